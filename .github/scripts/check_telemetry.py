@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Check that the copies of `percentile` and `Telemetry` in each pipe are the same code.
+
+Each pipe is built into its own image, so the telemetry core is copied into every pipe rather than shared.
+The copies may differ only in type annotations and the class docstring. Anything a pipe adds goes in a
+subclass or its callers, so a fix made to one copy has to be made to all of them.
+"""
+
+import argparse
+import ast
+import difflib
+import sys
+
+DEFAULT_FILES = [
+    'code-review-agent/pipe/pipe.py',
+    'new-relic-deployment-marker/pipe/pipe.py',
+    'terragrunt-config-export/main.py',
+]
+
+
+class StripAnnotations(ast.NodeTransformer):
+    def visit_arg(self, node):
+        node.annotation = None
+        return node
+
+    def visit_FunctionDef(self, node):
+        node.returns = None
+        return self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        return ast.Assign(targets=[node.target], value=node.value, lineno=node.lineno)
+
+
+def extract(path):
+    """Return the source of the file's percentile and Telemetry definitions, without annotations or the class docstring."""
+    with open(path) as source_file:
+        tree = ast.parse(source_file.read(), path)
+
+    definitions = {node.name: node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+    missing = {'percentile', 'Telemetry'} - set(definitions)
+    if missing:
+        sys.exit(f"{path} doesn't define {', '.join(sorted(missing))}")
+
+    telemetry = definitions['Telemetry']
+    if ast.get_docstring(telemetry) is not None:
+        telemetry.body = telemetry.body[1:]
+
+    module = ast.Module(body=[definitions['percentile'], telemetry], type_ignores=[])
+    return ast.unparse(ast.fix_missing_locations(StripAnnotations().visit(module)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='*', default=DEFAULT_FILES, help='Files holding a copy of the telemetry core')
+    args = parser.parse_args()
+
+    expected_path = args.files[0]
+    expected = extract(expected_path)
+    mismatched = []
+    for path in args.files[1:]:
+        actual = extract(path)
+        if actual != expected:
+            mismatched.append(path)
+            sys.stdout.writelines(difflib.unified_diff(
+                expected.splitlines(True), actual.splitlines(True), expected_path, path))
+
+    if mismatched:
+        sys.exit(f"The telemetry core in {', '.join(mismatched)} differs from {expected_path}")
+    print(f"The telemetry core is the same in {', '.join(args.files)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Measure how long a pipe's entry point takes to import using `python -X importtime`.
+
+Fails when a module that should be imported lazily is loaded at startup, or when the
+total import time goes over the budget. The measurements are written as JSON so CI
+can keep them as an artifact and track them over time.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure(path, module):
+    """Import the module in a fresh interpreter and return {module: (self_us, cumulative_us)} for top level imports."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=path, capture_output=True, text=True,
+        env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} from {path} failed:\n{result.stderr}")
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--path', required=True, help='Directory to run the import from')
+    parser.add_argument('--module', default='pipe', help='Module to import')
+    parser.add_argument('--lazy', action='append', default=[], help='Top level package that must not be imported at startup')
+    parser.add_argument('--budget-ms', type=float, help='Maximum median import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='File to write the measurements to as JSON')
+    args = parser.parse_args()
+
+    runs = [measure(args.path, args.module) for _ in range(args.runs)]
+    totals_ms = [imports[args.module][1] / 1000 for imports in runs]
+    median_ms = statistics.median(totals_ms)
+
+    slowest = sorted(
+        ((name, cumulative) for name, (_, cumulative) in runs[-1].items() if '.' not in name and name != args.module),
+        key=lambda item: item[1], reverse=True,
+    )[:10]
+
+    print(f"{args.path}: import {args.module} took {median_ms:.1f}ms (median of {args.runs} runs)")
+    for name, cumulative in slowest:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    eager = sorted({name.split('.')[0] for name in runs[-1]} & set(args.lazy))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'path': args.path,
+                'module': args.module,
+                'median_ms': median_ms,
+                'runs_ms': totals_ms,
+                'slowest': {name: cumulative / 1000 for name, cumulative in slowest},
+                'eager_imports': eager,
+            }, output_file, indent=2)
+
+    if eager:
+        sys.exit(f"Modules that should be imported lazily were imported at startup: {', '.join(eager)}")
+
+    if args.budget_ms is not None and median_ms > args.budget_ms:
+        sys.exit(f"Import time of {median_ms:.1f}ms is over the budget of {args.budget_ms}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,107 @@
+import time
+import hashlib
+import tempfile
+import threading
+from functools import cache, partial
+
+from bitbucket_pipes_toolkit import get_logger
+from chromadb.config import Settings
 from crewai import Agent, Crew, Process, Task
+from crewai.knowledge.knowledge import Knowledge
 from crewai.knowledge.source.string_knowledge_source import StringKnowledgeSource
-from crewai.project import CrewBase, agent, crew, task
-from pydantic import BaseModel
+from crewai.knowledge.storage.knowledge_storage import KnowledgeStorage
+from crewai.project import CrewBase, agent, before_kickoff, crew, task
+from crewai.rag.chromadb.config import ChromaDBConfig
+from crewai.rag.factory import create_client
+from pydantic import BaseModel, model_validator
 
 
 # If you want to run a snippet of code before or after the crew starts,
 # you can use the @before_kickoff and @after_kickoff decorators
 # https://docs.crewai.com/concepts/crews#example-crew-class-with-decorators
 
+logger = get_logger()
+SPECIALIST_TASKS = ('developer_task', 'tester_task', 'cyber_task')
+
+# Added to the end of the specialists' task descriptions. crewai's task prompt puts the expected output after
+# the description, so the diff is followed by the static expected output rather than being the very last thing
+CODE_TO_REVIEW = (
+	'\nCode To Review - The format of the following code is in the git diff format, '
+	'where "+" mean additions and "-" mean removals.\n'
+	'Any line that does not start with either of these characters has not been changed. Removals should not be reviewed.\n'
+	'\n{code_to_review}\n'
+)
+
+# Chunks are reviewed by concurrent crews sharing one knowledge store, so only one of them embeds the knowledge file
+knowledge_lock = threading.Lock()
+
+class CachedKnowledgeStorage(KnowledgeStorage):
+	"""Knowledge storage in a chroma store of its own at persist_directory, rather than crewai's default store.
+
+	The collection is named by the hash of the knowledge, so a store kept between runs only embeds a changed file.
+	"""
+	persist_directory: str
+
+	@model_validator(mode='after')
+	def create_cached_client(self):
+		self._client = create_client(ChromaDBConfig(settings=Settings(
+			persist_directory=self.persist_directory,
+			allow_reset=True,
+			is_persistent=True,
+			anonymized_telemetry=False,
+		)))
+		return self
+
+	@property
+	def full_collection_name(self):
+		# The name crewai's KnowledgeStorage gives the collection
+		return f"knowledge_{self.collection_name}"
+
+	def is_embedded(self):
+		return self._client.get_or_create_collection(collection_name=self.full_collection_name).count() > 0
+
+	def delete_other_collections(self):
+		for collection in self._client.client.list_collections():
+			if collection.name != self.full_collection_name:
+				self._client.delete_collection(collection_name=collection.name)
+
+@cache
+def temporary_knowledge_dir():
+	return tempfile.mkdtemp(prefix='knowledge-')
+
+def create_knowledge(knowledge_source_file, knowledge_cache_dir=None):
+	"""Returns the knowledge in the file, embedding it only when the store in the cache directory doesn't have it yet.
+
+	Without a cache directory, the chunks of a run share a temporary store and the file is embedded on every run.
+	"""
+	with open(knowledge_source_file, 'r') as file:
+		data = file.read().rstrip()
+
+	storage = CachedKnowledgeStorage(
+		# Chroma collection names are at most 63 characters
+		collection_name=hashlib.sha256(data.encode()).hexdigest()[:32],
+		persist_directory=knowledge_cache_dir or temporary_knowledge_dir(),
+	)
+	knowledge = Knowledge(
+		collection_name=storage.collection_name,
+		sources=[StringKnowledgeSource(content=data)],
+		storage=storage,
+	)
+
+	with knowledge_lock:
+		storage.delete_other_collections()
+		if storage.is_embedded():
+			logger.info('Using the cached knowledge embeddings')
+		else:
+			try:
+				knowledge.add_sources()
+			except Exception:
+				# A partly embedded collection would look cached to the next run
+				storage.reset()
+				raise
+
+	return knowledge
+
 class CodeChange(BaseModel):
 	before: str
 	after: str
@@ -35,34 +129,43 @@ class CodeReview():
 	agents_config = 'config/agents.yaml'
 	tasks_config = 'config/tasks.yaml'
 
+	def __init__(self, model=None):
+		# Without a model, the agents use the one in the MODEL environment variable
+		self.model = model
+
 	@agent
 	def developer(self) -> Agent:
 		return Agent(
 			config=self.agents_config['developer'],
+			llm=self.model,
 		)
 
 	@agent
 	def tester(self) -> Agent:
 		return Agent(
 			config=self.agents_config['tester'],
+			llm=self.model,
 		)
 
 	@agent
 	def cyber_expert(self) -> Agent:
 		return Agent(
 			config=self.agents_config['cyber_expert'],
+			llm=self.model,
 		)
 
 	@agent
 	def triage_agent(self) -> Agent:
 		return Agent(
 			config=self.agents_config['triage_agent'],
+			llm=self.model,
 		)
 
 	@agent
 	def report_analyst(self) -> Agent:
 		return Agent(
 			config=self.agents_config['report_analyst'],
+			llm=self.model,
 			verbose=True
 		)
 
@@ -97,19 +200,36 @@ class CodeReview():
 			output_json=Review
 		)
 
-	@crew
-	def crew(self, knowledge_source_file=None) -> Crew:
+	@before_kickoff
+	def start_task_timer(self, inputs):
+		self.kickoff_started_at = time.monotonic()
+		self.last_task_finished_at = self.kickoff_started_at
+		return inputs
 
-		knowledge_sources = []
-		if knowledge_source_file is not None:
-			with open(knowledge_source_file, 'r') as file:
-				data = file.read().rstrip()
+	def log_task_timing(self, task_name, concurrent, output):
+		finished_at = time.monotonic()
+		# Concurrent tasks all start at kickoff, the rest start when the task before them finishes
+		started_at = self.kickoff_started_at if concurrent else self.last_task_finished_at
+		self.last_task_finished_at = max(self.last_task_finished_at, finished_at)
+		logger.info(f"Task {task_name} took {finished_at - started_at:.1f}s")
+		return finished_at - started_at
 
-			knowledge_sources.append(
-				StringKnowledgeSource(
-					content=data
-				)
-			)
+	@crew
+	def crew(self, knowledge_source_file=None, parallel=False, knowledge_cache_dir=None) -> Crew:
+		# The specialists don't depend on each other, so they can run at the same time.
+		# Triage waits for all of them and gets their combined output as context
+		for task in self.tasks:
+			concurrent = parallel and task.name in SPECIALIST_TASKS
+			task.async_execution = concurrent
+			task.callback = partial(self.log_task_timing, task.name, concurrent)
+			# One after another, the tester and cyber expert see the diff through the developer's output,
+			# so only the developer is sent it. Run concurrently, each specialist needs its own copy
+			if task.name == 'developer_task' or concurrent:
+				task.description += CODE_TO_REVIEW
+
+		knowledge = None
+		if knowledge_source_file is not None:
+			knowledge = create_knowledge(knowledge_source_file, knowledge_cache_dir)
 
 		return Crew(
 			agents=self.agents,
@@ -117,5 +237,5 @@ class CodeReview():
 			process=Process.sequential,
 			verbose=False,
 			share_crew=False,
-			knowledge_sources=knowledge_sources,
+			knowledge=knowledge,
 		)
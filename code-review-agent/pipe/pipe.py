@@ -1,97 +1,827 @@
+import io
 import os
 import re
+import json
+import time
+import glob
+import sqlite3
+import hashlib
+import functools
+import threading
+import contextlib
 
-import tiktoken
 import yaml
 import requests
 
-from typing import Dict, Any
+from itertools import islice
+from collections import Counter
+from operator import itemgetter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from typing import TYPE_CHECKING, Dict, Any
 
 from bitbucket_pipes_toolkit import Pipe, get_logger, fail
-from snakemd import Document, Table, Inline
 
-from code_review.crew import CodeReview
+# tiktoken, snakemd and crewai (through code_review.crew) are imported where they're used,
+# so runs that stop early don't pay for loading them
+if TYPE_CHECKING:
+    from snakemd import Document
 
 logger = get_logger()
+ENCODING_NAME = "o200k_base"
+# Roughly how many characters of code make up a token, for estimates that aren't worth encoding the text
+CHARACTERS_PER_TOKEN = 4
+MODELS = ['gpt-4o-mini', 'gpt-4o', 'o3-mini', 'o3', 'gpt-5-mini']
 schema = {
     'OPENAI_API_KEY': {'type': 'string', 'required': True},
     'BITBUCKET_ACCESS_TOKEN': {'type': 'string', 'required': True},
-    'MODEL': {'type': 'string', 'required': True, 'allowed': ['gpt-4o-mini', 'gpt-4o', 'o3-mini', 'o3', 'gpt-5-mini']},
+    'MODEL': {'type': 'string', 'required': True, 'allowed': MODELS},
     'KNOWLEDGE_FILE_PATH': {'type': 'string', 'required': False},
     'MAX_INPUT_TOKENS': {'type': 'integer', 'required': False, 'default': 10000},
     'MAX_SUGGESTIONS': {'type': 'integer', 'required': False, 'default': 10},
     'MIN_SEVERITY_LIMIT': {'type': 'integer', 'required': False, 'default': 0},
     'SUGGEST_CODE': {'type': 'boolean', 'required': False, 'default': False},
+    'COMMENT_MODE': {'type': 'string', 'required': False, 'default': 'summary', 'allowed': ['summary', 'inline']},
+    'UPDATE_SUMMARY_COMMENT': {'type': 'boolean', 'required': False, 'default': False},
+    'MAX_REVIEW_CHUNKS': {'type': 'integer', 'required': False, 'default': 4, 'min': 1},
+    'MAX_CONCURRENT_REVIEWS': {'type': 'integer', 'required': False, 'default': 2, 'min': 1},
+    'PARALLEL_AGENTS': {'type': 'boolean', 'required': False, 'default': True},
+    'INCLUDE_FILES': {'type': 'list', 'required': False, 'default': []},
+    'EXCLUDE_FILES': {'type': 'list', 'required': False, 'default': []},
+    'DEFAULT_EXCLUDES': {'type': 'boolean', 'required': False, 'default': True},
+    'MAX_FILE_DIFF_LINES': {'type': 'integer', 'required': False, 'default': 0, 'min': 0},
+    'MODEL_ROUTING': {'type': 'boolean', 'required': False, 'default': False},
+    'FAST_MODEL': {'type': 'string', 'required': False, 'default': 'gpt-4o-mini', 'allowed': MODELS},
+    'FAST_MODEL_MAX_TOKENS': {'type': 'integer', 'required': False, 'default': 2000, 'min': 0},
+    'FAST_MODEL_MAX_FILES': {'type': 'integer', 'required': False, 'default': 5, 'min': 0},
+    'SENSITIVE_FILES': {'type': 'list', 'required': False, 'default': []},
+    'REVIEW_CACHE_DIR': {'type': 'string', 'required': False},
+    'REVIEW_CACHE_MAX_ENTRIES': {'type': 'integer', 'required': False, 'default': 10000, 'min': 1},
+    'TELEMETRY_FILE': {'type': 'string', 'required': False},
+    'OTLP_TRACES_FILE': {'type': 'string', 'required': False},
+}
+
+# USD per million prompt and completion tokens, to estimate what a review cost
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'o3-mini': (1.10, 4.40),
+    'o3': (2.00, 8.00),
+    'gpt-5-mini': (0.25, 2.00),
 }
 
+# Files where a change is worth the slower model's review, even when the change is small
+DEFAULT_SENSITIVE_FILES = [
+    '*auth*', '*login*', '*password*', '*secret*', '*token*', '*crypt*', '*permission*', '*security*',
+    '*.sql', '**/migrations/', 'Dockerfile', '*.tf',
+]
+
+# Comments carry an invisible marker, so later runs can tell which comments they've already posted
+COMMENT_MARKER = "[//]: # (code-review-agent:{})"
+COMMENT_MARKER_PATTERN = re.compile(r'^\[//\]: # \(code-review-agent:(\S+)\)$', re.MULTILINE)
+SUMMARY_COMMENT_KEY = 'summary'
+
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+CREW_CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code_review', 'config')
+CREW_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code_review', 'crew.py')
+
+# Lockfiles, bundles, snapshots and vendored code, which aren't worth the tokens to review
+DEFAULT_EXCLUDE_FILES = [
+    '*.lock', 'package-lock.json', 'npm-shrinkwrap.json', 'pnpm-lock.yaml', 'go.sum',
+    '*.min.js', '*.min.css', '*.map', '*.snap',
+    '**/vendor/', '**/node_modules/',
+]
+
+# percentile and Telemetry are copied into each pipe's image, .github/scripts/check_telemetry.py checks the copies match
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    rank = -(-percent * len(values) // 100)
+    return values[max(rank, 1) - 1]
+
+class Telemetry:
+    """Times the API calls and steps of a run as spans, summarised as latency percentiles per span name."""
+
+    def __init__(self, service_name, client_span_prefix):
+        self.service_name = service_name
+        # Spans named with this prefix are calls to another service, exported as SPAN_KIND_CLIENT
+        self.client_span_prefix = client_span_prefix
+        self.trace_id = os.urandom(16).hex()
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, started, seconds, attributes=None, error=None):
+        with self.lock:
+            self.spans.append({'name': name, 'span_id': os.urandom(8).hex(), 'started': started, 'seconds': seconds,
+                               'attributes': attributes or {}, 'error': str(error) if error else None})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time the block, yielding the span's attributes so the block can add to them."""
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, started, time.perf_counter() - start, attributes, error)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        by_name = {}
+        for span in self.spans:
+            by_name.setdefault(span['name'], []).append(span)
+
+        spans = {}
+        for name, recorded in sorted(by_name.items()):
+            seconds = sorted(span['seconds'] for span in recorded)
+            spans[name] = {
+                'count': len(seconds),
+                'errors': sum(1 for span in recorded if span['error']),
+                'totalSeconds': round(sum(seconds), 6),
+                'p50Seconds': round(percentile(seconds, 50), 6),
+                'p95Seconds': round(percentile(seconds, 95), 6),
+                'p99Seconds': round(percentile(seconds, 99), 6),
+                'maxSeconds': round(seconds[-1], 6),
+            }
+
+        return {
+            'service': self.service_name,
+            'started': self.started,
+            'durationSeconds': round(time.time() - self.started, 6),
+            'spans': spans,
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def format_summary(self, summary):
+        """The summary as the lines of a table, followed by the counters."""
+        width = max(len(name) for name in ['span', *summary['spans']]) + 2
+        lines = [f"{'span':<{width}}{'count':>7}{'errors':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}{'total (s)':>11}"]
+        for name, span in summary['spans'].items():
+            lines.append(
+                f"{name:<{width}}{span['count']:>7}{span['errors']:>8}{span['p50Seconds']:>10.3f}{span['p95Seconds']:>10.3f}"
+                f"{span['p99Seconds']:>10.3f}{span['maxSeconds']:>10.3f}{span['totalSeconds']:>11.3f}")
+        if summary['counters']:
+            lines.append('Counters: ' + ', '.join(f"{name}={value}" for name, value in summary['counters'].items()))
+        return lines
+
+    def write_json(self, path, summary):
+        with open(path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+
+    def write_otlp(self, path):
+        """Append the spans as one OTLP/JSON ExportTraceServiceRequest line, as read by the collector's otlpjsonfile receiver."""
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = []
+        for span in self.spans:
+            start_nanos = int(span['started'] * 1e9)
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': span['span_id'],
+                'name': span['name'],
+                # SPAN_KIND_CLIENT = 3, SPAN_KIND_INTERNAL = 1
+                'kind': 3 if span['name'].startswith(self.client_span_prefix) else 1,
+                'startTimeUnixNano': str(start_nanos),
+                'endTimeUnixNano': str(start_nanos + int(span['seconds'] * 1e9)),
+                'attributes': [attribute(key, value) for key, value in span['attributes'].items()],
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {},
+            })
+
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', self.service_name)]},
+            'scopeSpans': [{'scope': {'name': self.service_name}, 'spans': spans}],
+        }]}
+        with open(path, 'a') as traces_file:
+            traces_file.write(json.dumps(request, separators=(',', ':')) + '\n')
+
+class ReviewTelemetry(Telemetry):
+    """Telemetry that also adds up the tokens each model used, and an estimate of their cost."""
+
+    def __init__(self):
+        super().__init__('code-review-agent', 'bitbucket ')
+        self.token_usage = {}
+
+    def add_token_usage(self, model, usage):
+        """Add a crew's UsageMetrics to the model's token spend."""
+        with self.lock:
+            spend = self.token_usage.setdefault(
+                model, {'requests': 0, 'promptTokens': 0, 'cachedPromptTokens': 0, 'completionTokens': 0})
+            # Older crewai versions don't count cached prompt tokens
+            spend['requests'] += getattr(usage, 'successful_requests', 0)
+            spend['promptTokens'] += getattr(usage, 'prompt_tokens', 0)
+            spend['cachedPromptTokens'] += getattr(usage, 'cached_prompt_tokens', 0)
+            spend['completionTokens'] += getattr(usage, 'completion_tokens', 0)
+
+    def summary(self):
+        summary = super().summary()
+        summary['tokens'] = {}
+        for model, spend in sorted(self.token_usage.items()):
+            # Cached prompt tokens are billed at a discount, so this is an upper bound
+            prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+            cost = (spend['promptTokens'] * prompt_price + spend['completionTokens'] * completion_price) / 1_000_000
+            summary['tokens'][model] = {**spend, 'estimatedCostUsd': round(cost, 6)}
+        return summary
+
+    def format_summary(self, summary):
+        lines = super().format_summary(summary)
+        for model, spend in summary['tokens'].items():
+            lines.append(
+                f"{model}: {spend['requests']} requests, {spend['promptTokens']} prompt tokens "
+                f"({spend['cachedPromptTokens']} cached), {spend['completionTokens']} completion tokens, "
+                f"~${spend['estimatedCostUsd']:.4f}")
+        return lines
+
+def get_endpoint_name(url):
+    """Name a Bitbucket API call by its path within the repository, with ids and commit hashes replaced so calls group together."""
+    path = re.sub(r'^.*?/repositories/[^/]+/[^/]+', '', urlsplit(url).path)
+    return re.sub(r'/(?:\d+|[0-9a-f]{7,40}(?:\.\.[0-9a-f]{7,40})?)(?=/|$)', '/{id}', path) or '/'
+
 class BitbucketApiService:
     BITBUCKET_API_BASE_URL = "https://api.bitbucket.org/2.0"
     DIFF_DELIMITER = "diff --git a/"
+    REQUEST_TIMEOUT = 30
+    MAX_RETRIES = 3
+    POOL_SIZE = 10
+    COMMENT_WORKERS = 4
 
-    def __init__(self, auth, workspace, repo_slug):
+    def __init__(self, auth, workspace, repo_slug, telemetry=None):
         self.auth = auth
         self.workspace = workspace
         self.repo_slug = repo_slug
+        self.telemetry = telemetry or ReviewTelemetry()
+
+        # One session for every call so connections are kept alive, retrying throttled and failed reads
+        retry = Retry(
+            total=self.MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            respect_retry_after_header=True,
+        )
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=self.POOL_SIZE, max_retries=retry))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.REQUEST_TIMEOUT)
+        with self.telemetry.span(f"bitbucket {method} {get_endpoint_name(url)}") as attributes:
+            response = self.session.request(method, url, **kwargs)
+            # urllib3 keeps the retries it made for the response
+            retries = getattr(response.raw, 'retries', None)
+            attributes.update(status=response.status_code, retries=len(retries.history) if retries else 0)
+            if attributes['retries']:
+                self.telemetry.count('bitbucket_retries', attributes['retries'])
+            response.raise_for_status()
+        return response
+
+    def paginate(self, url):
+        """Yield the values of a paginated endpoint, only fetching the next page once the current one is used up."""
+        while url:
+            page = self.request("GET", url).json()
+            yield from page.get('values', [])
+            url = page.get('next')
 
     def get_last_pull_request_build(self, branch):
         url_diff = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pipelines?target.branch={branch}&target.selector.type=PULLREQUESTS&sort=-run_creation_date"
-        response = requests.request("GET", url_diff, auth=self.auth)
-        response.raise_for_status()
-        json_response = response.json()
-
-        if 'values' in json_response and len(json_response['values']) > 1:
-            return json_response['values'][1]
-        else:
-            return None  # Return None if the second value does not exist
+        # The first value is the build that is currently running
+        return next(islice(self.paginate(url_diff), 1, None), None)
 
     def get_pull_request(self, pull_request_id):
         url_diff = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}"
-        response = requests.request("GET", url_diff, auth=self.auth)
-        response.raise_for_status()
-        return response.json()
+        return self.request("GET", url_diff).json()
 
     def get_pull_request_commits(self, pull_request_id):
+        """Yield the commits of a pull request, newest first."""
         url_diff = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}/commits"
-        response = requests.request("GET", url_diff, auth=self.auth)
-        response.raise_for_status()
-        return response.json()
+        return self.paginate(url_diff)
 
     def get_pull_request_diffs(self, pull_request_id):
         url_diff = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}/diff"
-        response = requests.request("GET", url_diff, auth=self.auth)
-        response.raise_for_status()
-        return response.text
+        return self.request("GET", url_diff).text
 
     def get_commit_diff(self, commit_hash):
         url_diff = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/diff/{commit_hash}"
-        response = requests.request("GET", url_diff, auth=self.auth)
-        response.raise_for_status()
-        return response.text
+        return self.request("GET", url_diff).text
+
+    def get_commit_diffs(self, commit_hashes):
+        """Fetch the diff of each commit concurrently, returned in the same order as the hashes."""
+        if not commit_hashes:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.POOL_SIZE, len(commit_hashes))) as executor:
+            return list(executor.map(self.get_commit_diff, commit_hashes))
+
+    def get_pull_request_comments(self, pull_request_id):
+        url_comments = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}/comments?pagelen=100"
+        return self.paginate(url_comments)
 
     def add_comment(self, pull_request_id, payload):
         url_comment = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}/comments"
-        response = requests.request("POST", url_comment, auth=self.auth, json=payload)
-        response.raise_for_status()
-        return response.json()
+        return self.request("POST", url_comment, json=payload).json()
+
+    def add_comments(self, pull_request_id, payloads):
+        """Post comments concurrently, returning each comment or the error posting it, in the order of the payloads."""
+        if not payloads:
+            return []
+
+        def add_comment(payload):
+            try:
+                return self.add_comment(pull_request_id, payload)
+            except requests.RequestException as error:
+                return error
+
+        with ThreadPoolExecutor(max_workers=min(self.COMMENT_WORKERS, len(payloads))) as executor:
+            return list(executor.map(add_comment, payloads))
+
+    def update_comment(self, pull_request_id, comment_id, payload):
+        url_comment = f"{self.BITBUCKET_API_BASE_URL}/repositories/{self.workspace}/{self.repo_slug}/pullrequests/{pull_request_id}/comments/{comment_id}"
+        return self.request("PUT", url_comment, json=payload).json()
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name=ENCODING_NAME):
+    """Load a tiktoken encoding once per process. The image ships with its BPE file, see TIKTOKEN_CACHE_DIR."""
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+def count_tokens(string, encoding_name=ENCODING_NAME):
+    """Returns the number of tokens in a text string."""
+    # Diffs are plain text, so special tokens are counted as text rather than rejected
+    return len(get_encoding(encoding_name).encode_ordinary(string))
+
+def split_file_diffs(diff, delimiter=BitbucketApiService.DIFF_DELIMITER):
+    """Yield the diff of each file in a unified diff, one file at a time."""
+    file_diff = []
+    for line in io.StringIO(diff):
+        if line.startswith(delimiter) and file_diff:
+            yield ''.join(file_diff)
+            file_diff = []
+        file_diff.append(line)
+
+    if file_diff:
+        yield ''.join(file_diff)
+
+def join_commit_diffs(commit_diffs):
+    """Join the diffs of several commits into one diff, where the same file can appear once for each commit.
+
+    Nothing goes between the diffs, as any line outside a file header or hunk would be parsed as part of a hunk.
+    """
+    return ''.join(commit_diff if commit_diff.endswith('\n') else commit_diff + '\n'
+                   for commit_diff in commit_diffs if commit_diff)
+
+def split_hunks(file_diff):
+    """Split the diff of one file into its header and the text of each hunk."""
+    header, hunks = [], []
+    for line in io.StringIO(file_diff):
+        if line.startswith('@@'):
+            hunks.append([line])
+        elif hunks:
+            hunks[-1].append(line)
+        else:
+            header.append(line)
+
+    return ''.join(header), [''.join(hunk) for hunk in hunks]
+
+def format_hunk_range(start, count):
+    # An empty range starts at the line before it, as in the headers git writes
+    return f"{start - 1 if count == 0 else start},{count}"
+
+def split_hunk(hunk, token_budget, count_tokens):
+    """Split a hunk into (tokens, hunk) pieces within the token budget, on line boundaries.
+
+    Each piece gets its own header with the line ranges it covers, so it is still a valid hunk.
+    """
+    header, *lines = hunk.splitlines(keepends=True)
+    match = HUNK_HEADER_PATTERN.match(header)
+    if match is None:
+        yield from ((count_tokens(line), line) for line in io.StringIO(hunk))
+        return
+
+    old_start, old_count, new_start, new_count = match.groups()
+    old_line = int(old_start) + (old_count == '0')
+    new_line = int(new_start) + (new_count == '0')
+    # The function name git puts after the ranges, which gives each piece some context
+    section = header[match.end():]
+    header_tokens = count_tokens(header)
+
+    pieces, piece, piece_tokens = [], [], header_tokens
+    for line in lines:
+        tokens = count_tokens(line)
+        if piece and piece_tokens + tokens > token_budget:
+            pieces.append((piece_tokens, piece))
+            piece, piece_tokens = [], header_tokens
+        piece.append(line)
+        piece_tokens += tokens
+    if piece:
+        pieces.append((piece_tokens, piece))
+
+    for piece_tokens, piece in pieces:
+        old_lines = sum(not line.startswith(('+', '\\')) for line in piece)
+        new_lines = sum(not line.startswith(('-', '\\')) for line in piece)
+        piece_header = f"@@ -{format_hunk_range(old_line, old_lines)} +{format_hunk_range(new_line, new_lines)} @@{section}"
+        yield piece_tokens, piece_header + ''.join(piece)
+        old_line += old_lines
+        new_line += new_lines
+
+def split_oversized_diff(file_diff, token_budget, count_tokens):
+    """Split the diff of one file into pieces within the token budget, on hunk boundaries where possible.
+
+    Each piece repeats the file header so the reviewer still knows which file the hunks belong to.
+    """
+    header, hunks = split_hunks(file_diff)
+    header_tokens = count_tokens(header)
+
+    # A hunk that doesn't fit on its own is broken up into smaller hunks
+    units = []
+    for hunk in hunks:
+        tokens = count_tokens(hunk)
+        if header_tokens + tokens <= token_budget:
+            units.append((tokens, hunk))
+        else:
+            units.extend(split_hunk(hunk, token_budget - header_tokens, count_tokens))
+
+    piece, piece_tokens = [], header_tokens
+    for tokens, unit in units:
+        if piece and piece_tokens + tokens > token_budget:
+            yield piece_tokens, header + ''.join(piece)
+            piece, piece_tokens = [], header_tokens
+        piece.append(unit)
+        piece_tokens += tokens
+
+    if piece or not hunks:
+        yield piece_tokens, header + ''.join(piece)
+
+def get_diff_path(file_diff):
+    """Returns the path of the file a diff is for, the new path when it was renamed."""
+    header = file_diff.partition('\n')[0]
+    for line in io.StringIO(file_diff):
+        if line.startswith('+++ b/'):
+            return line[len('+++ b/'):].rstrip('\n')
+        if line.startswith('@@'):
+            break
+
+    # Files without content changes only have the 'diff --git a/<path> b/<path>' line
+    return header[len(BitbucketApiService.DIFF_DELIMITER):].rpartition(' b/')[2]
+
+def translate_glob_segment(segment):
+    """Translate one path segment of a glob to a regular expression, where wildcards don't match a slash."""
+    regex, index = '', 0
+    while index < len(segment):
+        char = segment[index]
+        index += 1
+        if char == '*':
+            regex += '[^/]*'
+            while segment[index:index + 1] == '*':
+                index += 1
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in segment[index + 1:]:
+            end = segment.index(']', index + 1)
+            characters = segment[index:end].replace('\\', '\\\\')
+            regex += '[^' + characters[1:] + ']' if characters.startswith('!') else '[' + characters + ']'
+            index = end + 1
+        else:
+            regex += re.escape(char)
+
+    return regex
+
+@functools.lru_cache(maxsize=None)
+def compile_glob(pattern):
+    """Compile a .gitattributes style glob to a regular expression matching whole paths."""
+    directory = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # Patterns with a slash are relative to the root, the rest match in any directory
+    regex = '' if '/' in pattern else '(?:.*/)?'
+
+    segments = pattern.lstrip('/').split('/')
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if last else '(?:.*/)?'
+        else:
+            regex += translate_glob_segment(segment) + ('' if last else '/')
+
+    if directory:
+        regex += '/.*'
+    return re.compile(regex, re.DOTALL)
+
+def path_matches(path, pattern):
+    """Match a path against a .gitattributes style glob.
+
+    Patterns without a slash match the file name in any directory, and patterns ending in a slash match a directory.
+    A * or ? doesn't match a slash, while ** matches any number of directories.
+    """
+    return compile_glob(pattern).fullmatch(path) is not None
+
+def read_generated_files(gitattributes_path):
+    """Read the patterns of a .gitattributes file that set or unset linguist-generated or linguist-vendored.
+
+    Returns (pattern, generated) pairs in file order, so the last pattern matching a path wins.
+    """
+    patterns = []
+    try:
+        with open(gitattributes_path, 'r') as gitattributes:
+            lines = gitattributes.readlines()
+    except FileNotFoundError:
+        return patterns
+
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+
+        for attribute in fields[1:]:
+            name, _, value = attribute.lstrip('-!').partition('=')
+            if name in ('linguist-generated', 'linguist-vendored'):
+                patterns.append((fields[0], not attribute.startswith(('-', '!')) and value != 'false'))
+
+    return patterns
+
+class DiffFilter:
+    """Drops the files and hunks of a diff that aren't worth reviewing, keeping what was dropped to report on."""
+
+    def __init__(self, include_files=(), exclude_files=(), generated_files=(), max_file_lines=0):
+        self.include_files = list(include_files)
+        self.exclude_files = list(exclude_files)
+        self.generated_files = list(generated_files)
+        self.max_file_lines = max_file_lines
+        self.dropped_files = Counter()
+        self.dropped_hunks = 0
+        self.dropped_characters = 0
+
+    def is_generated(self, path):
+        generated = False
+        for pattern, is_generated in self.generated_files:
+            if path_matches(path, pattern):
+                generated = is_generated
+        return generated
+
+    def get_drop_reason(self, path):
+        if self.include_files and not any(path_matches(path, pattern) for pattern in self.include_files):
+            return 'not included'
+        if any(path_matches(path, pattern) for pattern in self.exclude_files):
+            return 'excluded'
+        if self.is_generated(path):
+            return 'generated'
+        return None
+
+    def filter(self, file_diffs):
+        """Yield the diff of each file worth reviewing, without the hunks that only remove lines."""
+        for file_diff in file_diffs:
+            reason = self.get_drop_reason(get_diff_path(file_diff))
+            header, hunks = split_hunks(file_diff)
+            # The agents don't review removals, so a hunk needs at least one added line
+            added_hunks, removal_hunks = [], []
+            for hunk in hunks:
+                (added_hunks if re.search(r'^\+', hunk, re.MULTILINE) else removal_hunks).append(hunk)
+
+            if reason is None and not hunks:
+                reason = 'no text changes'
+            elif reason is None and not added_hunks:
+                reason = 'removals only'
+            elif reason is None and self.max_file_lines:
+                if sum(hunk.count('\n') for hunk in added_hunks) > self.max_file_lines:
+                    reason = 'too large'
+
+            if reason is not None:
+                self.dropped_files[reason] += 1
+                self.dropped_characters += len(file_diff)
+                continue
+
+            if removal_hunks:
+                self.dropped_hunks += len(removal_hunks)
+                self.dropped_characters += sum(len(hunk) for hunk in removal_hunks)
+                file_diff = header + ''.join(added_hunks)
+
+            yield file_diff
+
+    def tokens_saved(self):
+        """Estimate the tokens in what was dropped, rather than encoding whole lockfiles just to report on them."""
+        return self.dropped_characters // CHARACTERS_PER_TOKEN
+
+def parse_hunk(hunk):
+    """Returns the old start line, new start line, new line count and body lines of a hunk.
+
+    Returns None when the body doesn't match the line counts in its header, as for a damaged hunk.
+    """
+    match = HUNK_HEADER_PATTERN.match(hunk)
+    if match is None:
+        return None
+
+    old_start, old_count, new_start, new_count = match.groups()
+    old_count = 1 if old_count is None else int(old_count)
+    new_count = 1 if new_count is None else int(new_count)
+
+    lines = hunk.splitlines()[1:]
+    if sum(not line.startswith('+') for line in lines if not line.startswith('\\')) != old_count \
+            or sum(not line.startswith('-') for line in lines if not line.startswith('\\')) != new_count:
+        return None
+
+    return int(old_start), int(new_start), new_count, lines
+
+class ReviewCache:
+    """The issues found in previously reviewed hunks, kept in SQLite and evicting the least recently used hunks.
+
+    Hunks are keyed on their path and content without line numbers, so a rebase that only moves a hunk still hits,
+    and issue lines are stored relative to the start of their hunk. Keys include the model that reviewed the hunk.
+    """
+
+    def __init__(self, path, version, max_entries=10000):
+        self.version = version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.cached_issues = []
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS reviews (key TEXT PRIMARY KEY, issues TEXT NOT NULL, last_used REAL NOT NULL)')
+
+    def get_key(self, path, lines, model):
+        content = '\n'.join(line.rstrip() for line in lines)
+        return hashlib.sha256(f"{self.version}\0{model}\0{path}\0{content}".encode()).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute('SELECT issues FROM reviews WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        with self.connection:
+            self.connection.execute('UPDATE reviews SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def lookup(self, file_diffs, get_models):
+        """Yield each file diff with only the hunks that haven't been reviewed before, collecting the cached issues.
+
+        get_models returns the models whose reviews of a path can be used, in order of preference.
+        """
+        for file_diff in file_diffs:
+            path = get_diff_path(file_diff)
+            header, hunks = split_hunks(file_diff)
+            models = get_models(path)
+            missed_hunks = []
+            for hunk in hunks:
+                parsed = parse_hunk(hunk)
+                issues = None
+                for model in models if parsed is not None else ():
+                    issues = self.get(self.get_key(path, parsed[3], model))
+                    if issues is not None:
+                        break
+
+                if issues is None:
+                    self.misses += 1
+                    missed_hunks.append(hunk)
+                    continue
+
+                self.hits += 1
+                old_start, new_start = parsed[:2]
+                for issue in issues:
+                    issue['file'].update(
+                        full_path=path,
+                        new_line=new_start + issue['file']['new_line'],
+                        old_line=0 if issue['file']['old_line'] is None else old_start + issue['file']['old_line'],
+                    )
+                    self.cached_issues.append(issue)
+
+            if missed_hunks:
+                yield header + ''.join(missed_hunks)
+
+    def store(self, reviewed_diff, issues, model):
+        """Store the issues the model found in each whole hunk of a reviewed diff, including hunks without any."""
+        entries = []
+        now = time.time()
+        for file_diff in split_file_diffs(reviewed_diff):
+            path = get_diff_path(file_diff)
+            for hunk in split_hunks(file_diff)[1]:
+                parsed = parse_hunk(hunk)
+                if parsed is None:
+                    continue
+
+                old_start, new_start, new_count, lines = parsed
+                hunk_issues = [
+                    {**issue, 'file': {
+                        **issue['file'],
+                        'new_line': issue['file']['new_line'] - new_start,
+                        # Added lines don't have an old line
+                        'old_line': issue['file']['old_line'] - old_start if issue['file']['old_line'] else None,
+                    }}
+                    for issue in issues
+                    if issue['file']['full_path'] == path
+                    and new_start <= issue['file']['new_line'] < new_start + max(new_count, 1)
+                ]
+                entries.append((self.get_key(path, lines, model), json.dumps(hunk_issues), now))
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO reviews VALUES (?, ?, ?)', entries)
+            self.connection.execute(
+                'DELETE FROM reviews WHERE key NOT IN (SELECT key FROM reviews ORDER BY last_used DESC LIMIT ?)',
+                (self.max_entries,))
+
+    def close(self):
+        self.connection.close()
+
+def count_file_tokens(file_diffs, token_limit):
+    """Count the tokens of each file diff, stopping once the running total is over the limit.
+
+    Returns the (tokens, diff) pair of each file counted, and how many files were left uncounted.
+    """
+    file_diffs = iter(file_diffs)
+    sized_diffs = []
+    total_tokens = 0
+    for file_diff in file_diffs:
+        tokens = count_tokens(file_diff)
+        sized_diffs.append((tokens, file_diff))
+        total_tokens += tokens
+        if total_tokens > token_limit:
+            break
+
+    return sized_diffs, sum(1 for _ in file_diffs)
+
+def pack_diff_chunks(sized_diffs, token_budget):
+    """Pack (tokens, diff) pairs into as few (tokens, chunk) pairs within the token budget as possible.
+
+    Uses first-fit decreasing, so small files share a chunk with whatever space the large ones leave.
+    """
+    chunks = []
+    for tokens, file_diff in sorted(sized_diffs, key=itemgetter(0), reverse=True):
+        for chunk in chunks:
+            if chunk[0] + tokens <= token_budget:
+                chunk[0] += tokens
+                chunk[1].append(file_diff)
+                break
+        else:
+            chunks.append([tokens, [file_diff]])
+
+    return [(tokens, ''.join(file_diffs)) for tokens, file_diffs in chunks]
+
+def merge_reviews(reviews, max_suggestions):
+    """Merge the reviews of each chunk, dropping duplicate issues and keeping the most severe first."""
+    summaries = []
+    issues = {}
+    for review in reviews:
+        if review['summary_of_changes']:
+            summaries.append(review['summary_of_changes'])
+        for issue in review['issues']:
+            key = (issue['file']['full_path'], issue['file']['new_line'], issue['title'].strip().casefold())
+            if key not in issues or issue['severity'] > issues[key]['severity']:
+                issues[key] = issue
+
+    return {
+        'summary_of_changes': ' '.join(summaries),
+        'issues': sorted(issues.values(), key=itemgetter('severity'), reverse=True)[:max_suggestions],
+    }
 
 class CodeReviewPipe(Pipe):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.auth_method_bitbucket = self.resolve_auth()
+        self.telemetry = ReviewTelemetry()
 
         # Bitbucket
         self.workspace = os.getenv('BITBUCKET_WORKSPACE')
         self.repo_slug = os.getenv('BITBUCKET_REPO_SLUG')
         self.bitbucket_client = BitbucketApiService(
-            self.auth_method_bitbucket, self.workspace, self.repo_slug)
-
-    def num_tokens_from_string(self, string: str, encoding_name: str) -> int:
-        """Returns the number of tokens in a text string."""
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+            self.auth_method_bitbucket, self.workspace, self.repo_slug, telemetry=self.telemetry)
 
     def run(self):
+        # The review stops early through sys.exit, so the report is made on the way out
+        try:
+            with self.telemetry.span('run'):
+                self.review_pull_request()
+        finally:
+            self.report_telemetry()
+
+    def report_telemetry(self):
+        """Log the run's timings and token spend, and write them to TELEMETRY_FILE and OTLP_TRACES_FILE when they're set."""
+        summary = self.telemetry.summary()
+        for line in self.telemetry.format_summary(summary):
+            self.log_info(line)
+
+        clone_dir = os.getenv('BITBUCKET_CLONE_DIR', os.getcwd())
+        if self.get_variable('TELEMETRY_FILE'):
+            self.telemetry.write_json(os.path.join(clone_dir, self.get_variable('TELEMETRY_FILE')), summary)
+        if self.get_variable('OTLP_TRACES_FILE'):
+            self.telemetry.write_otlp(os.path.join(clone_dir, self.get_variable('OTLP_TRACES_FILE')))
+
+    def review_pull_request(self):
         super().run()
         self.log_info('Executing the pipe...')
 
@@ -104,78 +834,351 @@ class CodeReviewPipe(Pipe):
                 'https://support.atlassian.com/bitbucket-cloud/docs/pipeline-start-conditions/#Pull-Requests'
             )
 
+        diff_to_review = self.get_diff_to_review(pull_request_id)
+
+        if not diff_to_review:
+            self.log_warning(f"No files for code review.")
+            self.success(message='Pipe is stopped.', do_exit=True)
+
+        input_token_limit = self.get_variable('MAX_INPUT_TOKENS')
+        max_review_chunks = self.get_variable('MAX_REVIEW_CHUNKS')
+
+        diff_filter = self.create_diff_filter()
+        file_diffs = diff_filter.filter(split_file_diffs(diff_to_review))
+
+        review_cache = self.create_review_cache()
+        if review_cache is not None:
+            file_diffs = review_cache.lookup(file_diffs, self.get_cached_review_models)
+
+        # Nothing past what the chunks can hold gets reviewed, so there's no need to count it
+        review_token_limit = input_token_limit * max_review_chunks
+        # The filter and cache lookup are lazy, so they run as the files are counted
+        with self.telemetry.span('filter and count tokens') as attributes:
+            sized_diffs, uncounted_files = count_file_tokens(file_diffs, review_token_limit)
+            attributes['files'] = len(sized_diffs)
+        number_of_tokens = sum(tokens for tokens, _ in sized_diffs)
+        if uncounted_files:
+            self.log_warning(
+                f"The diff is over the review limit of {review_token_limit} tokens, "
+                f"the last {uncounted_files} files will not be reviewed.")
+
+        if diff_filter.dropped_files or diff_filter.dropped_hunks:
+            dropped_files = ', '.join(f"{count} {reason}" for reason, count in diff_filter.dropped_files.items())
+            self.log_info(
+                f"Filtered out {sum(diff_filter.dropped_files.values())} files ({dropped_files or 'none'}) and "
+                f"{diff_filter.dropped_hunks} removal only hunks, saving about {diff_filter.tokens_saved()} tokens.")
+
+        if review_cache is not None:
+            self.log_info(
+                f"Review cache: {review_cache.hits} hunks reviewed before, {review_cache.misses} to review.")
+
+        if not sized_diffs and (review_cache is None or not review_cache.hits):
+            self.log_warning(f"No files for code review after filtering.")
+            self.success(message='Pipe is stopped.', do_exit=True)
+
+        if not sized_diffs:
+            chunks = []
+        elif number_of_tokens > input_token_limit:
+            with self.telemetry.span('chunk', files=len(sized_diffs)):
+                chunks = self.chunk_diff(sized_diffs, input_token_limit)
+            self.log_warning(
+                f"Max input tokens exceeded limit of {input_token_limit}. Actual count of tokens: {number_of_tokens}. "
+                f"Reviewing the diff in {len(chunks)} chunks.")
+
+            if len(chunks) > max_review_chunks:
+                self.log_warning(f"Only the first {max_review_chunks} of {len(chunks)} chunks will be reviewed.")
+                chunks = chunks[:max_review_chunks]
+        else:
+            chunks = [(number_of_tokens, ''.join(file_diff for _, file_diff in sized_diffs))]
+
+        max_suggestions = self.get_variable('MAX_SUGGESTIONS')
+        self.log_info(
+            f"Generating a max suggestion count of: {max_suggestions}")
+
+        reviewed_chunks = self.review_chunks(chunks) if chunks else []
+        reviews = [review for _, _, review in reviewed_chunks]
+        if review_cache is not None:
+            for chunk, model, chunk_review in reviewed_chunks:
+                # The reviewers stop at MAX_SUGGESTIONS, so a full review may have left out issues worth reporting later
+                if len(chunk_review['issues']) >= max_suggestions:
+                    continue
+                review_cache.store(chunk, chunk_review['issues'], model)
+            review_cache.close()
+
+            summary = '' if chunks else 'Every change in this pull request was reviewed before, these are the issues found then.'
+            reviews.append({'summary_of_changes': summary, 'issues': review_cache.cached_issues})
+
+        review = merge_reviews(reviews, max_suggestions)
+
+        with self.telemetry.span('post review', issues=len(review['issues'])):
+            added_suggestions = self.post_review(pull_request_id, review)
+        ui_pull_request_url = f"https://bitbucket.org/{self.workspace}/{self.repo_slug}/pull-requests/{pull_request_id}"
+        self.success(message=f"🤖 Successfully added {added_suggestions} comments to the pull request: {ui_pull_request_url} 🤖")
+
+    def get_diff_to_review(self, pull_request_id):
+        """Returns the diff of the whole pull request on its first build, and of the commits since the last build after that."""
         pull_reqeust = self.bitbucket_client.get_pull_request(pull_request_id)
         last_pull_request_build = self.bitbucket_client.get_last_pull_request_build(pull_reqeust['source']['branch']['name'])
 
         # If we've had no build prior to this one, review the entire PR - If not, then only review non merge commits
         if last_pull_request_build is None:
             self.log_info(f"Pull Request has no previous build, going to do a full review of pull request: {pull_request_id}")
-            diff_to_review = self.bitbucket_client.get_pull_request_diffs(pull_request_id)
-        else:
-            self.log_info(
-                f"Pull Request has a previous build, going to do a partial review of pull request: {pull_request_id}")
+            return self.bitbucket_client.get_pull_request_diffs(pull_request_id)
 
-            last_build_commit = last_pull_request_build['target']['commit']['hash']
-            pull_reqeust_commits = self.bitbucket_client.get_pull_request_commits(pull_request_id)
-            commits_to_review = []
-            for commit in pull_reqeust_commits['values']:
-                if commit['hash'] == last_build_commit:
-                    break
+        self.log_info(f"Pull Request has a previous build, going to do a partial review of pull request: {pull_request_id}")
 
-                if len(commit['parents']) > 1:
-                    continue
+        last_build_commit = last_pull_request_build['target']['commit']['hash']
+        pull_reqeust_commits = self.bitbucket_client.get_pull_request_commits(pull_request_id)
+        commits_to_review = []
+        found_last_build_commit = False
+        skipped_merge_commits = False
+        # Stops paging through the commits as soon as the last built commit is found
+        for commit in pull_reqeust_commits:
+            if commit['hash'] == last_build_commit:
+                found_last_build_commit = True
+                break
 
-                commits_to_review.append(commit['hash'])
+            if len(commit['parents']) > 1:
+                skipped_merge_commits = True
+                continue
 
-            # Reverse the commits so we have them in order of oldest first
-            commits_to_review.reverse()
-            diff_to_review = []
-            for commit_to_review in commits_to_review:
-                diff_to_review.append(f"--- Commit Hash: {commit_to_review} ---")
-                diff_to_review.append(self.bitbucket_client.get_commit_diff(commit_to_review))
+            commits_to_review.append(commit['hash'])
 
-            diff_to_review = '\n'.join(diff_to_review)
+        # Reverse the commits so we have them in order of oldest first
+        commits_to_review.reverse()
 
-        if not diff_to_review:
-            self.log_warning(f"No files for code review.")
-            self.success(message='Pipe is stopped.', do_exit=True)
+        if commits_to_review and found_last_build_commit and not skipped_merge_commits:
+            # Without merge commits in the range, one range diff covers every commit since the last build
+            return self.bitbucket_client.get_commit_diff(f"{commits_to_review[-1]}..{last_build_commit}")
 
-        number_of_tokens = self.num_tokens_from_string(diff_to_review, "o200k_base")
+        self.log_info(f"Reviewing the diffs of {len(commits_to_review)} commits: {', '.join(commits_to_review)}")
+        return join_commit_diffs(self.bitbucket_client.get_commit_diffs(commits_to_review))
 
-        input_token_limit = self.get_variable('MAX_INPUT_TOKENS')
-        # Check for sensible max tokens, add pipe variable for this
-        if number_of_tokens > input_token_limit:
-            self.log_warning(f"Max input tokens exceeded limit of {input_token_limit}. Actual count of tokens: {number_of_tokens}.")
-            self.success(message='Pipe is stopped.', do_exit=True)
+    def create_diff_filter(self):
+        exclude_files = list(self.get_variable('EXCLUDE_FILES'))
+        if self.get_variable('DEFAULT_EXCLUDES'):
+            exclude_files += DEFAULT_EXCLUDE_FILES
+
+        clone_dir = os.getenv('BITBUCKET_CLONE_DIR', os.getcwd())
+        return DiffFilter(
+            include_files=self.get_variable('INCLUDE_FILES'),
+            exclude_files=exclude_files,
+            generated_files=read_generated_files(os.path.join(clone_dir, '.gitattributes')),
+            max_file_lines=self.get_variable('MAX_FILE_DIFF_LINES'),
+        )
+
+    def get_cache_dir(self, *paths):
+        if not self.get_variable('REVIEW_CACHE_DIR'):
+            return None
+
+        return os.path.join(os.getenv('BITBUCKET_CLONE_DIR', os.getcwd()), self.get_variable('REVIEW_CACHE_DIR'), *paths)
+
+    def create_review_cache(self):
+        cache_dir = self.get_cache_dir()
+        if cache_dir is None:
+            return None
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Cached issues are only valid for the same prompts, knowledge and limits. Entries are kept per model
+        version = hashlib.sha256()
+        for name in ('MAX_SUGGESTIONS', 'MIN_SEVERITY_LIMIT'):
+            version.update(f"{name}={self.get_variable(name)}\0".encode())
+        # The crew adds the diff to the task prompts, so its module is part of the prompts too
+        version_files = sorted(glob.glob(os.path.join(CREW_CONFIG_DIR, '*.yaml'))) + [CREW_MODULE]
+        if self.get_variable('KNOWLEDGE_FILE_PATH'):
+            version_files.append(self.get_variable('KNOWLEDGE_FILE_PATH'))
+        for version_file in version_files:
+            with open(version_file, 'rb') as file:
+                version.update(hashlib.sha256(file.read()).digest())
+
+        return ReviewCache(
+            os.path.join(cache_dir, 'reviews.sqlite3'),
+            version.hexdigest(),
+            max_entries=self.get_variable('REVIEW_CACHE_MAX_ENTRIES'),
+        )
+
+    def chunk_diff(self, sized_diffs, token_budget):
+        """Pack the (tokens, diff) pairs of each file into (tokens, chunk) pairs that each fit within the token budget."""
+        fitting_diffs = []
+        for tokens, file_diff in sized_diffs:
+            if tokens <= token_budget:
+                fitting_diffs.append((tokens, file_diff))
+            else:
+                fitting_diffs.extend(split_oversized_diff(file_diff, token_budget, count_tokens))
+
+        return pack_diff_chunks(fitting_diffs, token_budget)
+
+    def is_sensitive(self, path):
+        sensitive_files = list(self.get_variable('SENSITIVE_FILES')) or DEFAULT_SENSITIVE_FILES
+        return any(path_matches(path, pattern) for pattern in sensitive_files)
+
+    def get_cached_review_models(self, path):
+        """Returns the models whose cached reviews of a path can be used, the reviews of MODEL first."""
+        # A chunk with the path could be routed to either model, but a sensitive path always goes to MODEL
+        if self.get_variable('MODEL_ROUTING') and not self.is_sensitive(path):
+            return [self.get_variable('MODEL'), self.get_variable('FAST_MODEL')]
+        return [self.get_variable('MODEL')]
+
+    def choose_model(self, chunk, tokens):
+        """Returns the model to review a chunk with, and why it was chosen."""
+        model = self.get_variable('MODEL')
+        if not self.get_variable('MODEL_ROUTING'):
+            return model, 'MODEL'
+
+        paths = [get_diff_path(file_diff) for file_diff in split_file_diffs(chunk)]
+        for path in paths:
+            if self.is_sensitive(path):
+                return model, f"sensitive file {path}"
+
+        if tokens > self.get_variable('FAST_MODEL_MAX_TOKENS'):
+            return model, f"{tokens} tokens"
+        if len(paths) > self.get_variable('FAST_MODEL_MAX_FILES'):
+            return model, f"{len(paths)} files"
+
+        return self.get_variable('FAST_MODEL'), f"{tokens} tokens in {len(paths)} files"
+
+    def review_chunk(self, chunk, model):
+        from code_review.crew import CodeReview
 
-        max_suggestions = self.get_variable('MAX_SUGGESTIONS')
-        min_severity_limit = self.get_variable('MIN_SEVERITY_LIMIT')
         inputs = {
-            'code_to_review': diff_to_review,
-            'max_suggestion_count': max_suggestions,
-            'min_severity_limit': min_severity_limit
+            'code_to_review': chunk,
+            'max_suggestion_count': self.get_variable('MAX_SUGGESTIONS'),
+            'min_severity_limit': self.get_variable('MIN_SEVERITY_LIMIT')
         }
 
-        self.log_info(
-            f"Generating a max suggestion count of: {max_suggestions}")
+        # Each chunk gets its own crew, so concurrent reviews don't share agent state
+        return (CodeReview(model=model)
+                .crew(knowledge_source_file=self.get_variable('KNOWLEDGE_FILE_PATH'),
+                      parallel=self.get_variable('PARALLEL_AGENTS'),
+                      knowledge_cache_dir=self.get_cache_dir('knowledge'))
+                .kickoff(inputs=inputs))
+
+    def timed_review_chunk(self, chunk, model):
+        started_at = time.monotonic()
+        with self.telemetry.span('crew kickoff', model=model):
+            output = self.review_chunk(chunk, model)
+        return output, time.monotonic() - started_at
+
+    def review_chunks(self, chunks):
+        """Review each (tokens, chunk) pair with a bounded number of crews at once.
+
+        Returns the (chunk, model, review) of each chunk that was reviewed.
+        """
+        max_workers = min(self.get_variable('MAX_CONCURRENT_REVIEWS'), len(chunks))
+        reviews = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for number, (tokens, chunk) in enumerate(chunks, start=1):
+                model, reason = self.choose_model(chunk, tokens)
+                self.log_info(f"Reviewing chunk {number} of {len(chunks)} with {model} ({reason}).")
+                futures.append((model, executor.submit(self.timed_review_chunk, chunk, model)))
+
+            for number, (model, future) in enumerate(futures, start=1):
+                try:
+                    output, duration = future.result()
+                except Exception as error:
+                    self.log_warning(f"Review of chunk {number} of {len(chunks)} failed: {error}")
+                    continue
+
+                self.log_info(f"Reviewed chunk {number} of {len(chunks)} with {model} in {duration:.1f}s.")
+                self.log_info(f"Tokens Used (chunk {number} of {len(chunks)}): {output.token_usage}")
+                self.telemetry.add_token_usage(model, output.token_usage)
+                if output.json_dict is None:
+                    self.log_warning(f"Review of chunk {number} of {len(chunks)} returned no structured output.")
+                    continue
+
+                reviews.append((chunks[number - 1][1], model, output.json_dict))
+
+        if not reviews:
+            self.fail(message='None of the diff chunks could be reviewed.')
+
+        return reviews
+
+    def post_review(self, pull_request_id, review):
+        """Post the review to the pull request, returning how many comments were added or updated."""
+        inline = self.get_variable('COMMENT_MODE') == 'inline'
+        update_summary = self.get_variable('UPDATE_SUMMARY_COMMENT')
 
-        output = (CodeReview()
-                  .crew(knowledge_source_file=self.get_variable('KNOWLEDGE_FILE_PATH'))
-                  .kickoff(inputs=inputs))
+        # One paginated fetch of what earlier runs posted, keyed on the marker in each comment
+        existing_comments = {}
+        if inline or update_summary:
+            for comment in self.bitbucket_client.get_pull_request_comments(pull_request_id):
+                if comment.get('deleted'):
+                    continue
+                for key in COMMENT_MARKER_PATTERN.findall(comment['content']['raw']):
+                    existing_comments[key] = comment['id']
+
+        added_comments = 0
+        if inline:
+            new_issues = [issue for issue in review['issues'] if self.get_issue_key(issue) not in existing_comments]
+            self.log_info(f"{len(review['issues']) - len(new_issues)} issues are already commented on the pull request.")
 
-        self.log_info(f"Tokens Used: {output.token_usage}")
+            payloads = [
+                {
+                    'content': {'raw': self.generate_issue_comment(issue)},
+                    'inline': {'path': issue['file']['full_path'], 'to': issue['file']['new_line']},
+                }
+                for issue in new_issues
+            ]
+            # Issues that can't be anchored to a line are listed in the summary instead
+            unanchored_issues = []
+            for issue, result in zip(new_issues, self.bitbucket_client.add_comments(pull_request_id, payloads)):
+                if isinstance(result, Exception):
+                    self.log_warning(f"Could not comment on {issue['file']['full_path']}#{issue['file']['new_line']}: {result}")
+                    unanchored_issues.append(issue)
+                else:
+                    added_comments += 1
+
+            review = {**review, 'issues': unanchored_issues}
 
         # Toggle between formats if the suggest code flag is set
-        if self.get_variable('SUGGEST_CODE'):
-            comment = self.generate_issues_with_code_markdown_table(output.json_dict)
+        if inline and not review['issues']:
+            from snakemd import Document
+
+            comment = str(self.generate_summary_of_changes(Document(), review['summary_of_changes']))
+        elif self.get_variable('SUGGEST_CODE'):
+            comment = self.generate_issues_with_code_markdown_table(review)
         else:
-            comment = self.generate_all_issues_markdown_table(output.json_dict)
+            comment = self.generate_all_issues_markdown_table(review)
+        comment += "\n\n" + COMMENT_MARKER.format(SUMMARY_COMMENT_KEY)
 
-        added_suggestions = self.add_comment(pull_request_id, comment)
-        ui_pull_request_url = f"https://bitbucket.org/{self.workspace}/{self.repo_slug}/pull-requests/{pull_request_id}"
-        self.success(message=f"🤖 Successfully added {added_suggestions} comments to the pull request: {ui_pull_request_url} 🤖")
+        if update_summary and SUMMARY_COMMENT_KEY in existing_comments:
+            self.bitbucket_client.update_comment(
+                pull_request_id, existing_comments[SUMMARY_COMMENT_KEY], {'content': {'raw': comment}})
+            return added_comments + 1
+
+        return added_comments + self.add_comment(pull_request_id, comment)
+
+    def get_issue_key(self, issue):
+        """Fingerprint an issue by its file, title and code rather than its line, which moves as the pull request changes."""
+        fingerprint = '\0'.join([
+            issue['file']['full_path'],
+            issue['title'].strip().casefold(),
+            ' '.join(issue['code']['before'].split()),
+        ])
+        return 'issue-' + hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+    def generate_issue_comment(self, issue):
+        from snakemd import Document
+
+        doc = Document()
+        doc.add_heading(issue['title'], 4)
+        doc.add_paragraph(f"🚨 Severity: {int(issue['severity'])} ({issue['state']})")
+        doc.add_paragraph(issue['description'])
+        if self.get_variable('SUGGEST_CODE'):
+            doc.add_heading('Original', 5)
+            doc.add_code(issue['code']['before'])
+
+            doc.add_heading('Recommended Change', 5)
+            doc.add_code(issue['code']['after'])
+
+        doc.add_raw(COMMENT_MARKER.format(self.get_issue_key(issue)))
+        return str(doc)
 
     def generate_all_issues_markdown_table(self, output):
+        from snakemd import Document
+
         doc = Document()
         doc = self.generate_summary_of_changes(doc, output['summary_of_changes'])
         header = self.get_table_header()
@@ -195,6 +1198,8 @@ class CodeReviewPipe(Pipe):
         return str(doc)
 
     def generate_issues_with_code_markdown_table(self, output):
+        from snakemd import Document
+
         doc = Document()
         doc = self.generate_summary_of_changes(doc, output['summary_of_changes'])
         header = self.get_table_header()
@@ -215,7 +1220,7 @@ class CodeReviewPipe(Pipe):
 
         return str(doc)
 
-    def generate_summary_of_changes(self, doc: Document, summary):
+    def generate_summary_of_changes(self, doc: 'Document', summary):
         doc.add_heading("Summary of Changes", 3)
         doc.add_paragraph(summary)
         return doc
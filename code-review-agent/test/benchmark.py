@@ -0,0 +1,238 @@
+"""Offline end-to-end benchmark of the code review pipe.
+
+Runs CodeReviewPipe.run against a fake Bitbucket API and a stub OpenAI server for synthetic pull
+requests of different sizes, and reports how long each phase of the run took.
+
+    python test/benchmark.py --sizes small,large --llm-latency 0.5 --output benchmark.json
+    python test/benchmark.py --variable MAX_CONCURRENT_REVIEWS=1 --variable PARALLEL_AGENTS=false
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import threading
+
+from collections import defaultdict
+from unittest import mock
+
+PIPE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipe')
+sys.path.insert(0, PIPE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pipe  # noqa: E402
+from fakes import FakeBitbucketApi, StubOpenAIServer  # noqa: E402
+
+# Files changed and lines added per file
+SIZES = {
+    'small': (1, 10),
+    'medium': (10, 40),
+    'large': (40, 120),
+}
+HUNK_LINES = 20
+
+
+def synthetic_diff(files, lines_per_file):
+    """Build a diff of new Python code, split into hunks of HUNK_LINES added lines between context lines."""
+    diff = []
+    for file_number in range(files):
+        path = f"src/module_{file_number}/service_{file_number}.py"
+        diff.append(f"diff --git a/{path} b/{path}\nindex 1a2b3c4..5d6e7f8 100644\n--- a/{path}\n+++ b/{path}\n")
+        for start in range(0, lines_per_file, HUNK_LINES):
+            added = min(HUNK_LINES, lines_per_file - start)
+            old_start = start * 2 + 1
+            new_start = old_start + start
+            diff.append(f"@@ -{old_start},2 +{new_start},{added + 2} @@ class Service{file_number}:\n")
+            diff.append(f"     def handler_{start}(self, request):\n")
+            for line in range(added):
+                diff.append(f"+        value_{line} = self.repository.load(request.customer_id, limit={line})\n")
+            diff.append(f"         return self.render(request)\n")
+    return ''.join(diff)
+
+
+class PhaseTimer:
+    """Records when each call in a phase started and finished, patching the functions that make up the phase."""
+
+    def __init__(self):
+        self.intervals = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, phase, started_at, finished_at):
+        with self.lock:
+            self.intervals[phase].append((started_at, finished_at))
+
+    def time(self, owner, name, phase):
+        """Patch owner.name to record each call under the phase, where phase can be a function of the arguments."""
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(phase(*args, **kwargs) if callable(phase) else phase, started_at, time.perf_counter())
+
+        return mock.patch.object(owner, name, timed)
+
+    def summary(self):
+        """Returns the calls, summed time and wall clock time of each phase, where concurrent calls overlap."""
+        phases = {}
+        for phase, intervals in self.intervals.items():
+            wall_clock, covered_until = 0.0, float('-inf')
+            for started_at, finished_at in sorted(intervals):
+                wall_clock += max(0.0, finished_at - max(started_at, covered_until))
+                covered_until = max(covered_until, finished_at)
+            phases[phase] = {
+                'calls': len(intervals),
+                'total_seconds': sum(finished_at - started_at for started_at, finished_at in intervals),
+                'wall_seconds': wall_clock,
+            }
+        return phases
+
+
+def timed_phases(timer):
+    """The patches that time each phase of a run."""
+    from code_review.crew import CodeReview
+
+    review_pipe = pipe.CodeReviewPipe
+    log_task_timing = CodeReview.log_task_timing
+
+    # The crew times its own tasks, this only moves the durations it logs onto the benchmark's clock
+    def task_timing(self, task_name, concurrent, output):
+        duration = log_task_timing(self, task_name, concurrent, output)
+        finished_at = time.perf_counter()
+        timer.record(f"task {task_name}", finished_at - duration, finished_at)
+        return duration
+
+    return [
+        timer.time(pipe.BitbucketApiService, 'request',
+                   lambda client, method, url, **kwargs: 'fetch' if method == 'GET' else 'post'),
+        timer.time(pipe, 'count_file_tokens', 'token count'),
+        timer.time(review_pipe, 'chunk_diff', 'chunk'),
+        timer.time(review_pipe, 'review_chunk', 'crew kickoff'),
+        mock.patch.object(CodeReview, 'log_task_timing', task_timing),
+        timer.time(review_pipe, 'generate_all_issues_markdown_table', 'markdown render'),
+        timer.time(review_pipe, 'generate_issues_with_code_markdown_table', 'markdown render'),
+        timer.time(review_pipe, 'generate_issue_comment', 'markdown render'),
+        timer.time(review_pipe, 'run', 'total'),
+    ]
+
+
+def run_scenario(size, llm_latency=0.0, bitbucket_latency=0.0, incremental=False, variables=None):
+    """Run the pipe once for a synthetic pull request, returning the timings of each phase."""
+    diff = synthetic_diff(*SIZES[size])
+    timer = PhaseTimer()
+
+    with FakeBitbucketApi(diff, incremental=incremental, latency=bitbucket_latency) as bitbucket, \
+            StubOpenAIServer(latency=llm_latency) as llm, \
+            contextlib.ExitStack() as stack:
+        environment = {
+            'OPENAI_API_KEY': 'benchmark',
+            'OPENAI_API_BASE': f"{llm.url}/v1",
+            'OPENAI_BASE_URL': f"{llm.url}/v1",
+            'BITBUCKET_ACCESS_TOKEN': 'benchmark',
+            'MODEL': 'gpt-4o-mini',
+            'BITBUCKET_PR_ID': '1',
+            'BITBUCKET_WORKSPACE': 'workspace',
+            'BITBUCKET_REPO_SLUG': 'repository',
+            'OTEL_SDK_DISABLED': 'true',
+            'CREWAI_DISABLE_TELEMETRY': 'true',
+            **(variables or {}),
+        }
+        stack.enter_context(mock.patch.dict(os.environ, environment))
+        stack.enter_context(mock.patch.object(pipe.BitbucketApiService, 'BITBUCKET_API_BASE_URL', f"{bitbucket.url}/2.0"))
+        for patch in timed_phases(timer):
+            stack.enter_context(patch)
+
+        review_pipe = pipe.CodeReviewPipe(schema=pipe.schema, pipe_metadata={'name': 'Code Review Agent'})
+        try:
+            review_pipe.run()
+        except SystemExit as exit:
+            if exit.code:
+                raise RuntimeError(f"The pipe failed on the {size} pull request") from exit
+
+        return {
+            'size': size,
+            'diff_bytes': len(diff),
+            'phases': timer.summary(),
+            'llm_requests': len(llm.requests),
+            'llm_prompt_tokens': llm.prompt_tokens,
+            'llm_prompts': llm.prompts,
+            'llm_embedded_texts': llm.embedded_texts,
+            'bitbucket_requests': len(bitbucket.requests),
+            'comments': bitbucket.comments,
+        }
+
+
+def summarise(runs):
+    """Combine repeated runs of a size into the median and 95th percentile wall clock time of each phase."""
+    phases = defaultdict(list)
+    for run in runs:
+        for phase, timing in run['phases'].items():
+            phases[phase].append(timing['wall_seconds'])
+    for values in phases.values():
+        values.sort()
+
+    return {
+        'size': runs[0]['size'],
+        'runs': len(runs),
+        'diff_bytes': runs[0]['diff_bytes'],
+        'llm_requests': runs[0]['llm_requests'],
+        'llm_prompt_tokens': runs[0]['llm_prompt_tokens'],
+        'bitbucket_requests': runs[0]['bitbucket_requests'],
+        'phases': {
+            phase: {'p50_seconds': pipe.percentile(values, 50), 'p95_seconds': pipe.percentile(values, 95)}
+            for phase, values in phases.items()
+        },
+    }
+
+
+def print_table(results):
+    phases = sorted({phase for result in results for phase in result['phases']}, key=lambda phase: (phase == 'total', phase))
+    print(f"{'phase':<32}" + ''.join(f"{result['size']:>18}" for result in results))
+    for phase in phases:
+        cells = []
+        for result in results:
+            timing = result['phases'].get(phase)
+            cells.append(f"{timing['p50_seconds']:>9.3f}/{timing['p95_seconds']:<8.3f}" if timing else f"{'-':>18}")
+        print(f"{phase:<32}" + ''.join(cells))
+    print(f"{'(seconds, p50/p95 wall clock)':<32}")
+
+
+def parse_variable(value):
+    name, separator, variable = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"Expected NAME=VALUE, got {value}")
+    return name, variable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(SIZES), help='Comma separated pull request sizes to run')
+    parser.add_argument('--runs', type=int, default=3, help='Runs of each size')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='Seconds the stub LLM takes to answer')
+    parser.add_argument('--bitbucket-latency', type=float, default=0.02, help='Seconds the fake Bitbucket API takes to answer')
+    parser.add_argument('--incremental', action='store_true', help='Review the commits since a previous build')
+    parser.add_argument('--variable', type=parse_variable, action='append', default=[], help='Pipe variable as NAME=VALUE')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    arguments = parser.parse_args()
+
+    results = []
+    for size in arguments.sizes.split(','):
+        runs = [
+            run_scenario(size, arguments.llm_latency, arguments.bitbucket_latency, arguments.incremental,
+                         dict(arguments.variable))
+            for _ in range(arguments.runs)
+        ]
+        results.append(summarise(runs))
+
+    print_table(results)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump({'arguments': {**vars(arguments), 'variable': dict(arguments.variable)}, 'results': results},
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
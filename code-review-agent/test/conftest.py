@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipe'))
+
+import pipe  # noqa: E402
+
+
+@pytest.fixture
+def make_pipe(monkeypatch, tmp_path):
+    """Builds a CodeReviewPipe from the required variables plus the given ones, where lists use the toolkit's _COUNT form."""
+    def make(**variables):
+        environment = {
+            'OPENAI_API_KEY': 'test',
+            'BITBUCKET_ACCESS_TOKEN': 'test',
+            'MODEL': 'gpt-4o',
+            'BITBUCKET_WORKSPACE': 'workspace',
+            'BITBUCKET_REPO_SLUG': 'repository',
+            'BITBUCKET_PR_ID': '1',
+            'BITBUCKET_CLONE_DIR': str(tmp_path),
+        }
+        for name, value in variables.items():
+            if isinstance(value, list):
+                environment[f"{name}_COUNT"] = str(len(value))
+                environment.update({f"{name}_{index}": item for index, item in enumerate(value)})
+            else:
+                environment[name] = str(value).lower() if isinstance(value, bool) else str(value)
+
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        return pipe.CodeReviewPipe(schema=pipe.schema, pipe_metadata={'name': 'Code Review Agent'})
+
+    return make
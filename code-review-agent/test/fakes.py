@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import time
+import base64
+import struct
+import hashlib
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as fixture:
+        return json.load(fixture)
+
+
+class FakeServer:
+    """Serves a BaseHTTPRequestHandler on a free local port from a background thread."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.create_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, query, body):
+        """Returns the status and JSON or text body for a request."""
+        raise NotImplementedError
+
+    def create_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                with fake.lock:
+                    fake.requests.append((method, url.path))
+
+                time.sleep(fake.latency)
+                status, payload = fake.handle(method, url.path, parse_qs(url.query), body)
+                if isinstance(payload, str):
+                    content, content_type = payload.encode(), 'text/plain'
+                else:
+                    content, content_type = json.dumps(payload).encode(), 'application/json'
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+        return Handler
+
+
+class FakeBitbucketApi(FakeServer):
+    """The Bitbucket endpoints the pipe uses, serving the recorded fixtures and a diff set by the benchmark.
+
+    commit_diffs maps a commit hash or a newest..oldest range to its diff, falling back to diff.
+    """
+
+    COMMENTS_PAGE_SIZE = 100
+    COMMITS_PAGE_SIZE = 2
+
+    def __init__(self, diff='', incremental=False, latency=0.0, commits=None, commit_diffs=None):
+        super().__init__(latency=latency)
+        self.diff = diff
+        self.incremental = incremental
+        self.commits = load_fixture('commits.json')['values'] if commits is None else commits
+        self.commit_diffs = commit_diffs or {}
+        self.commit_pages = []
+        self.comments = []
+
+    def handle(self, method, path, query, body):
+        # Next links repeat the request's own path
+        next_url = f"{self.url}{path}"
+        path = re.sub(r'^/2\.0/repositories/[^/]+/[^/]+', '', path)
+
+        if method == 'GET' and path == '/pipelines':
+            pipelines = load_fixture('pipelines.json')
+            # Without a previous build the pipe reviews the whole pull request
+            if not self.incremental:
+                pipelines['values'] = pipelines['values'][:1]
+            return 200, pipelines
+        if method == 'GET' and re.fullmatch(r'/pullrequests/\d+', path):
+            return 200, load_fixture('pullrequest.json')
+        if method == 'GET' and re.fullmatch(r'/pullrequests/\d+/commits', path):
+            page = int(query.get('page', ['1'])[0])
+            with self.lock:
+                self.commit_pages.append(page)
+            start = (page - 1) * self.COMMITS_PAGE_SIZE
+            response = {'values': self.commits[start:start + self.COMMITS_PAGE_SIZE]}
+            if start + self.COMMITS_PAGE_SIZE < len(self.commits):
+                response['next'] = f"{next_url}?page={page + 1}"
+            return 200, response
+        if method == 'GET' and re.fullmatch(r'/pullrequests/\d+/diff', path):
+            return 200, self.diff
+        if method == 'GET' and path.startswith('/diff/'):
+            return 200, self.commit_diffs.get(path[len('/diff/'):], self.diff)
+
+        if re.fullmatch(r'/pullrequests/\d+/comments', path):
+            with self.lock:
+                if method == 'POST':
+                    comment = {'id': len(self.comments) + 1, 'deleted': False, **body}
+                    self.comments.append(comment)
+                    return 201, comment
+
+                page = int(query.get('page', ['1'])[0])
+                start = (page - 1) * self.COMMENTS_PAGE_SIZE
+                response = {'values': self.comments[start:start + self.COMMENTS_PAGE_SIZE]}
+                if start + self.COMMENTS_PAGE_SIZE < len(self.comments):
+                    response['next'] = f"{next_url}?pagelen=100&page={page + 1}"
+                return 200, response
+
+        match = re.fullmatch(r'/pullrequests/\d+/comments/(\d+)', path)
+        if method == 'PUT' and match:
+            with self.lock:
+                comment = self.comments[int(match.group(1)) - 1]
+                comment['content'] = body['content']
+                return 200, comment
+
+        return 404, {'error': {'message': f"No fake for {method} {path}"}}
+
+
+class StubOpenAIServer(FakeServer):
+    """An OpenAI compatible chat completions endpoint answering every prompt with the same review after a delay.
+
+    The answer is in the format crewai's agents parse, and it is valid Review JSON. When crewai asks for
+    structured output with response_format, as it does for the report task, only the JSON is returned.
+    Embeddings are a small vector made from the hash of each text, which is enough for the knowledge store.
+    """
+
+    EMBEDDING_DIMENSIONS = 8
+
+    def __init__(self, review=None, latency=0.0):
+        super().__init__(latency=latency)
+        self.review = review or load_fixture('review.json')
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.prompts = []
+        self.embedded_texts = []
+
+    def handle(self, method, path, query, body):
+        if method == 'POST' and path.endswith('/embeddings'):
+            return 200, self.embed(body)
+        if method != 'POST' or not path.endswith('/chat/completions'):
+            return 404, {'error': {'message': f"No stub for {method} {path}"}}
+
+        if body.get('response_format'):
+            # Structured output requests expect the JSON on its own
+            content = json.dumps(self.review)
+        else:
+            content = f"Thought: I now can give a great answer\nFinal Answer: {json.dumps(self.review)}"
+        # Roughly four characters a token, which is close enough to compare runs
+        prompt_tokens = sum(len(message.get('content') or '') for message in body['messages']) // 4
+        completion_tokens = len(content) // 4
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.prompts.append('\n'.join(message.get('content') or '' for message in body['messages']))
+
+        return 200, {
+            'id': f"chatcmpl-{len(self.requests)}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def embed(self, body):
+        texts = [body['input']] if isinstance(body['input'], str) else body['input']
+        with self.lock:
+            self.embedded_texts.extend(texts)
+
+        data = []
+        for index, text in enumerate(texts):
+            digest = hashlib.sha256(text.encode()).digest()
+            embedding = [byte / 255 for byte in digest[:self.EMBEDDING_DIMENSIONS]]
+            if body.get('encoding_format') == 'base64':
+                # The openai client asks for little endian float32s in base64 unless told otherwise
+                embedding = base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode()
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        return {
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', 'text-embedding-3-small'),
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+        }
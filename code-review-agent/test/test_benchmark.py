@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip('crewai')
+
+import benchmark  # noqa: E402
+
+
+def test_small_pull_request_is_reviewed_end_to_end():
+    result = benchmark.run_scenario('small')
+
+    assert {'fetch', 'token count', 'crew kickoff', 'markdown render', 'post', 'total'} <= set(result['phases'])
+    assert [phase for phase in result['phases'] if phase.startswith('task ')]
+    assert len(result['comments']) == 1
+    assert 'Validate the invoice amount before charging' in result['comments'][0]['content']['raw']
+
+
+def test_large_pull_request_is_reviewed_in_chunks():
+    result = benchmark.run_scenario('large', variables={'MAX_INPUT_TOKENS': '10000', 'MAX_REVIEW_CHUNKS': '8'})
+
+    assert result['phases']['crew kickoff']['calls'] > 1
+    assert result['phases']['chunk']['calls'] == 1
+
+
+def test_issues_are_posted_inline():
+    result = benchmark.run_scenario('small', variables={'COMMENT_MODE': 'inline'})
+
+    inline_comments = [comment for comment in result['comments'] if 'inline' in comment]
+    assert len(inline_comments) == 2
+
+
+def test_specialists_review_the_diff_in_parallel_and_triage_gets_all_their_findings():
+    result = benchmark.run_scenario('small', variables={'PARALLEL_AGENTS': 'true'})
+
+    specialist_prompts = [prompt for prompt in result['llm_prompts'] if 'Code To Review' in prompt]
+    assert len(specialist_prompts) == 3
+    assert all('value_0 = self.repository.load(request.customer_id' in prompt for prompt in specialist_prompts)
+
+    triage_prompt, = [prompt for prompt in result['llm_prompts'] if 'assign a severity rating' in prompt]
+    assert triage_prompt.count('Validate the invoice amount before charging') == 3
+    assert {'task developer_task', 'task tester_task', 'task cyber_task', 'task triage_task'} <= set(result['phases'])
+
+
+def test_specialists_run_one_after_another_only_send_the_diff_to_the_developer():
+    result = benchmark.run_scenario('small', variables={'PARALLEL_AGENTS': 'false'})
+
+    # The tester and cyber expert review the diff through the developer's output
+    specialist_prompts = [prompt for prompt in result['llm_prompts'] if 'Code To Review' in prompt]
+    assert len(specialist_prompts) == 1
+    assert 'Provide feedback on code quality' in specialist_prompts[0]
+
+
+def test_knowledge_is_only_embedded_again_when_it_changes(tmp_path):
+    knowledge_file = tmp_path / 'knowledge.md'
+    knowledge_file.write_text('Payments must be validated before they are charged.')
+    variables = {'KNOWLEDGE_FILE_PATH': str(knowledge_file), 'REVIEW_CACHE_DIR': str(tmp_path / 'cache'),
+                 'MAX_INPUT_TOKENS': '10000', 'MAX_REVIEW_CHUNKS': '8'}
+
+    first = benchmark.run_scenario('large', variables=variables)
+    second = benchmark.run_scenario('large', variables=variables)
+    knowledge_file.write_text('Refunds must be logged.')
+    changed = benchmark.run_scenario('large', variables=variables)
+
+    assert first['phases']['crew kickoff']['calls'] > 1
+    assert first['llm_embedded_texts'].count('Payments must be validated before they are charged.') == 1
+    assert 'Payments must be validated before they are charged.' not in second['llm_embedded_texts']
+    assert changed['llm_embedded_texts'].count('Refunds must be logged.') == 1
+
+
+@pytest.mark.parametrize('max_suggestions, reviewed_again', [('10', False), ('2', True)])
+def test_reviews_cut_at_max_suggestions_are_not_cached(tmp_path, max_suggestions, reviewed_again):
+    variables = {'REVIEW_CACHE_DIR': str(tmp_path / 'cache'), 'MAX_SUGGESTIONS': max_suggestions}
+
+    benchmark.run_scenario('small', variables=variables)
+    result = benchmark.run_scenario('small', variables=variables)
+
+    assert ('crew kickoff' in result['phases']) is reviewed_again
+    assert 'Validate the invoice amount before charging' in result['comments'][0]['content']['raw']
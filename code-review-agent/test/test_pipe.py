@@ -0,0 +1,430 @@
+import json
+import types
+import contextlib
+
+import pytest
+
+import pipe
+from fakes import FakeBitbucketApi, load_fixture
+
+
+def file_diff(path, added_lines=1):
+    added = ''.join(f"+line {line}\n" for line in range(added_lines))
+    return f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,1 +1,{added_lines + 1} @@\n context\n{added}"
+
+
+def removal_diff(path):
+    return f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,2 +1,1 @@\n context\n-removed\n"
+
+
+@pytest.mark.parametrize('path, pattern, matches', [
+    ('src/app.py', '*.py', True),
+    ('src/app.py', 'src/*.py', True),
+    ('src/views/app.py', 'src/*.py', False),
+    ('src/views/app.py', 'src/**/*.py', True),
+    ('src/app.py', 'src/**/*.py', True),
+    ('web/node_modules/react/index.js', '**/node_modules/', True),
+    ('node_modules/react/index.js', 'node_modules/', True),
+    ('web/node_modules/react/index.js', 'node_modules/', True),
+    ('node_modules', 'node_modules/', False),
+    ('docs/index.md', '/docs/*.md', True),
+    ('web/docs/index.md', '/docs/*.md', False),
+    ('src/v1.py', 'src/v?.py', True),
+    ('src/v/.py', 'src/v?.py', False),
+    ('src/v1.py', 'src/v[0-9].py', True),
+    ('src/v1.py', 'src/v[!0-9].py', False),
+    ('app.py', 'app.py', True),
+    ('app_py', 'app.py', False),
+])
+def test_path_matches(path, pattern, matches):
+    assert pipe.path_matches(path, pattern) is matches
+
+
+def test_read_generated_files(tmp_path):
+    gitattributes = tmp_path / '.gitattributes'
+    gitattributes.write_text(
+        '# Generated code\n'
+        '\n'
+        'api/generated/** linguist-generated\n'
+        'api/generated/handwritten.py -linguist-generated\n'
+        'third_party/ linguist-vendored=true text\n'
+        'docs/vendor/ linguist-vendored=false\n'
+        '*.png binary\n'
+    )
+
+    assert pipe.read_generated_files(str(gitattributes)) == [
+        ('api/generated/**', True),
+        ('api/generated/handwritten.py', False),
+        ('third_party/', True),
+        ('docs/vendor/', False),
+    ]
+    assert pipe.read_generated_files(str(tmp_path / 'missing')) == []
+
+
+class TestChooseModel:
+    @pytest.fixture
+    def routed_pipe(self, make_pipe):
+        return make_pipe(MODEL='gpt-4o', MODEL_ROUTING=True, FAST_MODEL='gpt-4o-mini',
+                         FAST_MODEL_MAX_TOKENS=100, FAST_MODEL_MAX_FILES=2)
+
+    def test_uses_the_model_without_routing(self, make_pipe):
+        review_pipe = make_pipe(MODEL='gpt-4o')
+
+        assert review_pipe.choose_model(file_diff('src/app.py'), 10) == ('gpt-4o', 'MODEL')
+
+    def test_small_changes_use_the_fast_model(self, routed_pipe):
+        model, _ = routed_pipe.choose_model(file_diff('src/app.py') + file_diff('src/views.py'), 100)
+
+        assert model == 'gpt-4o-mini'
+
+    def test_changes_over_the_token_threshold_use_the_model(self, routed_pipe):
+        assert routed_pipe.choose_model(file_diff('src/app.py'), 101) == ('gpt-4o', '101 tokens')
+
+    def test_changes_over_the_file_threshold_use_the_model(self, routed_pipe):
+        chunk = file_diff('src/app.py') + file_diff('src/views.py') + file_diff('src/models.py')
+
+        assert routed_pipe.choose_model(chunk, 10) == ('gpt-4o', '3 files')
+
+    def test_sensitive_files_use_the_model(self, routed_pipe):
+        chunk = file_diff('src/app.py') + file_diff('src/password_reset.py')
+
+        assert routed_pipe.choose_model(chunk, 10) == ('gpt-4o', 'sensitive file src/password_reset.py')
+
+    def test_sensitive_files_can_be_configured(self, make_pipe):
+        review_pipe = make_pipe(MODEL='gpt-4o', MODEL_ROUTING=True, SENSITIVE_FILES=['billing/*.py'])
+
+        assert review_pipe.choose_model(file_diff('billing/invoice.py'), 10)[0] == 'gpt-4o'
+        # The configured patterns replace the defaults
+        assert review_pipe.choose_model(file_diff('src/password_reset.py'), 10)[0] == 'gpt-4o-mini'
+
+
+class TestDiffFilter:
+    def test_drops_files_that_are_not_worth_reviewing(self):
+        diff_filter = pipe.DiffFilter(
+            include_files=['src/'],
+            exclude_files=['*.min.js'],
+            generated_files=[('src/generated/**', True), ('src/generated/keep.py', False)],
+            max_file_lines=3,
+        )
+        file_diffs = [
+            file_diff('src/app.py'),
+            file_diff('README.md'),
+            file_diff('src/bundle.min.js'),
+            file_diff('src/generated/client.py'),
+            file_diff('src/generated/keep.py'),
+            file_diff('src/big.py', added_lines=3),
+            removal_diff('src/old.py'),
+            'diff --git a/src/logo.png b/src/logo.png\nBinary files differ\n',
+        ]
+
+        kept = [pipe.get_diff_path(diff) for diff in diff_filter.filter(file_diffs)]
+
+        assert kept == ['src/app.py', 'src/generated/keep.py']
+        assert diff_filter.dropped_files == {
+            'not included': 1, 'excluded': 1, 'generated': 1, 'too large': 1, 'removals only': 1, 'no text changes': 1,
+        }
+
+    def test_drops_hunks_that_only_remove_lines(self):
+        diff_filter = pipe.DiffFilter()
+        removal_hunk = '@@ -10,2 +11,1 @@\n context\n-removed\n'
+
+        kept, = diff_filter.filter([file_diff('src/app.py') + removal_hunk])
+
+        assert removal_hunk not in kept
+        assert '+line 0\n' in kept
+        assert diff_filter.dropped_hunks == 1
+        assert diff_filter.tokens_saved() == len(removal_hunk) // pipe.CHARACTERS_PER_TOKEN
+
+    def test_filters_the_joined_diffs_of_several_commits(self):
+        first_commit = file_diff('src/app.py', added_lines=2) + file_diff('src/views.py')
+        # Bitbucket's diffs end in a newline, but a diff without one mustn't run into the next commit's
+        second_commit = file_diff('src/app.py').rstrip('\n')
+        diff_filter = pipe.DiffFilter()
+
+        file_diffs = list(diff_filter.filter(pipe.split_file_diffs(pipe.join_commit_diffs([first_commit, '', second_commit]))))
+
+        assert [pipe.get_diff_path(diff) for diff in file_diffs] == ['src/app.py', 'src/views.py', 'src/app.py']
+        assert not diff_filter.dropped_files and not diff_filter.dropped_hunks
+        for diff in file_diffs:
+            _, hunks = pipe.split_hunks(diff)
+            assert all(pipe.parse_hunk(hunk) is not None for hunk in hunks)
+
+
+class TestParseHunk:
+    def test_parses_the_header_and_body(self):
+        hunk = '@@ -10,3 +12,4 @@ def handler():\n context\n-removed\n+added\n+added again\n context\n'
+
+        assert pipe.parse_hunk(hunk) == (10, 12, 4, [' context', '-removed', '+added', '+added again', ' context'])
+
+    def test_counts_default_to_one(self):
+        assert pipe.parse_hunk('@@ -3 +3 @@\n-old\n\\ No newline at end of file\n+new\n') == (3, 3, 1, ['-old', '\\ No newline at end of file', '+new'])
+
+    def test_rejects_a_body_that_does_not_match_the_header(self):
+        assert pipe.parse_hunk('@@ -10,3 +12,4 @@\n context\n+added\n') is None
+        assert pipe.parse_hunk('+added\n') is None
+
+
+def issue(path, new_line, old_line=None, title='Validate the amount'):
+    return {
+        'title': title, 'severity': 5, 'description': '', 'state': 'NEEDS REVIEW',
+        'file': {'full_path': path, 'new_line': new_line, 'old_line': old_line},
+        'code': {'before': '', 'after': ''},
+    }
+
+
+def hunk_diff(path, old_start, new_start):
+    return (f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n"
+            f"@@ -{old_start},2 +{new_start},3 @@\n context\n+charge(amount)\n context\n")
+
+
+class TestReviewCache:
+    @pytest.fixture
+    def review_cache(self, tmp_path):
+        review_cache = pipe.ReviewCache(str(tmp_path / 'reviews.sqlite3'), 'version')
+        yield review_cache
+        review_cache.close()
+
+    def test_reports_the_issues_of_a_moved_hunk_at_its_new_lines(self, review_cache):
+        review_cache.store(hunk_diff('src/pay.py', 10, 10), [issue('src/pay.py', 11), issue('src/other.py', 11)], 'gpt-4o')
+
+        remaining = list(review_cache.lookup([hunk_diff('src/pay.py', 20, 25)], lambda path: ['gpt-4o']))
+
+        assert remaining == []
+        assert (review_cache.hits, review_cache.misses) == (1, 0)
+        assert [cached['file'] for cached in review_cache.cached_issues] == [
+            {'full_path': 'src/pay.py', 'new_line': 26, 'old_line': 0},
+        ]
+
+    def test_hunks_without_issues_are_cached_too(self, review_cache):
+        review_cache.store(hunk_diff('src/pay.py', 10, 10), [], 'gpt-4o')
+
+        assert list(review_cache.lookup([hunk_diff('src/pay.py', 10, 10)], lambda path: ['gpt-4o'])) == []
+        assert review_cache.hits == 1 and review_cache.cached_issues == []
+
+    def test_only_uses_the_reviews_of_the_given_models(self, review_cache):
+        review_cache.store(hunk_diff('src/pay.py', 10, 10), [issue('src/pay.py', 11)], 'gpt-4o-mini')
+
+        diff = hunk_diff('src/pay.py', 10, 10)
+        assert list(review_cache.lookup([diff], lambda path: ['gpt-4o'])) == [diff]
+        assert list(review_cache.lookup([diff], lambda path: ['gpt-4o', 'gpt-4o-mini'])) == []
+        assert (review_cache.hits, review_cache.misses) == (1, 1)
+
+    def test_evicts_the_least_recently_used_hunks(self, tmp_path):
+        review_cache = pipe.ReviewCache(str(tmp_path / 'reviews.sqlite3'), 'version', max_entries=1)
+        review_cache.store(hunk_diff('src/pay.py', 10, 10), [], 'gpt-4o')
+        review_cache.store(hunk_diff('src/refund.py', 10, 10), [], 'gpt-4o')
+
+        remaining = list(review_cache.lookup([hunk_diff('src/pay.py', 10, 10), hunk_diff('src/refund.py', 10, 10)],
+                                             lambda path: ['gpt-4o']))
+        review_cache.close()
+
+        assert [pipe.get_diff_path(diff) for diff in remaining] == ['src/pay.py']
+
+
+class TestCachedReviewModels:
+    def test_only_reviews_by_the_model_are_used_without_routing(self, make_pipe):
+        review_pipe = make_pipe(MODEL='gpt-4o', FAST_MODEL='gpt-4o-mini')
+
+        assert review_pipe.get_cached_review_models('src/app.py') == ['gpt-4o']
+
+    def test_reviews_by_the_fast_model_are_used_for_files_it_can_review(self, make_pipe):
+        review_pipe = make_pipe(MODEL='gpt-4o', MODEL_ROUTING=True, FAST_MODEL='gpt-4o-mini')
+
+        assert review_pipe.get_cached_review_models('src/app.py') == ['gpt-4o', 'gpt-4o-mini']
+        assert review_pipe.get_cached_review_models('src/password_reset.py') == ['gpt-4o']
+
+
+def count_lines(text):
+    """A stand in for count_tokens, counting each line as a token."""
+    return text.count('\n')
+
+
+class TestChunking:
+    def test_count_file_tokens_stops_once_over_the_limit(self, monkeypatch):
+        monkeypatch.setattr(pipe, 'count_tokens', count_lines)
+        file_diffs = [file_diff(f"src/module_{number}.py") for number in range(5)]
+
+        sized_diffs, uncounted_files = pipe.count_file_tokens(iter(file_diffs), 10)
+
+        assert sized_diffs == [(6, file_diffs[0]), (6, file_diffs[1])]
+        assert uncounted_files == 3
+
+    def test_pack_diff_chunks_fills_the_space_left_by_large_files(self):
+        chunks = pipe.pack_diff_chunks([(6, 'a'), (2, 'b'), (5, 'c'), (4, 'd')], 10)
+
+        assert chunks == [(10, 'ad'), (7, 'cb')]
+
+    def test_split_oversized_diff_keeps_whole_hunks_together(self):
+        header = 'diff --git a/src/app.py b/src/app.py\n--- a/src/app.py\n+++ b/src/app.py\n'
+        hunks = ['@@ -1,2 +1,3 @@\n a\n+b\n c\n', '@@ -10,2 +11,3 @@\n d\n+e\n f\n']
+
+        pieces = list(pipe.split_oversized_diff(header + ''.join(hunks), 7, count_lines))
+
+        assert pieces == [(7, header + hunks[0]), (7, header + hunks[1])]
+
+    def test_split_oversized_diff_gives_each_piece_of_a_long_hunk_its_own_header(self):
+        header = 'diff --git a/src/app.py b/src/app.py\n--- a/src/app.py\n+++ b/src/app.py\n'
+        hunk = '@@ -10,5 +10,6 @@ def handler():\n a\n-b\n+c\n+d\n e\n f\n g\n'
+
+        pieces = [piece for _, piece in pipe.split_oversized_diff(header + hunk, 7, count_lines)]
+
+        assert pieces == [
+            header + '@@ -10,2 +10,2 @@ def handler():\n a\n-b\n+c\n',
+            header + '@@ -12,2 +12,3 @@ def handler():\n+d\n e\n f\n',
+            header + '@@ -14,1 +15,1 @@ def handler():\n g\n',
+        ]
+        for piece in pieces:
+            assert pipe.parse_hunk(pipe.split_hunks(piece)[1][0]) is not None
+
+    def test_split_oversized_diff_splits_a_new_file(self):
+        header = 'diff --git a/src/app.py b/src/app.py\nnew file mode 100644\n--- /dev/null\n+++ b/src/app.py\n'
+        hunk = '@@ -0,0 +1,4 @@\n+a\n+b\n+c\n+d\n'
+
+        pieces = [piece[len(header):] for _, piece in pipe.split_oversized_diff(header + hunk, 7, count_lines)]
+
+        assert pieces == ['@@ -0,0 +1,2 @@\n+a\n+b\n', '@@ -0,0 +3,2 @@\n+c\n+d\n']
+
+    def test_merge_reviews_drops_duplicates_and_keeps_the_most_severe(self):
+        duplicate = {**issue('src/pay.py', 11, title='Validate the amount'), 'severity': 3}
+        reviews = [
+            {'summary_of_changes': 'Adds payments.', 'issues': [issue('src/pay.py', 11), issue('src/pay.py', 20, title='Log')]},
+            {'summary_of_changes': '', 'issues': [duplicate, {**issue('src/refund.py', 4, title='Refund'), 'severity': 9}]},
+        ]
+
+        review = pipe.merge_reviews(reviews, 2)
+
+        assert review['summary_of_changes'] == 'Adds payments.'
+        assert [(issue['title'], issue['severity']) for issue in review['issues']] == [('Refund', 9), ('Validate the amount', 5)]
+
+
+class TestPostReview:
+    @pytest.fixture
+    def bitbucket(self, monkeypatch):
+        with FakeBitbucketApi() as bitbucket:
+            monkeypatch.setattr(pipe.BitbucketApiService, 'BITBUCKET_API_BASE_URL', f"{bitbucket.url}/2.0")
+            yield bitbucket
+
+    def test_a_second_run_does_not_comment_on_the_same_issues_again(self, make_pipe, bitbucket):
+        review_pipe = make_pipe(COMMENT_MODE='inline')
+        review = load_fixture('review.json')
+
+        assert review_pipe.post_review('1', review) == 2 + 1
+        # The issues moved down a line, as they would after another commit
+        for moved_issue in review['issues']:
+            moved_issue['file']['new_line'] += 1
+        assert review_pipe.post_review('1', review) == 1
+
+        inline_comments = [comment for comment in bitbucket.comments if 'inline' in comment]
+        assert [comment['inline'] for comment in inline_comments] == [
+            {'path': 'src/module_0/service_0.py', 'to': 2},
+            {'path': 'src/module_0/service_0.py', 'to': 4},
+        ]
+        # Without UPDATE_SUMMARY_COMMENT each run adds its own summary
+        assert len(bitbucket.comments) == 4
+
+    def test_the_summary_comment_is_updated_rather_than_added_again(self, make_pipe, bitbucket):
+        review_pipe = make_pipe(UPDATE_SUMMARY_COMMENT=True)
+        review = load_fixture('review.json')
+
+        review_pipe.post_review('1', review)
+        review['summary_of_changes'] = 'Adds a refund handler too.'
+        review_pipe.post_review('1', review)
+
+        summary, = bitbucket.comments
+        assert 'Adds a refund handler too.' in summary['content']['raw']
+        assert pipe.COMMENT_MARKER.format(pipe.SUMMARY_COMMENT_KEY) in summary['content']['raw']
+        assert [method for method, _ in bitbucket.requests].count('PUT') == 1
+
+
+class TestGetDiffToReview:
+    # The fixtures' last build was of a1a1a1a1a1a1, and the current one is of c3c3c3c3c3c3
+    @pytest.fixture
+    def make_bitbucket(self, monkeypatch):
+        with contextlib.ExitStack() as stack:
+            def make(**kwargs):
+                bitbucket = stack.enter_context(FakeBitbucketApi(**kwargs))
+                monkeypatch.setattr(pipe.BitbucketApiService, 'BITBUCKET_API_BASE_URL', f"{bitbucket.url}/2.0")
+                return bitbucket
+
+            yield make
+
+    @staticmethod
+    def diff_paths(bitbucket):
+        return [path.split('/diff/')[1] for _, path in bitbucket.requests if '/diff/' in path]
+
+    def test_reviews_the_whole_pull_request_on_its_first_build(self, make_pipe, make_bitbucket):
+        bitbucket = make_bitbucket(diff=file_diff('src/app.py'))
+
+        assert make_pipe().get_diff_to_review('1') == file_diff('src/app.py')
+        assert any(path.endswith('/pullrequests/1/diff') for _, path in bitbucket.requests)
+        assert not bitbucket.commit_pages
+
+    def test_reviews_one_range_diff_of_the_commits_since_the_last_build(self, make_pipe, make_bitbucket):
+        bitbucket = make_bitbucket(incremental=True, commit_diffs={'c3c3c3c3c3c3..a1a1a1a1a1a1': file_diff('src/app.py')})
+
+        assert make_pipe().get_diff_to_review('1') == file_diff('src/app.py')
+        assert self.diff_paths(bitbucket) == ['c3c3c3c3c3c3..a1a1a1a1a1a1']
+
+    def test_merge_commits_fall_back_to_the_diffs_of_each_commit(self, make_pipe, make_bitbucket):
+        commits = [
+            {'hash': 'e5e5e5e5e5e5', 'parents': [{'hash': 'd4d4d4d4d4d4'}]},
+            {'hash': 'd4d4d4d4d4d4', 'parents': [{'hash': 'b2b2b2b2b2b2'}, {'hash': 'f0f0f0f0f0f0'}]},
+            {'hash': 'b2b2b2b2b2b2', 'parents': [{'hash': 'a1a1a1a1a1a1'}]},
+            {'hash': 'a1a1a1a1a1a1', 'parents': [{'hash': 'd0d0d0d0d0d0'}]},
+        ]
+        bitbucket = make_bitbucket(incremental=True, commits=commits, commit_diffs={
+            'b2b2b2b2b2b2': file_diff('src/app.py'),
+            'e5e5e5e5e5e5': file_diff('src/views.py'),
+        })
+
+        # Oldest first, without the merge commit, which only brings in changes reviewed elsewhere
+        assert make_pipe().get_diff_to_review('1') == file_diff('src/app.py') + file_diff('src/views.py')
+        assert sorted(self.diff_paths(bitbucket)) == ['b2b2b2b2b2b2', 'e5e5e5e5e5e5']
+
+    def test_commits_are_only_paged_through_until_the_last_build(self, make_pipe, make_bitbucket):
+        older_commits = [{'hash': f"{index}" * 12, 'parents': [{'hash': 'd0d0d0d0d0d0'}]} for index in range(4)]
+        bitbucket = make_bitbucket(incremental=True, commits=load_fixture('commits.json')['values'] + older_commits)
+
+        make_pipe().get_diff_to_review('1')
+
+        # Two commits a page, so the last build's commit is on the second of four pages
+        assert bitbucket.commit_pages == [1, 2]
+
+    def test_comments_are_read_across_pages(self, make_pipe, make_bitbucket):
+        bitbucket = make_bitbucket()
+        bitbucket.comments = [{'id': index, 'deleted': False, 'content': {'raw': str(index)}} for index in range(1, 151)]
+
+        comments = list(make_pipe().bitbucket_client.get_pull_request_comments('1'))
+
+        assert [comment['id'] for comment in comments] == list(range(1, 151))
+
+    def test_a_last_build_missing_from_the_commits_reviews_each_commit(self, make_pipe, make_bitbucket):
+        # As after a force push that removed the commit the last build ran on
+        commits = [{'hash': 'c3c3c3c3c3c3', 'parents': [{'hash': 'b2b2b2b2b2b2'}]}]
+        bitbucket = make_bitbucket(incremental=True, commits=commits, commit_diffs={'c3c3c3c3c3c3': file_diff('src/app.py')})
+
+        assert make_pipe().get_diff_to_review('1') == file_diff('src/app.py')
+        assert self.diff_paths(bitbucket) == ['c3c3c3c3c3c3']
+
+
+class TestReviewTelemetry:
+    def test_adds_up_the_token_spend_of_each_model(self, tmp_path):
+        telemetry = pipe.ReviewTelemetry()
+        usage = types.SimpleNamespace(successful_requests=5, prompt_tokens=1_000_000, cached_prompt_tokens=200, completion_tokens=100_000)
+        telemetry.add_token_usage('gpt-4o-mini', usage)
+        telemetry.add_token_usage('gpt-4o-mini', usage)
+        with telemetry.span('bitbucket GET /pullrequests/{id}', status=200):
+            pass
+
+        summary = telemetry.summary()
+
+        assert summary['tokens']['gpt-4o-mini'] == {
+            'requests': 10, 'promptTokens': 2_000_000, 'cachedPromptTokens': 400, 'completionTokens': 200_000,
+            'estimatedCostUsd': 0.42,
+        }
+        assert telemetry.format_summary(summary)[-1].startswith('gpt-4o-mini: 10 requests')
+
+        telemetry.write_otlp(tmp_path / 'traces.jsonl')
+        span, = json.loads((tmp_path / 'traces.jsonl').read_text())['resourceSpans'][0]['scopeSpans'][0]['spans']
+        # Bitbucket API calls are exported as client spans
+        assert span['kind'] == 3
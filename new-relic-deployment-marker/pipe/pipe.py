@@ -1,13 +1,27 @@
 import os
+import json
+import time
+import random
+import hashlib
+import threading
+import contextlib
 import requests
-from typing import Dict, List, Any, Type
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Any, Optional, Type
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
 from cerberus import Validator
 from bitbucket_pipes_toolkit import Pipe, get_logger
 import yaml
 
 logger = get_logger()
 
+def to_bool(value: Any) -> bool:
+    return value if isinstance(value, bool) else str(value).lower() == 'true'
+
 v2_schema = {
     'NEW_RELIC_API_KEY': {'type': 'string', 'required': True},
     'APPLICATION_NAME': {'type': 'string', 'required': True},
@@ -16,6 +30,15 @@ v2_schema = {
     'SHORT_REGION': {'type': 'string', 'required': True},
     'DEPLOYMENT_USER': {'type': 'string', 'required': False, 'default': 'bitbucket.pipeline'},
     'DEPLOYMENT_REVISION': {'type': 'string', 'required': True},
+    'MAX_WORKERS': {'type': 'integer', 'coerce': int, 'required': False, 'default': 8},
+    'REQUEST_TIMEOUT': {'type': 'float', 'coerce': float, 'required': False, 'default': 10.0},
+    'MAX_RETRIES': {'type': 'integer', 'coerce': int, 'required': False, 'default': 3},
+    'RATE_LIMIT': {'type': 'float', 'coerce': float, 'required': False, 'default': 10.0},
+    'APPLICATION_CACHE_DIR': {'type': 'string', 'required': False, 'nullable': True, 'default': None},
+    'APPLICATION_CACHE_TTL': {'type': 'integer', 'coerce': int, 'required': False, 'default': 86400},
+    'APPLICATION_CACHE_INVALIDATE': {'type': 'boolean', 'coerce': to_bool, 'required': False, 'default': False},
+    'TELEMETRY_FILE': {'type': 'string', 'required': False, 'nullable': True, 'default': None},
+    'OTLP_TRACES_FILE': {'type': 'string', 'required': False, 'nullable': True, 'default': None},
 }
 
 v1_schema = {
@@ -23,8 +46,38 @@ v1_schema = {
     'NEW_RELIC_APPLICATION_ID': {'type': 'string', 'required': True},
     'DEPLOYMENT_REVISION': {'type': 'string', 'required': True},
     'DEPLOYMENT_USER': {'type': 'string', 'required': False, 'default': 'bitbucket.pipeline'},
+    'MAX_WORKERS': {'type': 'integer', 'coerce': int, 'required': False, 'default': 8},
+    'REQUEST_TIMEOUT': {'type': 'float', 'coerce': float, 'required': False, 'default': 10.0},
+    'MAX_RETRIES': {'type': 'integer', 'coerce': int, 'required': False, 'default': 3},
+    'RATE_LIMIT': {'type': 'float', 'coerce': float, 'required': False, 'default': 10.0},
+    'TELEMETRY_FILE': {'type': 'string', 'required': False, 'nullable': True, 'default': None},
+    'OTLP_TRACES_FILE': {'type': 'string', 'required': False, 'nullable': True, 'default': None},
+}
+
+nerdgraph_schema = {
+    **v2_schema,
+    'DEPLOYMENT_API': {'type': 'string', 'required': True, 'allowed': ['nerdgraph']},
+    'NERDGRAPH_BATCH_SIZE': {'type': 'integer', 'coerce': int, 'required': False, 'default': 50},
 }
 
+ENTITY_SEARCH_QUERY = """
+query($query: String!, $cursor: String) {
+  actor {
+    entitySearch(query: $query) {
+      results(cursor: $cursor) {
+        nextCursor
+        entities { guid name }
+      }
+    }
+  }
+}
+"""
+
+class DeploymentMarkerError(requests.RequestException):
+    def __init__(self, errors: Dict[str, Exception]) -> None:
+        self.errors = errors
+        super().__init__(f"Failed to create deployment markers for Application IDs: {', '.join(map(str, errors))}")
+
 class Config:
     def __init__(self, schema: Dict[str, Any]) -> None:
         self.validator = Validator(schema)
@@ -42,12 +95,275 @@ class Config:
     def get_app_name_pattern(self) -> str:
         return f'%{self.get("APPLICATION_NAME")}%{self.get("ENVIRONMENT")}%{self.get("SHORT_REGION")}%{self.get("COMPONENT_TYPE")}'
 
+class ApplicationCache:
+    """On-disk cache of application searches, keyed by the application name pattern."""
+    def __init__(self, directory: str, ttl: int) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, app_name_pattern: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(app_name_pattern.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, app_name_pattern: str) -> Optional[List[Dict[str, Any]]]:
+        try:
+            with open(self.path(app_name_pattern), 'r') as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry['created'] > self.ttl:
+            return None
+        return entry['applications']
+
+    def set(self, app_name_pattern: str, applications: List[Dict[str, Any]]) -> None:
+        path = self.path(app_name_pattern)
+        with open(f'{path}.tmp', 'w') as cache_file:
+            json.dump({'created': time.time(), 'pattern': app_name_pattern, 'applications': applications}, cache_file)
+        os.replace(f'{path}.tmp', path)
+
+    def invalidate(self, app_name_pattern: str) -> None:
+        try:
+            os.remove(self.path(app_name_pattern))
+        except FileNotFoundError:
+            pass
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter applying a default timeout to every request sent through it."""
+    def __init__(self, timeout: float, *args: Any, **kwargs: Any) -> None:
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+class RateLimiter:
+    """Token bucket shared by every thread making requests through a client."""
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+# percentile and Telemetry are copied into each pipe's image, .github/scripts/check_telemetry.py checks the copies match
+def percentile(values: List[float], percent: int) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = -(-percent * len(values) // 100)
+    return values[max(rank, 1) - 1]
+
+class Telemetry:
+    """Times the New Relic API requests and steps of a run as spans, summarised as latency percentiles per span name."""
+
+    def __init__(self, service_name: str, client_span_prefix: str) -> None:
+        self.service_name = service_name
+        # Spans named with this prefix are calls to another service, exported as SPAN_KIND_CLIENT
+        self.client_span_prefix = client_span_prefix
+        self.trace_id = os.urandom(16).hex()
+        self.started = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def record(self, name: str, started: float, seconds: float, attributes: Optional[Dict[str, Any]] = None,
+               error: Optional[Exception] = None) -> None:
+        with self.lock:
+            self.spans.append({'name': name, 'span_id': os.urandom(8).hex(), 'started': started, 'seconds': seconds,
+                               'attributes': attributes or {}, 'error': str(error) if error else None})
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """Time the block, yielding the span's attributes so the block can add to them."""
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, started, time.perf_counter() - start, attributes, error)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        by_name: Dict[str, List[Dict[str, Any]]] = {}
+        for span in self.spans:
+            by_name.setdefault(span['name'], []).append(span)
+
+        spans = {}
+        for name, recorded in sorted(by_name.items()):
+            seconds = sorted(span['seconds'] for span in recorded)
+            spans[name] = {
+                'count': len(seconds),
+                'errors': sum(1 for span in recorded if span['error']),
+                'totalSeconds': round(sum(seconds), 6),
+                'p50Seconds': round(percentile(seconds, 50), 6),
+                'p95Seconds': round(percentile(seconds, 95), 6),
+                'p99Seconds': round(percentile(seconds, 99), 6),
+                'maxSeconds': round(seconds[-1], 6),
+            }
+
+        return {
+            'service': self.service_name,
+            'started': self.started,
+            'durationSeconds': round(time.time() - self.started, 6),
+            'spans': spans,
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def format_summary(self, summary: Dict[str, Any]) -> List[str]:
+        """The summary as the lines of a table, followed by the counters."""
+        width = max(len(name) for name in ['span', *summary['spans']]) + 2
+        lines = [f"{'span':<{width}}{'count':>7}{'errors':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}{'total (s)':>11}"]
+        for name, span in summary['spans'].items():
+            lines.append(
+                f"{name:<{width}}{span['count']:>7}{span['errors']:>8}{span['p50Seconds']:>10.3f}{span['p95Seconds']:>10.3f}"
+                f"{span['p99Seconds']:>10.3f}{span['maxSeconds']:>10.3f}{span['totalSeconds']:>11.3f}")
+        if summary['counters']:
+            lines.append('Counters: ' + ', '.join(f"{name}={value}" for name, value in summary['counters'].items()))
+        return lines
+
+    def write_json(self, path: str, summary: Dict[str, Any]) -> None:
+        with open(path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+
+    def write_otlp(self, path: str) -> None:
+        """Append the spans as one OTLP/JSON ExportTraceServiceRequest line, as read by the collector's otlpjsonfile receiver."""
+        def attribute(key: str, value: Any) -> Dict[str, Any]:
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = []
+        for span in self.spans:
+            start_nanos = int(span['started'] * 1e9)
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': span['span_id'],
+                'name': span['name'],
+                # SPAN_KIND_CLIENT = 3, SPAN_KIND_INTERNAL = 1
+                'kind': 3 if span['name'].startswith(self.client_span_prefix) else 1,
+                'startTimeUnixNano': str(start_nanos),
+                'endTimeUnixNano': str(start_nanos + int(span['seconds'] * 1e9)),
+                'attributes': [attribute(key, value) for key, value in span['attributes'].items()],
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {},
+            })
+
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', self.service_name)]},
+            'scopeSpans': [{'scope': {'name': self.service_name}, 'spans': spans}],
+        }]}
+        with open(path, 'a') as traces_file:
+            traces_file.write(json.dumps(request, separators=(',', ':')) + '\n')
+
+def is_connect_error(error: Exception) -> bool:
+    """Whether a request failed before a connection was made, so the server never saw it."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps the urllib3 error, where a failed connection (NewConnectionError) is a ConnectTimeoutError
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
 class NewRelicClient:
-    def __init__(self, api_key: str) -> None:
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    # Statuses where the server turned the request away without acting on it, so a POST can be sent again
+    NON_IDEMPOTENT_RETRY_STATUS_CODES = {429, 503}
+
+    def __init__(self, api_key: str, pool_size: int = 10, application_cache: Optional[ApplicationCache] = None,
+                 timeout: float = 10.0, max_retries: int = 3, rate_limit: float = 10.0,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0, telemetry: Optional[Telemetry] = None) -> None:
         self.api_key = api_key
         self.base_url = 'https://api.newrelic.com/v2/'
+        self.nerdgraph_url = 'https://api.newrelic.com/graphql'
+        self.application_cache = application_cache
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.retries = Counter()
+        self.retries_lock = threading.Lock()
+        self.telemetry = telemetry or Telemetry('new-relic-deployment-marker', 'http ')
+        # A shared session keeps connections alive between calls, sized for concurrent marker creation
+        self.session = requests.Session()
+        self.session.mount('https://', TimeoutHTTPAdapter(timeout, pool_connections=1, pool_maxsize=pool_size))
 
-    def search_applications(self, app_name_pattern: str) -> List[Dict[str, Any]]:
+    def get_backoff(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Honour Retry-After when the response has one, otherwise use exponential backoff with full jitter."""
+        if response is not None and response.headers.get('Retry-After'):
+            retry_after = response.headers['Retry-After']
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), self.backoff_max)
+                except (TypeError, ValueError):
+                    pass
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method: str, endpoint: str, url: str, idempotent: Optional[bool] = None,
+                **kwargs: Any) -> requests.Response:
+        """Send a request through the rate limiter, retrying throttled, failed and timed out requests.
+
+        Requests that aren't idempotent, by default anything but a GET, are only retried when they can't have been
+        applied: when they were throttled, the service was unavailable or no connection was made.
+        The request is timed as one span including its retries and backoff, so the span shows what the run waited for.
+        """
+        if idempotent is None:
+            idempotent = method == 'get'
+        retry_status_codes = self.RETRY_STATUS_CODES if idempotent else self.NON_IDEMPOTENT_RETRY_STATUS_CODES
+
+        with self.telemetry.span(f'http {endpoint}', method=method.upper()) as attributes:
+            attempt = 0
+            while True:
+                attributes['retries'] = attempt
+                self.rate_limiter.acquire()
+                try:
+                    response = getattr(self.session, method)(url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    # A POST that was sent may have been applied, even when the response never came back
+                    if not (idempotent or is_connect_error(e)) or attempt >= self.max_retries:
+                        raise
+                    delay = self.get_backoff(attempt)
+                    reason = str(e)
+                else:
+                    attributes['status'] = response.status_code
+                    if response.status_code not in retry_status_codes or attempt >= self.max_retries:
+                        return response
+                    delay = self.get_backoff(attempt, response)
+                    reason = f"HTTP {response.status_code}"
+
+                with self.retries_lock:
+                    self.retries[endpoint] += 1
+                attempt += 1
+                logger.warning(f"Retrying {endpoint} request in {delay:.2f}s (attempt {attempt} of {self.max_retries}): {reason}")
+                time.sleep(delay)
+
+    def iter_applications(self, app_name_pattern: str) -> Iterator[Dict[str, Any]]:
+        """Yield matching applications, requesting the next page from the Link header only when it is needed."""
         headers = {
             'X-Api-Key': self.api_key,
             'Content-Type': 'application/json'
@@ -56,9 +372,97 @@ class NewRelicClient:
         params = {
             'filter[name]': app_name_pattern
         }
-        response = requests.get(url, headers=headers, params=params)
+        while url:
+            response = self.request('get', 'applications', url, headers=headers, params=params)
+            response.raise_for_status()
+            yield from response.json()['applications']
+
+            # The next link already carries the query string
+            url = response.links.get('next', {}).get('url')
+            params = None
+
+    def search_applications(self, app_name_pattern: str) -> List[Dict[str, Any]]:
+        if self.application_cache is not None:
+            applications = self.application_cache.get(app_name_pattern)
+            if applications is not None:
+                logger.info(f"Using cached applications for pattern: {app_name_pattern}")
+                return applications
+
+        applications = list(self.iter_applications(app_name_pattern))
+
+        # An application that hasn't reported to New Relic yet matches nothing, so an empty search isn't cached
+        if self.application_cache is not None and applications:
+            self.application_cache.set(app_name_pattern, applications)
+        return applications
+
+    def graphql(self, query: str, variables: Dict[str, Any], idempotent: bool = False) -> Dict[str, Any]:
+        """Send a NerdGraph query, where only queries without a mutation should be marked idempotent."""
+        headers = {
+            'API-Key': self.api_key,
+            'Content-Type': 'application/json'
+        }
+        response = self.request('post', 'graphql', self.nerdgraph_url, idempotent=idempotent, headers=headers,
+                                json={'query': query, 'variables': variables})
         response.raise_for_status()
-        return response.json()['applications']
+        return response.json()
+
+    def search_entities(self, app_name_pattern: str) -> List[Dict[str, Any]]:
+        """Find the APM application entities matching the pattern with a single entity search."""
+        cache_key = f'entities:{app_name_pattern}'
+        if self.application_cache is not None:
+            entities = self.application_cache.get(cache_key)
+            if entities is not None:
+                logger.info(f"Using cached entities for pattern: {app_name_pattern}")
+                return entities
+
+        escaped_pattern = app_name_pattern.replace("\\", "\\\\").replace("'", "\\'")
+        variables = {'query': f"domain = 'APM' AND type = 'APPLICATION' AND name LIKE '{escaped_pattern}'", 'cursor': None}
+        entities = []
+        while True:
+            result = self.graphql(ENTITY_SEARCH_QUERY, variables, idempotent=True)
+            if result.get('errors'):
+                raise requests.RequestException(f"Entity search failed: {result['errors']}")
+
+            results = result['data']['actor']['entitySearch']['results']
+            entities.extend(results['entities'])
+            if not results.get('nextCursor'):
+                break
+            variables['cursor'] = results['nextCursor']
+
+        if self.application_cache is not None and entities:
+            self.application_cache.set(cache_key, entities)
+        return entities
+
+    def create_change_tracking_markers(self, entity_guids: List[str], user: str, revision: str, description: str) -> Dict[str, Exception]:
+        """Create change tracking markers for every entity in one aliased mutation, returning the errors per entity."""
+        definitions = ', '.join(f'$deployment{index}: ChangeTrackingDeploymentInput!' for index in range(len(entity_guids)))
+        mutations = '\n'.join(
+            f'  marker{index}: changeTrackingCreateDeployment(deployment: $deployment{index}) {{ deploymentId entityGuid }}'
+            for index in range(len(entity_guids))
+        )
+        query = f'mutation({definitions}) {{\n{mutations}\n}}'
+        variables = {
+            f'deployment{index}': {'entityGuid': guid, 'version': revision, 'user': user, 'description': description}
+            for index, guid in enumerate(entity_guids)
+        }
+
+        result = self.graphql(query, variables)
+
+        errors = {}
+        for error in result.get('errors') or []:
+            path = error.get('path') or []
+            alias = path[0] if path else None
+            if alias and alias.startswith('marker'):
+                errors[entity_guids[int(alias[len('marker'):])]] = requests.RequestException(error.get('message'))
+            else:
+                # Errors without a path (such as validation errors) fail the whole mutation
+                return {guid: requests.RequestException(error.get('message')) for guid in entity_guids}
+
+        data = result.get('data') or {}
+        for index, guid in enumerate(entity_guids):
+            if guid not in errors and not data.get(f'marker{index}'):
+                errors[guid] = requests.RequestException('No deployment was returned')
+        return errors
 
     def create_deployment_marker(self, app_id: str, user: str, revision: str, description: str) -> None:
         url = f'{self.base_url}applications/{app_id}/deployments.json'
@@ -73,18 +477,37 @@ class NewRelicClient:
                 'user': user
             }
         }
-        response = requests.post(url, headers=headers, json=payload)
+        response = self.request('post', 'deployments', url, headers=headers, json=payload)
         response.raise_for_status()
 
 class DeploymentRunner(ABC):
-    def __init__(self, client: NewRelicClient, config: Config) -> None:
+    def __init__(self, client: NewRelicClient, config: Config, max_workers: int = 1) -> None:
         self.client = client
         self.config = config
+        self.max_workers = max_workers
 
     @abstractmethod
     def run(self) -> None:
         pass
 
+    def create_deployment_markers(self, app_ids: List[str], user: str, revision: str, description: str) -> None:
+        """Create a marker for every application on a bounded worker pool, raising once with every failure."""
+        def create(app_id: str) -> Optional[Exception]:
+            try:
+                self.client.create_deployment_marker(app_id, user, revision, description)
+                logger.info(f"Deployment marker created for Application ID {app_id}")
+                return None
+            except requests.RequestException as e:
+                logger.error(f"Error creating deployment marker for Application ID {app_id}: {str(e)}")
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(app_ids)))) as executor:
+            results = list(executor.map(create, app_ids))
+
+        errors = {app_id: error for app_id, error in zip(app_ids, results) if error is not None}
+        if errors:
+            raise DeploymentMarkerError(errors)
+
 class V1Deployment(DeploymentRunner):
     def run(self) -> None:
         logger.info("Starting New Relic Deployment with v1 schema")
@@ -94,13 +517,7 @@ class V1Deployment(DeploymentRunner):
         revision = self.config.get('DEPLOYMENT_REVISION')
         description = "Deployed new version with v1 schema"
 
-        for app_id in app_ids:
-            try:
-                self.client.create_deployment_marker(app_id, user, revision, description)
-                logger.info(f"Deployment marker created for Application ID {app_id} with v1 schema")
-            except requests.RequestException as e:
-                logger.error(f"Error creating deployment marker for Application ID {app_id}: {str(e)}")
-                raise
+        self.create_deployment_markers(app_ids, user, revision, description)
 
 class V2Deployment(DeploymentRunner):
     def run(self) -> None:
@@ -109,34 +526,109 @@ class V2Deployment(DeploymentRunner):
         logger.info(f"Searching applications with pattern: {app_name_pattern}")
 
         try:
-            applications = self.client.search_applications(app_name_pattern)
+            with self.client.telemetry.span('search applications'):
+                applications = self.client.search_applications(app_name_pattern)
         except requests.RequestException as e:
             logger.error(f"Error searching applications: {str(e)}")
             raise
 
         for app in applications:
-            app_id = app['id']
-            app_name = app['name']
-            logger.info(f"Application ID: {app_id}, Name: {app_name}")
+            logger.info(f"Application ID: {app['id']}, Name: {app['name']}")
+
+        deployment_description = "Deployed new version"
+        try:
+            self.create_deployment_markers(
+                [app['id'] for app in applications], self.config.get('DEPLOYMENT_USER'), self.config.get('DEPLOYMENT_REVISION'), deployment_description)
+        except DeploymentMarkerError:
+            # A cached application may have been deleted or renamed since it was cached
+            if self.client.application_cache is not None:
+                self.client.application_cache.invalidate(app_name_pattern)
+            raise
+
+class NerdGraphDeployment(DeploymentRunner):
+    def run(self) -> None:
+        logger.info("Starting New Relic Deployment with NerdGraph change tracking")
+        app_name_pattern = self.config.get_app_name_pattern()
+        logger.info(f"Searching entities with pattern: {app_name_pattern}")
+
+        try:
+            with self.client.telemetry.span('search entities'):
+                entities = self.client.search_entities(app_name_pattern)
+        except requests.RequestException as e:
+            logger.error(f"Error searching entities: {str(e)}")
+            raise
 
+        for entity in entities:
+            logger.info(f"Entity GUID: {entity['guid']}, Name: {entity['name']}")
+
+        entity_guids = [entity['guid'] for entity in entities]
+        batch_size = self.config.get('NERDGRAPH_BATCH_SIZE')
+        errors = {}
+        for start in range(0, len(entity_guids), batch_size):
+            batch = entity_guids[start:start + batch_size]
             try:
-                deployment_description = "Deployed new version"
-                self.client.create_deployment_marker(
-                    app_id, self.config.get('DEPLOYMENT_USER'), self.config.get('DEPLOYMENT_REVISION'), deployment_description)
-                logger.info(f"Deployment marker created for Application ID {app_id}")
+                batch_errors = self.client.create_change_tracking_markers(
+                    batch, self.config.get('DEPLOYMENT_USER'), self.config.get('DEPLOYMENT_REVISION'), "Deployed new version")
             except requests.RequestException as e:
-                logger.error(f"Error creating deployment marker for Application ID {app_id}: {str(e)}")
-                raise
+                batch_errors = {guid: e for guid in batch}
+
+            for guid in batch:
+                if guid in batch_errors:
+                    logger.error(f"Error creating deployment marker for Entity GUID {guid}: {str(batch_errors[guid])}")
+                else:
+                    logger.info(f"Deployment marker created for Entity GUID {guid}")
+            errors.update(batch_errors)
+
+        if errors:
+            # A cached entity may have been deleted or renamed since it was cached
+            if self.client.application_cache is not None:
+                self.client.application_cache.invalidate(f'entities:{app_name_pattern}')
+            raise DeploymentMarkerError(errors)
 
 class NewRelicDeploymentPipe(Pipe):
     def __init__(self, schema: Dict[str, Any], pipe_metadata: Dict[str, Any], deployment_cls: Type[DeploymentRunner]) -> None:
         super().__init__(schema=schema, pipe_metadata=pipe_metadata)
         self.config = Config(schema)
-        self.client = NewRelicClient(self.config.get('NEW_RELIC_API_KEY'))
-        self.deployment = deployment_cls(self.client, self.config)
+        max_workers = self.config.get('MAX_WORKERS')
+        self.client = NewRelicClient(self.config.get('NEW_RELIC_API_KEY'), pool_size=max_workers,
+                                     application_cache=self.create_application_cache(),
+                                     timeout=self.config.get('REQUEST_TIMEOUT'),
+                                     max_retries=self.config.get('MAX_RETRIES'),
+                                     rate_limit=self.config.get('RATE_LIMIT'))
+        self.deployment = deployment_cls(self.client, self.config, max_workers=max_workers)
+
+    def create_application_cache(self) -> Optional[ApplicationCache]:
+        cache_directory = self.config.config.get('APPLICATION_CACHE_DIR')
+        if not cache_directory:
+            return None
+
+        cache = ApplicationCache(cache_directory, self.config.get('APPLICATION_CACHE_TTL'))
+        if self.config.get('APPLICATION_CACHE_INVALIDATE'):
+            cache.invalidate(self.config.get_app_name_pattern())
+            cache.invalidate(f'entities:{self.config.get_app_name_pattern()}')
+        return cache
 
     def run(self) -> None:
-        self.deployment.run()
+        try:
+            with self.client.telemetry.span('run', runner=type(self.deployment).__name__):
+                self.deployment.run()
+        finally:
+            for endpoint, count in sorted(self.client.retries.items()):
+                logger.info(f"Retried {endpoint} requests {count} times")
+            self.report_telemetry()
+
+    def report_telemetry(self) -> None:
+        """Log the run's span timings, and write them to TELEMETRY_FILE and OTLP_TRACES_FILE when they are set."""
+        telemetry = self.client.telemetry
+        for endpoint, count in self.client.retries.items():
+            telemetry.count(f'retries.{endpoint}', count)
+        summary = telemetry.summary()
+        for line in telemetry.format_summary(summary):
+            logger.info(line)
+        if self.config.config.get('TELEMETRY_FILE'):
+            telemetry.write_json(self.config.get('TELEMETRY_FILE'), summary)
+        if self.config.config.get('OTLP_TRACES_FILE'):
+            telemetry.write_otlp(self.config.get('OTLP_TRACES_FILE'))
 
 if __name__ == '__main__':
     with open('/pipe.yml', 'r') as metadata_file:
@@ -145,6 +637,9 @@ if __name__ == '__main__':
         if 'NEW_RELIC_APPLICATION_ID' in os.environ:
             schema = v1_schema
             deployment_cls = V1Deployment
+        elif os.getenv('DEPLOYMENT_API') == 'nerdgraph':
+            schema = nerdgraph_schema
+            deployment_cls = NerdGraphDeployment
         else:
             schema = v2_schema
             deployment_cls = V2Deployment
@@ -2,7 +2,12 @@ import unittest
 from unittest.mock import patch, Mock
 import requests_mock
 import os
-from pipe.pipe import Config, NewRelicClient, V1Deployment, V2Deployment, NewRelicDeploymentPipe, v1_schema, v2_schema
+import time
+import tempfile
+import json
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from pipe.pipe import ApplicationCache, Telemetry, Config, NewRelicClient, V1Deployment, V2Deployment, NerdGraphDeployment, NewRelicDeploymentPipe, DeploymentMarkerError, v1_schema, v2_schema, nerdgraph_schema
 
 class TestConfig(unittest.TestCase):
     @patch.dict(os.environ, {
@@ -31,11 +36,12 @@ class TestNewRelicClient(unittest.TestCase):
         self.api_key = '12345'
         self.client = NewRelicClient(self.api_key)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_search_applications(self, mock_get):
         """Test that search_applications sends a request to the correct URL with correct headers."""
         mock_get.return_value.status_code = 200
         mock_get.return_value.json.return_value = {'applications': []}
+        mock_get.return_value.links = {}
 
         self.client.search_applications('MyApp%production%us-west-2%backend')
         mock_get.assert_called_once_with(
@@ -44,6 +50,229 @@ class TestNewRelicClient(unittest.TestCase):
             params={'filter[name]': 'MyApp%production%us-west-2%backend'}
         )
 
+    @requests_mock.Mocker()
+    def test_search_applications_follows_pages(self, mock_requests):
+        """Test that search_applications follows the Link header to fetch every page."""
+        next_page = 'https://api.newrelic.com/v2/applications.json?filter%5Bname%5D=MyApp&page=2'
+        mock_requests.get('https://api.newrelic.com/v2/applications.json?filter%5Bname%5D=MyApp', complete_qs=True,
+                          json={'applications': [{'id': 1, 'name': 'MyApp Web'}]},
+                          headers={'Link': f'<{next_page}>; rel="next", <{next_page}>; rel="last"'})
+        mock_requests.get(next_page, complete_qs=True, json={'applications': [{'id': 2, 'name': 'MyApp Cron'}]})
+
+        applications = self.client.search_applications('MyApp')
+
+        self.assertEqual([app['id'] for app in applications], [1, 2])
+        self.assertEqual(mock_requests.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_iter_applications_is_lazy(self, mock_requests):
+        """Test that later pages are only requested once the earlier ones are consumed."""
+        next_page = 'https://api.newrelic.com/v2/applications.json?page=2'
+        mock_requests.get('https://api.newrelic.com/v2/applications.json', json={'applications': [{'id': 1, 'name': 'MyApp'}]},
+                          headers={'Link': f'<{next_page}>; rel="next"'})
+
+        applications = self.client.iter_applications('MyApp')
+
+        self.assertEqual(next(applications)['id'], 1)
+        self.assertEqual(mock_requests.call_count, 1)
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        self.client = NewRelicClient('12345', max_retries=2, rate_limit=0)
+        self.url = 'https://api.newrelic.com/v2/applications/app_id_1/deployments.json'
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_retry_after_is_honoured(self, mock_sleep, mock_requests):
+        """Test that throttled requests wait for Retry-After before trying again."""
+        mock_requests.post(self.url, [
+            {'status_code': 429, 'headers': {'Retry-After': '7'}},
+            {'status_code': 201},
+        ])
+
+        self.client.create_deployment_marker('app_id_1', 'user', 'rev123', 'Deployed new version')
+
+        self.assertEqual(mock_requests.call_count, 2)
+        mock_sleep.assert_called_once_with(7.0)
+        self.assertEqual(self.client.retries['deployments'], 1)
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_retries_are_limited(self, mock_sleep, mock_requests):
+        """Test that server errors are retried with backoff up to max_retries before failing."""
+        mock_requests.get('https://api.newrelic.com/v2/applications.json', status_code=503)
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.search_applications('MyApp')
+
+        self.assertEqual(mock_requests.call_count, 3)
+        self.assertEqual(self.client.retries['applications'], 2)
+        for call in mock_sleep.call_args_list:
+            self.assertLessEqual(call.args[0], self.client.backoff_max)
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_connection_errors_are_retried(self, mock_sleep, mock_requests):
+        """Test that a dropped connection is retried."""
+        mock_requests.get('https://api.newrelic.com/v2/applications.json', [
+            {'exc': requests.ConnectionError},
+            {'json': {'applications': [{'id': 1, 'name': 'MyApp'}]}},
+        ])
+
+        self.assertEqual(self.client.search_applications('MyApp'), [{'id': 1, 'name': 'MyApp'}])
+        self.assertEqual(self.client.retries['applications'], 1)
+
+    @requests_mock.Mocker()
+    def test_post_read_timeouts_are_not_retried(self, mock_requests):
+        """Test that a marker which may already have been created is not posted again."""
+        mock_requests.post(self.url, exc=requests.ReadTimeout)
+
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.create_deployment_marker('app_id_1', 'user', 'rev123', 'Deployed new version')
+
+        self.assertEqual(mock_requests.call_count, 1)
+
+    @requests_mock.Mocker()
+    def test_post_server_errors_are_not_retried(self, mock_requests):
+        """Test that a marker the server may have created before failing is not posted again."""
+        mock_requests.post(self.url, [{'status_code': 502}, {'status_code': 201}])
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.create_deployment_marker('app_id_1', 'user', 'rev123', 'Deployed new version')
+
+        self.assertEqual(mock_requests.call_count, 1)
+        self.assertEqual(self.client.retries['deployments'], 0)
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_post_unavailable_and_connect_errors_are_retried(self, mock_sleep, mock_requests):
+        """Test that a marker which never reached the service is posted again."""
+        refused = requests.ConnectionError(MaxRetryError(None, self.url, NewConnectionError(None, 'Connection refused')))
+        mock_requests.post(self.url, [{'exc': refused}, {'status_code': 503}, {'status_code': 201}])
+
+        self.client.create_deployment_marker('app_id_1', 'user', 'rev123', 'Deployed new version')
+
+        self.assertEqual(mock_requests.call_count, 3)
+        self.assertEqual(self.client.retries['deployments'], 2)
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_only_nerdgraph_queries_are_retried_on_server_errors(self, mock_sleep, mock_requests):
+        """Test that the entity search is retried on a 502 while a marker mutation is not."""
+        search_result = {'data': {'actor': {'entitySearch': {'results': {'entities': [], 'nextCursor': None}}}}}
+        mock_requests.post(self.client.nerdgraph_url, [
+            {'status_code': 502}, {'json': search_result},
+            {'status_code': 502}, {'json': {'data': {}}},
+        ])
+
+        self.assertEqual(self.client.search_entities('MyApp%'), [])
+        with self.assertRaises(requests.HTTPError):
+            self.client.create_change_tracking_markers(['guid-1'], 'user', 'rev123', 'Deployed new version')
+
+        self.assertEqual(mock_requests.call_count, 3)
+        self.assertEqual(self.client.retries['graphql'], 1)
+
+class TestTelemetry(unittest.TestCase):
+    def test_summary_percentiles(self):
+        """Test that spans are summarised per name with nearest-rank percentiles."""
+        telemetry = Telemetry('new-relic-deployment-marker', 'http ')
+        telemetry.spans = [{'name': 'http applications', 'seconds': seconds, 'error': None} for seconds in range(1, 101)]
+        telemetry.count('retries.applications', 2)
+
+        summary = telemetry.summary()
+
+        span = summary['spans']['http applications']
+        self.assertEqual((span['count'], span['p50Seconds'], span['p95Seconds'], span['p99Seconds'], span['maxSeconds']), (100, 50, 95, 99, 100))
+        self.assertEqual(summary['counters'], {'retries.applications': 2})
+
+    @patch('pipe.pipe.time.sleep')
+    @requests_mock.Mocker()
+    def test_requests_are_timed_with_their_retries(self, mock_sleep, mock_requests):
+        """Test that a request and its retries are recorded as one span."""
+        client = NewRelicClient('12345', max_retries=2, rate_limit=0)
+        mock_requests.post('https://api.newrelic.com/v2/applications/app_id_1/deployments.json', [
+            {'status_code': 503},
+            {'status_code': 201},
+        ])
+
+        client.create_deployment_marker('app_id_1', 'user', 'rev123', 'Deployed new version')
+
+        [span] = client.telemetry.spans
+        self.assertEqual(span['name'], 'http deployments')
+        self.assertEqual(span['attributes'], {'method': 'POST', 'retries': 1, 'status': 201})
+
+    @patch.dict(os.environ, {
+        'NEW_RELIC_API_KEY': '12345',
+        'NEW_RELIC_APPLICATION_ID': 'app_id_1',
+        'DEPLOYMENT_REVISION': 'rev123',
+    })
+    @requests_mock.Mocker()
+    def test_pipe_writes_telemetry_files(self, mock_requests):
+        """Test that the run's summary and OTLP spans are written when the files are set."""
+        mock_requests.post('https://api.newrelic.com/v2/applications/app_id_1/deployments.json', status_code=201)
+
+        with tempfile.TemporaryDirectory() as directory:
+            summary_file = os.path.join(directory, 'telemetry.json')
+            traces_file = os.path.join(directory, 'traces.jsonl')
+            with patch.dict(os.environ, {'TELEMETRY_FILE': summary_file, 'OTLP_TRACES_FILE': traces_file}):
+                NewRelicDeploymentPipe(v1_schema, {}, V1Deployment).run()
+
+            with open(summary_file) as f:
+                summary = json.load(f)
+            with open(traces_file) as f:
+                [request] = [json.loads(line) for line in f]
+
+        self.assertEqual(sorted(summary['spans']), ['http deployments', 'run'])
+        spans = request['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(sorted(span['name'] for span in spans), ['http deployments', 'run'])
+        self.assertEqual(len({span['traceId'] for span in spans}), 1)
+
+class TestApplicationCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    @requests_mock.Mocker()
+    def test_search_applications_uses_cache(self, mock_requests):
+        """Test that a cached search skips the round trip until it is invalidated."""
+        mock_requests.get('https://api.newrelic.com/v2/applications.json', json={'applications': [{'id': 1, 'name': 'MyApp'}]})
+        cache = ApplicationCache(self.directory.name, ttl=60)
+        client = NewRelicClient('12345', application_cache=cache)
+
+        self.assertEqual(client.search_applications('MyApp'), [{'id': 1, 'name': 'MyApp'}])
+        self.assertEqual(client.search_applications('MyApp'), [{'id': 1, 'name': 'MyApp'}])
+        self.assertEqual(mock_requests.call_count, 1)
+
+        cache.invalidate('MyApp')
+        client.search_applications('MyApp')
+        self.assertEqual(mock_requests.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_empty_searches_are_not_cached(self, mock_requests):
+        """Test that an application that doesn't exist yet is searched for again on the next run."""
+        mock_requests.get('https://api.newrelic.com/v2/applications.json', [
+            {'json': {'applications': []}},
+            {'json': {'applications': [{'id': 1, 'name': 'MyApp'}]}},
+        ])
+        mock_requests.post('https://api.newrelic.com/graphql', json={
+            'data': {'actor': {'entitySearch': {'results': {'entities': [], 'nextCursor': None}}}}})
+        cache = ApplicationCache(self.directory.name, ttl=60)
+        client = NewRelicClient('12345', application_cache=cache)
+
+        self.assertEqual(client.search_applications('MyApp'), [])
+        self.assertEqual(client.search_applications('MyApp'), [{'id': 1, 'name': 'MyApp'}])
+        self.assertEqual(client.search_entities('MyApp'), [])
+        self.assertEqual(client.search_entities('MyApp'), [])
+        self.assertEqual(mock_requests.call_count, 4)
+
+    def test_expired_entries_are_ignored(self):
+        """Test that entries older than the TTL are not returned."""
+        cache = ApplicationCache(self.directory.name, ttl=0)
+        cache.set('MyApp', [{'id': 1, 'name': 'MyApp'}])
+
+        with patch('time.time', return_value=time.time() + 1):
+            self.assertIsNone(cache.get('MyApp'))
+
 class TestV1Deployment(unittest.TestCase):
     @patch('pipe.pipe.NewRelicClient')
     def test_run_v1_deployment(self, mock_client_class):
@@ -58,6 +287,28 @@ class TestV1Deployment(unittest.TestCase):
 
         client.create_deployment_marker.assert_called_once()
 
+class TestConcurrentDeployment(unittest.TestCase):
+    @patch('pipe.pipe.NewRelicClient')
+    def test_errors_are_aggregated(self, mock_client_class):
+        """Test that a failing application doesn't stop markers being created for the others."""
+        client = mock_client_class.return_value
+
+        def create_deployment_marker(app_id, user, revision, description):
+            if app_id in ('2', '4'):
+                raise requests.HTTPError(f'{app_id} failed')
+
+        client.create_deployment_marker.side_effect = create_deployment_marker
+
+        config = Mock(spec=Config)
+        config.get.side_effect = lambda key: {'NEW_RELIC_APPLICATION_ID': '1,2,3,4,5', 'DEPLOYMENT_USER': 'bitbucket.pipeline', 'DEPLOYMENT_REVISION': 'rev123'}[key]
+
+        runner = V1Deployment(client, config, max_workers=3)
+        with self.assertRaises(DeploymentMarkerError) as context:
+            runner.run()
+
+        self.assertEqual(client.create_deployment_marker.call_count, 5)
+        self.assertEqual(sorted(context.exception.errors), ['2', '4'])
+
 class TestV2Deployment(unittest.TestCase):
     @patch('pipe.pipe.NewRelicClient')
     def test_run_v2_deployment(self, mock_client_class):
@@ -161,5 +412,59 @@ class TestNewRelicDeploymentIntegration(unittest.TestCase):
         self.assertEqual(mock_requests.request_history[1].url,
                          'https://api.newrelic.com/v2/applications/app_id_1/deployments.json')
 
+    @patch.dict(os.environ, {
+        'NEW_RELIC_API_KEY': '12345',
+        'APPLICATION_NAME': 'MyApp',
+        'COMPONENT_TYPE': 'backend',
+        'ENVIRONMENT': 'production',
+        'SHORT_REGION': 'us-west-2',
+        'DEPLOYMENT_REVISION': 'rev123',
+        'DEPLOYMENT_USER': 'test_user',
+        'DEPLOYMENT_API': 'nerdgraph'
+    })
+    @requests_mock.Mocker()
+    def test_nerdgraph_deployment(self, mock_requests):
+        """Integration test for NerdGraph deployment, which marks every entity in two requests."""
+        entities = [{'guid': f'guid-{index}', 'name': f'MyApp {index}'} for index in range(3)]
+        mock_requests.post('https://api.newrelic.com/graphql', [
+            {'json': {'data': {'actor': {'entitySearch': {'results': {'nextCursor': None, 'entities': entities}}}}}},
+            {'json': {'data': {f'marker{index}': {'deploymentId': str(index), 'entityGuid': entity['guid']} for index, entity in enumerate(entities)}}},
+        ])
+
+        pipe = NewRelicDeploymentPipe(nerdgraph_schema, {}, NerdGraphDeployment)
+        pipe.run()
+
+        self.assertEqual(mock_requests.call_count, 2)
+        search, mutation = [request.json() for request in mock_requests.request_history]
+        self.assertIn("name LIKE '%MyApp%production%us-west-2%backend'", search['variables']['query'])
+        self.assertEqual(mutation['query'].count('changeTrackingCreateDeployment'), 3)
+        self.assertEqual(mutation['variables']['deployment2'],
+                         {'entityGuid': 'guid-2', 'version': 'rev123', 'user': 'test_user', 'description': 'Deployed new version'})
+
+    @patch.dict(os.environ, {
+        'NEW_RELIC_API_KEY': '12345',
+        'APPLICATION_NAME': 'MyApp',
+        'COMPONENT_TYPE': 'backend',
+        'ENVIRONMENT': 'production',
+        'SHORT_REGION': 'us-west-2',
+        'DEPLOYMENT_REVISION': 'rev123',
+        'DEPLOYMENT_API': 'nerdgraph'
+    })
+    @requests_mock.Mocker()
+    def test_nerdgraph_deployment_errors(self, mock_requests):
+        """Test that errors in an aliased mutation are reported against their entity."""
+        entities = [{'guid': 'guid-0', 'name': 'MyApp 0'}, {'guid': 'guid-1', 'name': 'MyApp 1'}]
+        mock_requests.post('https://api.newrelic.com/graphql', [
+            {'json': {'data': {'actor': {'entitySearch': {'results': {'nextCursor': None, 'entities': entities}}}}}},
+            {'json': {'data': {'marker0': {'deploymentId': '0', 'entityGuid': 'guid-0'}, 'marker1': None},
+                      'errors': [{'message': 'Entity not found', 'path': ['marker1']}]}},
+        ])
+
+        pipe = NewRelicDeploymentPipe(nerdgraph_schema, {}, NerdGraphDeployment)
+        with self.assertRaises(DeploymentMarkerError) as context:
+            pipe.run()
+
+        self.assertEqual(list(context.exception.errors), ['guid-1'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
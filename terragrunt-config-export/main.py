@@ -1,144 +1,800 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
 import boto3
+import botocore
+import botocore.session
 import yaml
 import time
-import stat
-import configparser
+import hashlib
+import json
+import re
+import threading
+import types
+import contextlib
+from botocore.config import Config as BotocoreConfig
+from cerberus import Validator
+from botocore.credentials import RefreshableCredentials
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
-def auth_oidc():
-    random_number = str(time.time_ns())
-    aws_config_directory = os.path.join(os.environ["HOME"], '.aws')
-    oidc_token_directory = os.path.join(aws_config_directory, '.aws-oidc')
+# describe_services accepts at most 10 services per call
+DESCRIBE_SERVICES_CHUNK_SIZE = 10
 
-    os.makedirs(aws_config_directory, exist_ok=True)
-    os.makedirs(oidc_token_directory, exist_ok=True)
+# Task definition ARNs pinned to a revision (family:revision) are immutable
+REVISION_ARN_PATTERN = re.compile(r':task-definition/[^:]+:\d+$')
 
-    web_identity_token_path = os.path.join(oidc_token_directory, f'oidc_token_{random_number}')
-    with open(web_identity_token_path, 'w') as f:
-        f.write(os.getenv('BITBUCKET_STEP_OIDC_TOKEN'))
+# Secrets Manager ARNs, optionally followed by :json-key:version-stage:version-id
+SECRET_ARN_PATTERN = re.compile(r'^arn:[^:]+:secretsmanager:[^:]*:[^:]*:secret:([^:]+)')
 
-    os.chmod(web_identity_token_path, mode=stat.S_IRUSR)
-    print('Web identity token file is created')
+# Part of the cached conversions' keys. Bump it whenever convert_to_terragrunt_format's output changes,
+# so conversions cached by an older version of the pipe aren't reused
+CONVERSION_VERSION = 1
 
-    aws_configfile_path = os.path.join(aws_config_directory, 'config')
-    with open(aws_configfile_path, 'w') as configfile:
-        config = configparser.ConfigParser()
-        config['default'] = {
-            'role_arn': os.getenv('AWS_OIDC_ROLE_ARN'),
-            'web_identity_token_file': web_identity_token_path
-        }
-        config.write(configfile)
-    print('Configured settings for authentication with assume web identity role')
+OUTPUT_FORMATS = ('yaml', 'json', 'ndjson')
+OUTPUT_FILE_EXTENSIONS = {'yaml': 'yml', 'json': 'json', 'ndjson': 'ndjson'}
+
+
+def parse_yaml_variable(value):
+    return yaml.safe_load(value) if isinstance(value, str) else value
+
+
+# Inputs to convert_to_terragrunt_format besides the task definition itself
+conversion_schema = {
+    'EXTRA_ENV': {'type': 'dict', 'coerce': parse_yaml_variable, 'default': {}},
+    'ENDPOINTS': {'type': 'list', 'coerce': parse_yaml_variable, 'default': []},
+    'EXTERNAL_ENDPOINTS': {'type': 'list', 'coerce': parse_yaml_variable, 'default': []},
+    'MAIN_CONTAINER_NAME': {'type': 'string', 'default': ''},
+    'IAM_ROLE': {'type': 'string', 'default': ''},
+}
+
+
+class Config:
+    def __init__(self, schema):
+        self.validator = Validator(schema)
+        self.config = self.load_config()
+
+    def load_config(self):
+        config = {key: os.getenv(key) or value.get('default') for key, value in self.validator.schema.items()}
+        if not self.validator.validate(config):
+            raise ValueError(f"Configuration validation error: {self.validator.errors}")
+        return self.validator.document
+
+    def get(self, key):
+        return self.config[key]
+
+    def fingerprint(self):
+        return json.dumps(self.config, sort_keys=True)
+
+
+conversion_config = None
+
+
+def get_conversion_config():
+    """
+    Return the conversion inputs, parsed and validated once per process.
+    """
+    global conversion_config
+    if conversion_config is None:
+        conversion_config = Config(conversion_schema)
+    return conversion_config
+
+
+def load_conversion_config():
+    """
+    Validate the conversion inputs up front, exiting with the validation errors if they are invalid.
+    """
+    try:
+        get_conversion_config()
+    except ValueError as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+session_lock = threading.Lock()
+boto3_session = None
+boto3_clients = {}
+auth_metrics = {
+    "assumeRoleCalls": 0,
+    "assumeRoleSeconds": 0.0,
+    "clientsCreated": 0,
+    "clientCreationSeconds": 0.0,
+    "clientCacheHits": 0,
+}
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of API calls made from several threads.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, **kwargs):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+rate_limiters = {}
 
-def get_boto3_client(service_name='ecs'):
+
+def get_rate_limiter(region):
+    """
+    Return the rate limiter shared by every client in a region, None when REGION_RATE_LIMIT is 0.
+    """
+    rate = float(os.getenv('REGION_RATE_LIMIT', '20'))
+    if rate <= 0:
+        return None
+    if region not in rate_limiters:
+        rate_limiters[region] = RateLimiter(rate)
+    return rate_limiters[region]
+
+
+def get_region():
+    return os.getenv('AWS_REGION', os.getenv('AWS_DEFAULT_REGION', 'eu-west-1'))
+
+
+def assume_web_identity_role(sts_client):
+    """
+    Assume AWS_OIDC_ROLE_ARN with the step OIDC token, keeping the credentials in memory.
+    """
+    started = time.perf_counter()
+    response = sts_client.assume_role_with_web_identity(
+        RoleArn=os.getenv('AWS_OIDC_ROLE_ARN'),
+        RoleSessionName=f"terragrunt-config-export-{os.getenv('BITBUCKET_BUILD_NUMBER', 'local')}",
+        WebIdentityToken=os.getenv('BITBUCKET_STEP_OIDC_TOKEN'),
+    )
+    auth_metrics["assumeRoleCalls"] += 1
+    auth_metrics["assumeRoleSeconds"] += time.perf_counter() - started
+
+    credentials = response['Credentials']
+    return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat(),
+    }
+
+
+def create_oidc_session():
+    """
+    Create a session whose credentials come from assuming the web identity role once,
+    and are refreshed by botocore shortly before they expire.
+    """
+    botocore_session = botocore.session.get_session()
+    sts_client = botocore_session.create_client(
+        'sts', region_name=get_region(), config=BotocoreConfig(signature_version=botocore.UNSIGNED))
+    instrument_client(sts_client)
+
+    def refresh():
+        return assume_web_identity_role(sts_client)
+
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(),
+        refresh_using=refresh,
+        method='assume-role-with-web-identity',
+    )
+    print('Assumed web identity role')
+    return boto3.Session(botocore_session=botocore_session)
+
+
+def get_boto3_session():
+    """
+    Return the process-wide boto3 session, authenticating on first use.
+    """
+    global boto3_session
+    if boto3_session is None:
+        profile_name = os.getenv('AWS_PROFILE')
+        if os.getenv('AWS_OIDC_ROLE_ARN'):
+            boto3_session = create_oidc_session()
+        elif profile_name:
+            boto3_session = boto3.Session(profile_name=profile_name)
+        else:
+            boto3_session = boto3.Session()
+    return boto3_session
+
+
+def get_boto3_client(service_name='ecs', region=None):
     """
     Create and return a boto3 client with appropriate authentication.
+    Clients are cached per service and region, share the session's credentials and the region's rate limiter.
     """
-    region = os.getenv('AWS_REGION', os.getenv('AWS_DEFAULT_REGION', 'eu-west-1'))
-    profile_name = os.getenv('AWS_PROFILE')
-    oidc = os.getenv('AWS_OIDC_ROLE_ARN')
+    region = region or get_region()
+    key = (service_name, region)
+
+    with session_lock:
+        if key in boto3_clients:
+            auth_metrics["clientCacheHits"] += 1
+            return boto3_clients[key]
+
+        started = time.perf_counter()
+        client = get_boto3_session().client(service_name, region_name=region)
+        rate_limiter = get_rate_limiter(region)
+        if rate_limiter is not None:
+            client.meta.events.register(f'before-call.{client.meta.service_model.service_id.hyphenize()}', rate_limiter.acquire)
+        boto3_clients[key] = instrument_client(client)
+        auth_metrics["clientsCreated"] += 1
+        auth_metrics["clientCreationSeconds"] += time.perf_counter() - started
+        return boto3_clients[key]
 
-    if oidc:
-        auth_oidc()
-        return boto3.client(service_name,region_name=region)
-    elif profile_name:
-        session = boto3.Session(profile_name=profile_name)
-        return session.client(service_name, region_name=region)
 
-def convert_to_terragrunt_format(task_definition, service_name):
+def print_auth_metrics():
+    print(
+        f"Auth: {auth_metrics['assumeRoleCalls']} role assumptions in {auth_metrics['assumeRoleSeconds']:.3f}s, "
+        f"{auth_metrics['clientsCreated']} clients created in {auth_metrics['clientCreationSeconds']:.3f}s, "
+        f"{auth_metrics['clientCacheHits']} client cache hits"
+    )
+
+
+# percentile and Telemetry are copied into each pipe's image, .github/scripts/check_telemetry.py checks the copies match
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    rank = -(-percent * len(values) // 100)
+    return values[max(rank, 1) - 1]
+
+
+class Telemetry:
     """
-    Convert ECS task definition to the required Terragrunt format.
+    Times the AWS calls and conversion steps of a run as spans, summarised as latency percentiles per span name.
     """
 
-    extra_env_str = os.getenv('EXTRA_ENV', '')
-    try:
-        extra_env = yaml.safe_load(extra_env_str) if extra_env_str else {}
-    except yaml.YAMLError:
-        extra_env = {}
+    def __init__(self, service_name, client_span_prefix):
+        self.service_name = service_name
+        # Spans named with this prefix are calls to another service, exported as SPAN_KIND_CLIENT
+        self.client_span_prefix = client_span_prefix
+        self.trace_id = os.urandom(16).hex()
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
 
-    endpoints = os.getenv('ENDPOINTS', '')
-    try:
-        endpoints_list = yaml.safe_load(endpoints) if endpoints else []
-    except yaml.YAMLError:
-        endpoints_list = []
+    def record(self, name, started, seconds, attributes=None, error=None):
+        with self.lock:
+            self.spans.append({'name': name, 'span_id': os.urandom(8).hex(), 'started': started, 'seconds': seconds,
+                               'attributes': attributes or {}, 'error': str(error) if error else None})
 
-    external_endpoints = os.getenv('EXTERNAL_ENDPOINTS', '')
-    try:
-        external_endpoints_list = yaml.safe_load(external_endpoints) if external_endpoints else []
-    except yaml.YAMLError:
-        external_endpoints_list = []
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time the block, yielding the span's attributes so the block can add to them."""
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, started, time.perf_counter() - start, attributes, error)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        by_name = {}
+        for span in self.spans:
+            by_name.setdefault(span['name'], []).append(span)
+
+        spans = {}
+        for name, recorded in sorted(by_name.items()):
+            seconds = sorted(span['seconds'] for span in recorded)
+            spans[name] = {
+                'count': len(seconds),
+                'errors': sum(1 for span in recorded if span['error']),
+                'totalSeconds': round(sum(seconds), 6),
+                'p50Seconds': round(percentile(seconds, 50), 6),
+                'p95Seconds': round(percentile(seconds, 95), 6),
+                'p99Seconds': round(percentile(seconds, 99), 6),
+                'maxSeconds': round(seconds[-1], 6),
+            }
+
+        return {
+            'service': self.service_name,
+            'started': self.started,
+            'durationSeconds': round(time.time() - self.started, 6),
+            'spans': spans,
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def format_summary(self, summary):
+        """The summary as the lines of a table, followed by the counters."""
+        width = max(len(name) for name in ['span', *summary['spans']]) + 2
+        lines = [f"{'span':<{width}}{'count':>7}{'errors':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}{'total (s)':>11}"]
+        for name, span in summary['spans'].items():
+            lines.append(
+                f"{name:<{width}}{span['count']:>7}{span['errors']:>8}{span['p50Seconds']:>10.3f}{span['p95Seconds']:>10.3f}"
+                f"{span['p99Seconds']:>10.3f}{span['maxSeconds']:>10.3f}{span['totalSeconds']:>11.3f}")
+        if summary['counters']:
+            lines.append('Counters: ' + ', '.join(f"{name}={value}" for name, value in summary['counters'].items()))
+        return lines
+
+    def write_json(self, path, summary):
+        with open(path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+
+    def write_otlp(self, path):
+        """Append the spans as one OTLP/JSON ExportTraceServiceRequest line, as read by the collector's otlpjsonfile receiver."""
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = []
+        for span in self.spans:
+            start_nanos = int(span['started'] * 1e9)
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': span['span_id'],
+                'name': span['name'],
+                # SPAN_KIND_CLIENT = 3, SPAN_KIND_INTERNAL = 1
+                'kind': 3 if span['name'].startswith(self.client_span_prefix) else 1,
+                'startTimeUnixNano': str(start_nanos),
+                'endTimeUnixNano': str(start_nanos + int(span['seconds'] * 1e9)),
+                'attributes': [attribute(key, value) for key, value in span['attributes'].items()],
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {},
+            })
+
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', self.service_name)]},
+            'scopeSpans': [{'scope': {'name': self.service_name}, 'spans': spans}],
+        }]}
+        with open(path, 'a') as traces_file:
+            traces_file.write(json.dumps(request, separators=(',', ':')) + '\n')
+
+
+telemetry = Telemetry('terragrunt-config-export', 'aws ')
+
+
+def instrument_client(client):
+    """
+    Record a span for every call the client makes, counting the retries botocore made for it.
+    Registered after the rate limiter, so time spent waiting for a token isn't counted as latency.
+    """
+    service_id = client.meta.service_model.service_id.hyphenize()
+
+    def before_call(model, context, **kwargs):
+        context['telemetry'] = (f"aws {service_id}.{model.name}", time.time(), time.perf_counter())
+
+    def finish(context, metadata, error=None):
+        if 'telemetry' not in context:
+            return
+        name, started, start = context.pop('telemetry')
+        retries = metadata.get('RetryAttempts', 0)
+        if retries:
+            telemetry.count("awsRetries", retries)
+        telemetry.record(name, started, time.perf_counter() - start,
+                         {"aws.region": client.meta.region_name, "retries": retries}, error)
+
+    def after_call(http_response, parsed, context, **kwargs):
+        error = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+        finish(context, parsed.get('ResponseMetadata', {}), error)
+
+    def after_call_error(exception, context, **kwargs):
+        finish(context, {}, exception)
+
+    client.meta.events.register(f'before-call.{service_id}', before_call)
+    client.meta.events.register(f'after-call.{service_id}', after_call)
+    client.meta.events.register(f'after-call-error.{service_id}', after_call_error)
+    return client
+
+
+def report_telemetry():
+    """
+    Print the run's span timings, and write them to TELEMETRY_FILE and OTLP_TRACES_FILE if specified.
+    """
+    summary = telemetry.summary()
+    for line in telemetry.format_summary(summary):
+        print(line)
+    if os.getenv('TELEMETRY_FILE'):
+        telemetry.write_json(os.getenv('TELEMETRY_FILE'), summary)
+    if os.getenv('OTLP_TRACES_FILE'):
+        telemetry.write_otlp(os.getenv('OTLP_TRACES_FILE'))
+
+
+class TaskDefinitionCache:
+    """
+    Content-addressed on-disk cache for immutable task definition revisions and their conversions.
+    Entries are evicted least recently used first at the end of a run once the directory exceeds max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
 
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(temporary_path, path)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the directory fits in max_size bytes.
+        Called once per run rather than after every put, as it reads the whole directory.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat_result = entry.stat()
+                entries.append((stat_result.st_mtime, stat_result.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def summary(self):
+        return f"Cache hits: {self.hits}, misses: {self.misses}"
+
+
+task_definition_cache = None
+task_definition_cache_lock = threading.Lock()
+
+
+def get_task_definition_cache():
+    """
+    Return the process-wide task definition cache, None when CACHE_DIRECTORY is not set.
+    It is first used from the worker threads, so it is created under a lock.
+    """
+    global task_definition_cache
+    cache_directory = os.getenv('CACHE_DIRECTORY')
+    with task_definition_cache_lock:
+        if task_definition_cache is None and cache_directory:
+            max_size = int(os.getenv('CACHE_MAX_SIZE_MB', '100')) * 1024 * 1024
+            task_definition_cache = TaskDefinitionCache(cache_directory, max_size)
+    return task_definition_cache
+
+
+def describe_task_definition(ecs_client, task_definition_arn):
+    """
+    Fetch a task definition, serving immutable revisions from the cache when enabled.
+    """
+    cache = get_task_definition_cache()
+    cacheable = cache is not None and REVISION_ARN_PATTERN.search(task_definition_arn)
+
+    if cacheable:
+        task_definition = cache.get(task_definition_arn)
+        if task_definition is not None:
+            return task_definition
+
+    response = ecs_client.describe_task_definition(taskDefinition=task_definition_arn)
+    task_definition = response['taskDefinition']
+
+    if cacheable:
+        cache.put(task_definition_arn, task_definition)
+    return task_definition
+
+
+def convert_task_definition(task_definition_arn, task_definition, service_name, lazy=False):
+    """
+    Convert a task definition, reusing a cached conversion of the same revision and inputs.
+    """
+    cache = get_task_definition_cache()
+    if cache is None or not REVISION_ARN_PATTERN.search(task_definition_arn):
+        with telemetry.span('convert', service=service_name, lazy=lazy):
+            return convert_to_terragrunt_format(task_definition, service_name, lazy)
+
+    key = 'conversion:' + json.dumps(
+        [CONVERSION_VERSION, task_definition_arn, service_name, get_conversion_config().fingerprint()])
+
+    with telemetry.span('convert', service=service_name, lazy=False) as attributes:
+        config = cache.get(key)
+        attributes['cached'] = config is not None
+        if config is None:
+            config = convert_to_terragrunt_format(task_definition, service_name)
+            cache.put(key, config)
+    return config
+
+
+def convert_to_terragrunt_format(task_definition, service_name, lazy=False):
+    """
+    Convert ECS task definition to the required Terragrunt format.
+    With lazy set, containers is a generator converting one container at a time for the streaming writers.
+    """
+
+    inputs = get_conversion_config()
+
+    container_definitions = task_definition.get("containerDefinitions", [])
+    containers = (convert_container(container) for container in container_definitions)
+    secret_names = get_secret_names(container_definitions)
 
     # Initialize the terragrunt config structure
     config = {
         "deployment": {
-            "extraEnv": extra_env
+            "extraEnv": inputs.get('EXTRA_ENV')
         },
         "terragruntConfig": {
             "name": f"({service_name})",
-            "secretName": "",
-            "containers": [],
-            "mainContainerName": os.getenv("MAIN_CONTAINER_NAME", ""),
+            "secretName": secret_names[-1] if secret_names else "",
+            "secretNames": secret_names,
+            "containers": containers if lazy else list(containers),
+            "mainContainerName": inputs.get('MAIN_CONTAINER_NAME'),
             "resources": {
                 "cpu" : task_definition.get("cpu", 0),
                 "memory" : task_definition.get("memory", 0)
             },
-            "endpoints": endpoints_list,
-            "externalEndpoints": external_endpoints_list,
-            "iamRole": os.getenv('IAM_ROLE', "")
+            "endpoints": inputs.get('ENDPOINTS'),
+            "externalEndpoints": inputs.get('EXTERNAL_ENDPOINTS'),
+            "iamRole": inputs.get('IAM_ROLE')
         }
     }
 
-    # Process each container definition
-    for container in task_definition.get("containerDefinitions", []):
-        terragrunt_container = {
-            "name": container.get("name", ""),
-            "image": container.get("image", ""),
-            "environment": [],
-            "ports": [],
-            "dependencies": []
-        }
+    return config
 
-        if "secrets" in container:
-            for secret in container["secrets"]:
-                secret_name = secret.get("valueFrom", "").split(":")[-1].rsplit("-", 1)[0]
-                if secret_name not in config["terragruntConfig"]["secretName"] and secret.get("name", "") != "SHAREDSECRETS":
-                    config["terragruntConfig"]["secretName"] = secret_name
-
-
-        # Process environment variables
-        if "environment" in container:
-            for env in container["environment"]:
-                terragrunt_container["environment"].append({
-                    "name": env.get("name", ""),
-                    "value": env.get("value", "")
-                })
-
-        # Process port mappings
-        if "portMappings" in container:
-            for port in container["portMappings"]:
-                terragrunt_container["ports"].append({
-                    "name": port.get("name", ""),
-                    "hostPort": port.get("hostPort", 0),
-                    "containerPort": port.get("containerPort", 0),
-                    "protocol": port.get("protocol", "")
-                })
-
-        # Process dependencies (if any)
-        if "dependsOn" in container:
-            for dep in container["dependsOn"]:
-                terragrunt_container["dependencies"].append({
-                    "condition": dep.get("condition", ""),
-                    "containerName": dep.get("containerName", "")
-                })
-
-        config["terragruntConfig"]["containers"].append(terragrunt_container)
 
-    return config
+def parse_secret_name(value_from):
+    """
+    Get the secret name from a secret ARN, without the random suffix Secrets Manager appends.
+    """
+    match = SECRET_ARN_PATTERN.match(value_from)
+    secret_id = match.group(1) if match else value_from.split(":")[-1]
+    return secret_id.rsplit("-", 1)[0]
+
+
+def get_secret_names(container_definitions):
+    """
+    Get the names of the secrets referenced by the container definitions, in order of first use.
+    Each distinct ARN is parsed once however many containers or keys reference it.
+    """
+    secret_arns = dict.fromkeys(
+        secret.get("valueFrom", "")
+        for container in container_definitions
+        for secret in container.get("secrets", ())
+        if secret.get("name", "") != "SHAREDSECRETS"
+    )
+    return list(dict.fromkeys(parse_secret_name(secret_arn) for secret_arn in secret_arns))
+
+
+def convert_container(container):
+    """
+    Convert a single ECS container definition to the Terragrunt container format.
+    """
+    return {
+        "name": container.get("name", ""),
+        "image": container.get("image", ""),
+        "environment": [
+            {"name": env.get("name", ""), "value": env.get("value", "")}
+            for env in container.get("environment", ())
+        ],
+        "ports": [
+            {
+                "name": port.get("name", ""),
+                "hostPort": port.get("hostPort", 0),
+                "containerPort": port.get("containerPort", 0),
+                "protocol": port.get("protocol", "")
+            }
+            for port in container.get("portMappings", ())
+        ],
+        "dependencies": [
+            {"condition": dep.get("condition", ""), "containerName": dep.get("containerName", "")}
+            for dep in container.get("dependsOn", ())
+        ]
+    }
+
+
+def yaml_node_events(dumper, node):
+    """
+    Generate the emitter events for a represented node, the streaming equivalent of yaml.serialize.
+    """
+    if isinstance(node, yaml.ScalarNode):
+        detected_tag = dumper.resolve(yaml.ScalarNode, node.value, (True, False))
+        default_tag = dumper.resolve(yaml.ScalarNode, node.value, (False, True))
+        implicit = (node.tag == detected_tag, node.tag == default_tag)
+        yield yaml.ScalarEvent(None, node.tag, implicit, node.value, style=node.style)
+    elif isinstance(node, yaml.SequenceNode):
+        implicit = node.tag == dumper.resolve(yaml.SequenceNode, node.value, True)
+        yield yaml.SequenceStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+        for item in node.value:
+            yield from yaml_node_events(dumper, item)
+        yield yaml.SequenceEndEvent()
+    else:
+        implicit = node.tag == dumper.resolve(yaml.MappingNode, node.value, True)
+        yield yaml.MappingStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+        for key, value in node.value:
+            yield from yaml_node_events(dumper, key)
+            yield from yaml_node_events(dumper, value)
+        yield yaml.MappingEndEvent()
+
+
+def yaml_data_events(dumper, data):
+    """
+    Generate emitter events for data, consuming generators lazily and representing one item at a time.
+    """
+    if isinstance(data, dict):
+        yield yaml.MappingStartEvent(None, None, True, flow_style=False)
+        for key, value in data.items():
+            yield from yaml_data_events(dumper, key)
+            yield from yaml_data_events(dumper, value)
+        yield yaml.MappingEndEvent()
+    elif isinstance(data, types.GeneratorType):
+        yield yaml.SequenceStartEvent(None, None, True, flow_style=False)
+        for item in data:
+            yield from yaml_data_events(dumper, item)
+        yield yaml.SequenceEndEvent()
+    else:
+        node = dumper.represent_data(data)
+        dumper.represented_objects = {}
+        yield from yaml_node_events(dumper, node)
+
+
+def write_yaml(config, stream):
+    """
+    Stream config as YAML, using the C-accelerated emitter when PyYAML was built with libyaml.
+    """
+    dumper = YamlDumper(stream, default_flow_style=False, sort_keys=False)
+    dumper.emit(yaml.StreamStartEvent())
+    dumper.emit(yaml.DocumentStartEvent(explicit=False))
+    for event in yaml_data_events(dumper, config):
+        dumper.emit(event)
+    dumper.emit(yaml.DocumentEndEvent(explicit=False))
+    dumper.emit(yaml.StreamEndEvent())
+    dumper.dispose()
+
+
+def json_chunks(data, indent, level=0):
+    """
+    Generate JSON text for data in chunks, consuming generators lazily.
+    """
+    if isinstance(data, dict):
+        items = data.items()
+        opening, closing = '{', '}'
+    elif isinstance(data, (list, types.GeneratorType)):
+        items = data
+        opening, closing = '[', ']'
+    else:
+        yield json.dumps(data)
+        return
+
+    if indent is None:
+        item_prefix, closing_prefix, key_separator = '', '', ':'
+    else:
+        item_prefix = '\n' + ' ' * indent * (level + 1)
+        closing_prefix = '\n' + ' ' * indent * level
+        key_separator = ': '
+
+    yield opening
+    empty = True
+    for item in items:
+        yield item_prefix if empty else ',' + item_prefix
+        empty = False
+        if isinstance(data, dict):
+            key, item = item
+            yield json.dumps(key) + key_separator
+        yield from json_chunks(item, indent, level + 1)
+    yield closing if empty else closing_prefix + closing
+
+
+def write_terragrunt_config(config, stream, output_format='yaml'):
+    """
+    Write a converted config to stream in the requested output format.
+    """
+    if output_format == 'yaml':
+        write_yaml(config, stream)
+        return
+
+    indent = 2 if output_format == 'json' else None
+    for chunk in json_chunks(config, indent):
+        stream.write(chunk)
+    stream.write('\n')
+
+
+def get_output_format():
+    output_format = os.getenv('OUTPUT_FORMAT', 'yaml').lower()
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Error: OUTPUT_FORMAT must be one of {', '.join(OUTPUT_FORMATS)}")
+        sys.exit(1)
+    return output_format
+
+
+def read_output_file(output_file):
+    """
+    Get the content of an existing output file, None when there isn't one.
+    """
+    try:
+        with open(output_file, 'r') as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def write_output_file(output_file, configs, output_format, only_if_changed=False):
+    """
+    Write converted configs to output_file. Returns False when the write was skipped because
+    only_if_changed is set and the file already holds the same content.
+    """
+    content = None
+    if only_if_changed:
+        # Lazy configs are converted as they are rendered, so this includes the rest of their conversion
+        with telemetry.span('render', output_format=output_format):
+            rendered = io.StringIO()
+            for config in configs:
+                write_terragrunt_config(config, rendered, output_format)
+            content = rendered.getvalue()
+        if read_output_file(output_file) == content:
+            return False
+
+    # Written next to the output and moved over it, so a failed conversion leaves the previous output in place.
+    # Lazy configs are converted as they are written, so this includes the rest of their conversion
+    temporary_file = f"{output_file}.tmp"
+    try:
+        with telemetry.span('write', output_format=output_format), open(temporary_file, 'w') as f:
+            if content is not None:
+                f.write(content)
+            else:
+                for config in configs:
+                    write_terragrunt_config(config, f, output_format)
+        os.replace(temporary_file, output_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_file)
+        raise
+    return True
+
+
+def report_changes(changes):
+    """
+    Print a summary of which outputs changed, and write it to CHANGE_SUMMARY_FILE if specified.
+    """
+    summary = {
+        "changed": [name for name, changed in changes.items() if changed],
+        "unchanged": [name for name, changed in changes.items() if not changed],
+    }
+    summary["anyChanged"] = bool(summary["changed"])
+
+    print(f"Change summary: {json.dumps(summary)}")
+    if os.getenv('CHANGE_SUMMARY_FILE'):
+        with open(os.getenv('CHANGE_SUMMARY_FILE'), 'w') as f:
+            json.dump(summary, f, indent=2)
 
 
 def get_container_definitions():
@@ -148,6 +804,8 @@ def get_container_definitions():
     # Required parameters
     cluster = os.getenv('ECS_CLUSTER')
     service = os.getenv('ECS_SERVICE')
+    output_format = get_output_format()
+    only_if_changed = os.getenv('ONLY_WRITE_IF_CHANGED', 'false').lower() == 'true'
 
     # Validate required parameters
     if not cluster:
@@ -158,6 +816,8 @@ def get_container_definitions():
         print("Error: ECS_SERVICE is required")
         sys.exit(1)
 
+    load_conversion_config()
+
     try:
         # Get the ECS client
         ecs_client = get_boto3_client('ecs')
@@ -178,25 +838,30 @@ def get_container_definitions():
         print(f"Found task definition: {task_definition_arn}")
 
         # Get the task definition details
-        task_def_response = ecs_client.describe_task_definition(
-            taskDefinition=task_definition_arn
-        )
+        task_definition = describe_task_definition(ecs_client, task_definition_arn)
 
         print("Converting to Terragrunt format...")
-        response = convert_to_terragrunt_format(
-            task_def_response['taskDefinition'],
-            service
-        )
-
-        output_content = yaml.dump(response, default_flow_style=False, sort_keys=False)
+        response = convert_task_definition(task_definition_arn, task_definition, service, lazy=not only_if_changed)
 
         # Write to file if specified
         if os.getenv('OUTPUT_FILE'):
-            with open(os.getenv('OUTPUT_FILE'), 'w') as f:
-                f.write(output_content)
-            print(f"Output written to {os.getenv('OUTPUT_FILE')}")
+            if write_output_file(os.getenv('OUTPUT_FILE'), [response], output_format, only_if_changed):
+                print(f"Output written to {os.getenv('OUTPUT_FILE')}")
+                changed = True
+            else:
+                print(f"Output in {os.getenv('OUTPUT_FILE')} is unchanged, skipping write")
+                changed = False
+
+            if only_if_changed:
+                report_changes({service: changed})
         else:
-            print(output_content)
+            write_terragrunt_config(response, sys.stdout, output_format)
+
+        cache = get_task_definition_cache()
+        if cache is not None:
+            cache.evict()
+            print(cache.summary())
+        print_auth_metrics()
 
         print("✅ Successfully retrieved container definitions")
         return 0
@@ -206,5 +871,222 @@ def get_container_definitions():
         return 1
 
 
+def parse_list(value):
+    """
+    Parse a YAML list or comma separated string into a list of names.
+    """
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError:
+        parsed = None
+
+    if isinstance(parsed, list):
+        return [str(item).strip() for item in parsed if str(item).strip()]
+
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def get_requested_services():
+    """
+    Parse ECS_SERVICES into a list of service names, None if batch mode is not requested.
+    A single "*" (or ECS_SERVICE="*") exports every service in the cluster.
+    """
+    services = os.getenv('ECS_SERVICES', '')
+    if not services:
+        if os.getenv('ECS_SERVICE') == '*':
+            return ['*']
+        if (os.getenv('AWS_REGIONS') or os.getenv('ECS_CLUSTERS')) and os.getenv('ECS_SERVICE'):
+            return [os.getenv('ECS_SERVICE')]
+        return None
+
+    return parse_list(services)
+
+
+def get_export_targets():
+    """
+    Get the (region, cluster) pairs to export from AWS_REGIONS and ECS_CLUSTERS,
+    falling back to AWS_REGION and ECS_CLUSTER.
+    """
+    regions = parse_list(os.getenv('AWS_REGIONS', '')) or [get_region()]
+    clusters = parse_list(os.getenv('ECS_CLUSTERS', ''))
+    if not clusters and os.getenv('ECS_CLUSTER'):
+        clusters = [os.getenv('ECS_CLUSTER')]
+    return [(region, cluster) for region in regions for cluster in clusters]
+
+
+def list_cluster_services(ecs_client, cluster):
+    """
+    List the names of every service in the cluster.
+    """
+    service_names = []
+    paginator = ecs_client.get_paginator('list_services')
+    for page in paginator.paginate(cluster=cluster):
+        for service_arn in page.get('serviceArns', []):
+            service_names.append(service_arn.split('/')[-1])
+    return service_names
+
+
+def describe_services_in_chunks(ecs_client, cluster, services):
+    """
+    Map each service name to its task definition ARN, describing services in chunks of 10.
+    """
+    task_definition_arns = {}
+    for start in range(0, len(services), DESCRIBE_SERVICES_CHUNK_SIZE):
+        chunk = services[start:start + DESCRIBE_SERVICES_CHUNK_SIZE]
+        response = ecs_client.describe_services(cluster=cluster, services=chunk)
+
+        for service in response.get('services', []):
+            task_definition_arns[service['serviceName']] = service['taskDefinition']
+
+        for failure in response.get('failures', []):
+            print(f"Warning: Unable to describe {failure.get('arn')}: {failure.get('reason')}")
+
+    return task_definition_arns
+
+
+def fetch_task_definitions(ecs_client, task_definition_arns, max_workers):
+    """
+    Fetch each unique task definition once, in parallel.
+    """
+    unique_arns = list(dict.fromkeys(task_definition_arns))
+
+    def describe(task_definition_arn):
+        return describe_task_definition(ecs_client, task_definition_arn)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(unique_arns, executor.map(describe, unique_arns)))
+
+
+def collect_cluster(region, cluster, services, max_workers):
+    """
+    Resolve the services of one cluster to their task definitions.
+    Returns the task definition ARN per service, the task definitions by ARN and the missing services.
+    """
+    ecs_client = get_boto3_client('ecs', region)
+
+    if services == ['*']:
+        print(f"Listing all services in cluster {cluster} ({region})...")
+        services = list_cluster_services(ecs_client, cluster)
+
+    print(f"Fetching service details for {len(services)} services in cluster {cluster} ({region})...")
+    task_definition_arns = describe_services_in_chunks(ecs_client, cluster, services)
+
+    missing_services = [service for service in services if service not in task_definition_arns]
+    for service in missing_services:
+        print(f"Error: Service {service} not found in cluster {cluster} ({region})")
+
+    print(f"Fetching {len(set(task_definition_arns.values()))} unique task definitions for {cluster} ({region})...")
+    task_definitions = fetch_task_definitions(ecs_client, task_definition_arns.values(), max_workers)
+
+    return task_definition_arns, task_definitions, missing_services
+
+
+def export_services(services):
+    """
+    Export the container definitions of several ECS services, one file per service.
+    NDJSON output goes to a single OUTPUT_FILE, one line per service, when it is specified.
+    With several regions or clusters, every cluster is exported concurrently and output is
+    written per region: OUTPUT_DIRECTORY/<region>/<cluster>/<service> or OUTPUT_DIRECTORY/<region>.ndjson.
+    """
+    targets = get_export_targets()
+    output_directory = os.getenv('OUTPUT_DIRECTORY', '.')
+    max_workers = int(os.getenv('MAX_WORKERS', '8'))
+    output_format = get_output_format()
+    only_if_changed = os.getenv('ONLY_WRITE_IF_CHANGED', 'false').lower() == 'true'
+    fan_out = len(targets) > 1
+
+    if not targets:
+        print("Error: ECS_CLUSTER is required")
+        sys.exit(1)
+
+    load_conversion_config()
+
+    try:
+        def collect(target):
+            region, cluster = target
+            return collect_cluster(region, cluster, services, max_workers)
+
+        with ThreadPoolExecutor(max_workers=min(len(targets), max_workers)) as executor:
+            results = dict(zip(targets, executor.map(collect, targets)))
+
+        print("Converting to Terragrunt format...")
+        changes = {}
+        missing_services = []
+        exported_services = 0
+        region_outputs = {}
+
+        for (region, cluster), (task_definition_arns, task_definitions, missing) in results.items():
+            prefix = f"{region}/{cluster}/" if fan_out else ""
+            missing_services.extend(prefix + service for service in missing)
+            exported_services += len(task_definition_arns)
+
+            responses = [
+                (prefix + service, convert_task_definition(
+                    task_definition_arn, task_definitions[task_definition_arn], service, lazy=not only_if_changed))
+                for service, task_definition_arn in task_definition_arns.items()
+            ]
+
+            if output_format == 'ndjson' and fan_out:
+                region_outputs.setdefault(region, []).extend(responses)
+                continue
+
+            if output_format == 'ndjson' and os.getenv('OUTPUT_FILE'):
+                region_outputs[None] = responses
+                continue
+
+            cluster_directory = os.path.join(output_directory, region, cluster) if fan_out else output_directory
+            os.makedirs(cluster_directory, exist_ok=True)
+            extension = OUTPUT_FILE_EXTENSIONS[output_format]
+            for name, response in responses:
+                service = name[len(prefix):]
+                output_file = os.path.join(cluster_directory, f"{service}.{extension}")
+                changes[name] = write_output_file(output_file, [response], output_format, only_if_changed)
+                if changes[name]:
+                    print(f"Output for {name} written to {output_file}")
+                else:
+                    print(f"Output for {name} in {output_file} is unchanged, skipping write")
+
+        for region, responses in region_outputs.items():
+            if region is None:
+                output_file = os.getenv('OUTPUT_FILE')
+            else:
+                os.makedirs(output_directory, exist_ok=True)
+                output_file = os.path.join(output_directory, f"{region}.ndjson")
+
+            changed = write_output_file(
+                output_file, [response for _, response in responses], output_format, only_if_changed)
+            changes.update((name, changed) for name, _ in responses)
+            print(f"Output {'written to' if changed else 'is unchanged in'} {output_file}")
+
+        if only_if_changed:
+            report_changes(changes)
+
+        if missing_services:
+            print(f"❌ Error: {len(missing_services)} services could not be found")
+            return 1
+
+        cache = get_task_definition_cache()
+        if cache is not None:
+            cache.evict()
+            print(cache.summary())
+        print_auth_metrics()
+
+        print(f"✅ Successfully retrieved container definitions for {exported_services} services")
+        return 0
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return 1
+
+
 if __name__ == "__main__":
-    sys.exit(get_container_definitions())
+    requested_services = get_requested_services()
+    try:
+        with telemetry.span('run'):
+            if requested_services is not None:
+                exit_code = export_services(requested_services)
+            else:
+                exit_code = get_container_definitions()
+    finally:
+        report_telemetry()
+    sys.exit(exit_code)
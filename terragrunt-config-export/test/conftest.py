@@ -0,0 +1,43 @@
+import pytest
+import main
+
+
+# Variables the pipe reads, cleared so a developer's environment doesn't leak into the tests
+PIPE_VARIABLES = [
+    'AWS_REGION', 'AWS_DEFAULT_REGION', 'AWS_REGIONS', 'AWS_PROFILE', 'AWS_OIDC_ROLE_ARN', 'BITBUCKET_STEP_OIDC_TOKEN',
+    'BITBUCKET_BUILD_NUMBER', 'ECS_CLUSTER', 'ECS_CLUSTERS', 'ECS_SERVICE', 'ECS_SERVICES', 'OUTPUT_FILE',
+    'OUTPUT_DIRECTORY', 'OUTPUT_FORMAT', 'ONLY_WRITE_IF_CHANGED', 'CHANGE_SUMMARY_FILE', 'CACHE_DIRECTORY',
+    'CACHE_MAX_SIZE_MB', 'MAX_WORKERS', 'REGION_RATE_LIMIT', 'TELEMETRY_FILE', 'OTLP_TRACES_FILE',
+    'EXTRA_ENV', 'ENDPOINTS', 'EXTERNAL_ENDPOINTS', 'MAIN_CONTAINER_NAME', 'IAM_ROLE',
+]
+
+
+@pytest.fixture(autouse=True)
+def pipe_state(monkeypatch):
+    """
+    Give each test a fresh environment, caches and telemetry in place of the process-wide ones.
+    """
+    for variable in PIPE_VARIABLES:
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(main, 'conversion_config', None)
+    monkeypatch.setattr(main, 'task_definition_cache', None)
+    monkeypatch.setattr(main, 'boto3_session', None)
+    monkeypatch.setattr(main, 'boto3_clients', {})
+    monkeypatch.setattr(main, 'rate_limiters', {})
+    monkeypatch.setattr(main, 'auth_metrics', dict.fromkeys(main.auth_metrics, 0))
+    monkeypatch.setattr(main, 'telemetry', main.Telemetry('terragrunt-config-export', 'aws '))
+
+
+@pytest.fixture
+def ecs_clients(monkeypatch):
+    """
+    Map of region to FakeEcsClient, which get_boto3_client hands out in place of real clients.
+    """
+    clients = {}
+
+    def get_boto3_client(service_name='ecs', region=None):
+        assert service_name == 'ecs'
+        return clients[region or main.get_region()]
+
+    monkeypatch.setattr(main, 'get_boto3_client', get_boto3_client)
+    return clients
@@ -0,0 +1,63 @@
+import threading
+
+
+class FakeEcsClient:
+    """
+    Stand-in for a region's ECS client, serving clusters and task definitions from dicts and recording every call.
+    """
+
+    def __init__(self, clusters, task_definitions):
+        self.clusters = clusters
+        self.task_definitions = task_definitions
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, operation, **kwargs):
+        with self.lock:
+            self.calls.append((operation, kwargs))
+
+    def operations(self, operation):
+        return [kwargs for name, kwargs in self.calls if name == operation]
+
+    def get_paginator(self, operation):
+        assert operation == 'list_services'
+        return self
+
+    def paginate(self, cluster):
+        self.record('list_services', cluster=cluster)
+        names = list(self.clusters.get(cluster, {}))
+        for start in range(0, len(names), 2):
+            yield {'serviceArns': [f"arn:aws:ecs:eu-west-1:1:service/{cluster}/{name}" for name in names[start:start + 2]]}
+
+    def describe_services(self, cluster, services):
+        self.record('describe_services', cluster=cluster, services=services)
+        assert len(services) <= 10, "describe_services accepts at most 10 services"
+        found = self.clusters.get(cluster, {})
+        return {
+            'services': [{'serviceName': name, 'taskDefinition': found[name]} for name in services if name in found],
+            'failures': [{'arn': name, 'reason': 'MISSING'} for name in services if name not in found],
+        }
+
+    def describe_task_definition(self, taskDefinition):
+        self.record('describe_task_definition', taskDefinition=taskDefinition)
+        return {'taskDefinition': self.task_definitions[taskDefinition]}
+
+
+def task_definition(family, revision=1):
+    return {
+        'family': family,
+        'revision': revision,
+        'cpu': '256',
+        'memory': '512',
+        'containerDefinitions': [{
+            'name': family,
+            'image': f"123456789012.dkr.ecr.eu-west-1.amazonaws.com/{family}:{revision}",
+            'environment': [{'name': 'FAMILY', 'value': family}],
+            'secrets': [{'name': 'DB', 'valueFrom': f"arn:aws:secretsmanager:eu-west-1:1:secret:{family}-db-AbCdEf"}],
+            'portMappings': [{'name': 'http', 'hostPort': 80, 'containerPort': 80, 'protocol': 'tcp'}],
+        }],
+    }
+
+
+def task_definition_arn(family, revision=1):
+    return f"arn:aws:ecs:eu-west-1:123456789012:task-definition/{family}:{revision}"
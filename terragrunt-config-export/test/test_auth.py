@@ -0,0 +1,68 @@
+import datetime
+import pytest
+import main
+from botocore.stub import Stubber
+
+
+@pytest.fixture
+def assumed_roles(monkeypatch):
+    """
+    Queue of credential lifetimes for the stubbed STS client to answer AssumeRoleWithWebIdentity calls with.
+    """
+    monkeypatch.setenv('AWS_OIDC_ROLE_ARN', 'arn:aws:iam::123456789012:role/export')
+    monkeypatch.setenv('BITBUCKET_STEP_OIDC_TOKEN', 'oidc-token')
+    monkeypatch.setenv('BITBUCKET_BUILD_NUMBER', '42')
+    lifetimes = []
+    stubbers = []
+    instrument_client = main.instrument_client
+
+    def stub(client):
+        if client.meta.service_model.service_name == 'sts':
+            stubber = Stubber(client)
+            for index, lifetime in enumerate(lifetimes, 1):
+                stubber.add_response('assume_role_with_web_identity', {'Credentials': {
+                    'AccessKeyId': f"AKIA{index:016d}",
+                    'SecretAccessKey': f"secret-{index}",
+                    'SessionToken': f"token-{index}",
+                    'Expiration': datetime.datetime.now(datetime.timezone.utc) + lifetime,
+                }}, {
+                    'RoleArn': 'arn:aws:iam::123456789012:role/export',
+                    'RoleSessionName': 'terragrunt-config-export-42',
+                    'WebIdentityToken': 'oidc-token',
+                })
+            stubber.activate()
+            stubbers.append(stubber)
+        return instrument_client(client)
+
+    monkeypatch.setattr(main, 'instrument_client', stub)
+    yield lifetimes
+    for stubber in stubbers:
+        stubber.assert_no_pending_responses()
+
+
+def test_role_is_assumed_once_and_clients_are_reused(assumed_roles):
+    assumed_roles.append(datetime.timedelta(hours=1))
+
+    session = main.get_boto3_session()
+    ecs_client = main.get_boto3_client('ecs', 'eu-west-1')
+
+    assert main.get_boto3_session() is session
+    assert main.get_boto3_client('ecs', 'eu-west-1') is ecs_client
+    assert main.get_boto3_client('ecs', 'us-east-1') is not ecs_client
+    credentials = session.get_credentials().get_frozen_credentials()
+    assert (credentials.access_key, credentials.token) == ('AKIA0000000000000001', 'token-1')
+    assert main.auth_metrics['assumeRoleCalls'] == 1
+    assert main.auth_metrics['clientsCreated'] == 2
+    assert main.auth_metrics['clientCacheHits'] == 1
+
+
+def test_expiring_credentials_are_refreshed(assumed_roles):
+    # Credentials within botocore's mandatory refresh window are replaced before they are used
+    assumed_roles.extend([datetime.timedelta(minutes=5), datetime.timedelta(hours=1)])
+
+    session = main.get_boto3_session()
+    credentials = session.get_credentials().get_frozen_credentials()
+
+    assert (credentials.access_key, credentials.token) == ('AKIA0000000000000002', 'token-2')
+    assert main.auth_metrics['assumeRoleCalls'] == 2
+
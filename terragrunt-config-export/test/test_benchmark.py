@@ -0,0 +1,79 @@
+import io
+import pytest
+import main
+
+
+def secret_arn(index):
+    return f'arn:aws:secretsmanager:eu-west-1:123456789012:secret:service-secret-{index % 10}-AbCdEf'
+
+
+def build_task_definition(containers, variables):
+    """Build a task definition with the given number of env vars and secrets per container."""
+    return {
+        'cpu': '1024',
+        'memory': '2048',
+        'containerDefinitions': [
+            {
+                'name': f'container-{container}',
+                'image': f'123456789012.dkr.ecr.eu-west-1.amazonaws.com/service:{container}',
+                'environment': [{'name': f'VARIABLE_{index}', 'value': f'value-{index}'} for index in range(variables)],
+                'secrets': [
+                    {'name': f'SECRET_{index}', 'valueFrom': f'{secret_arn(index)}:SECRET_{index}::'}
+                    for index in range(variables)
+                ],
+                'portMappings': [{'name': 'http', 'hostPort': 80, 'containerPort': 80, 'protocol': 'tcp'}],
+                'dependsOn': [{'condition': 'START', 'containerName': 'container-0'}],
+            }
+            for container in range(containers)
+        ],
+    }
+
+
+@pytest.fixture(autouse=True)
+def conversion_config(monkeypatch):
+    monkeypatch.setenv('EXTRA_ENV', '{"BASE_URL": "example.com"}')
+    monkeypatch.setenv('MAIN_CONTAINER_NAME', 'container-0')
+    monkeypatch.setattr(main, 'conversion_config', None)
+
+
+def test_secret_names_are_resolved_once_in_order():
+    task_definition = {
+        'containerDefinitions': [
+            {'secrets': [
+                {'name': 'A', 'valueFrom': 'arn:aws:secretsmanager:eu-west-1:1:secret:app-AbCdEf'},
+                {'name': 'B', 'valueFrom': 'arn:aws:secretsmanager:eu-west-1:1:secret:app-AbCdEf:KEY::'},
+                {'name': 'SHAREDSECRETS', 'valueFrom': 'arn:aws:secretsmanager:eu-west-1:1:secret:shared-AbCdEf'},
+            ]},
+            {'secrets': [{'name': 'C', 'valueFrom': 'arn:aws:secretsmanager:eu-west-1:1:secret:app-db-AbCdEf'}]},
+        ]
+    }
+
+    config = main.convert_to_terragrunt_format(task_definition, 'service')
+
+    assert config['terragruntConfig']['secretNames'] == ['app', 'app-db']
+    assert config['terragruntConfig']['secretName'] == 'app-db'
+
+
+@pytest.mark.parametrize('containers,variables', [(1, 1000), (4, 2500)])
+def test_convert_to_terragrunt_format(benchmark, containers, variables):
+    task_definition = build_task_definition(containers, variables)
+
+    config = benchmark(main.convert_to_terragrunt_format, task_definition, 'service')
+
+    assert len(config['terragruntConfig']['containers']) == containers
+    assert len(config['terragruntConfig']['secretNames']) == 10
+
+
+@pytest.mark.parametrize('output_format', ['yaml', 'json'])
+def test_write_terragrunt_config(benchmark, output_format):
+    task_definition = build_task_definition(4, 2500)
+
+    def convert_and_write():
+        stream = io.StringIO()
+        main.write_terragrunt_config(
+            main.convert_to_terragrunt_format(task_definition, 'service', lazy=True), stream, output_format)
+        return stream.getvalue()
+
+    output = benchmark(convert_and_write)
+
+    assert 'VARIABLE_2499' in output
@@ -0,0 +1,93 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import main
+from test.fakes import FakeEcsClient, task_definition, task_definition_arn
+
+
+@pytest.fixture
+def cached_export(ecs_clients, monkeypatch, tmp_path):
+    """
+    Run a batch export of two services with CACHE_DIRECTORY set, each run starting from a new process' state.
+    Returns the fake ECS client and the run function, which returns the number of conversions made.
+    """
+    services = {'api': task_definition_arn('api', 3), 'worker': 'arn:aws:ecs:eu-west-1:1:task-definition/worker'}
+    task_definitions = {services['api']: task_definition('api', 3), services['worker']: task_definition('worker')}
+    ecs_clients['eu-west-1'] = ecs = FakeEcsClient({'cluster': services}, task_definitions)
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path / 'output'))
+    monkeypatch.setenv('CACHE_DIRECTORY', str(tmp_path / 'cache'))
+
+    convert_to_terragrunt_format = main.convert_to_terragrunt_format
+    conversions = []
+
+    def convert(task_definition, service_name, lazy=False):
+        conversions.append(service_name)
+        return convert_to_terragrunt_format(task_definition, service_name, lazy)
+
+    monkeypatch.setattr(main, 'convert_to_terragrunt_format', convert)
+
+    def run():
+        monkeypatch.setattr(main, 'task_definition_cache', None)
+        conversions.clear()
+        ecs.calls.clear()
+        assert main.export_services(['api', 'worker']) == 0
+        return list(conversions)
+
+    return ecs, run
+
+
+def test_second_run_is_served_from_the_cache(cached_export, tmp_path):
+    ecs, run = cached_export
+    assert sorted(run()) == ['api', 'worker']
+    first_output = (tmp_path / 'output' / 'api.yml').read_text()
+
+    # Only the revision pinned ARN is cached, the unpinned one may point at a new revision
+    assert run() == ['worker']
+    assert [call['taskDefinition'] for call in ecs.operations('describe_task_definition')] == [
+        'arn:aws:ecs:eu-west-1:1:task-definition/worker']
+    assert main.task_definition_cache.hits == 2
+    assert (tmp_path / 'output' / 'api.yml').read_text() == first_output
+
+
+def test_conversions_are_redone_when_the_conversion_version_changes(cached_export, monkeypatch):
+    ecs, run = cached_export
+    run()
+
+    monkeypatch.setattr(main, 'CONVERSION_VERSION', main.CONVERSION_VERSION + 1)
+
+    assert sorted(run()) == ['api', 'worker']
+    assert len(ecs.operations('describe_task_definition')) == 1
+
+
+def test_conversions_are_redone_when_the_conversion_inputs_change(cached_export, monkeypatch):
+    ecs, run = cached_export
+    run()
+
+    monkeypatch.setenv('IAM_ROLE', 'arn:aws:iam::1:role/other')
+    monkeypatch.setattr(main, 'conversion_config', None)
+
+    assert sorted(run()) == ['api', 'worker']
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = main.TaskDefinitionCache(str(tmp_path), max_size=0)
+    for index, key in enumerate(['old', 'used', 'new']):
+        cache.put(key, {'value': 'x' * 100})
+        os.utime(cache.path(key), (index, index))
+    cache.max_size = 2 * os.path.getsize(cache.path('old'))
+    cache.get('used')
+
+    cache.evict()
+
+    assert cache.get('old') is None
+    assert cache.get('used') == cache.get('new') == {'value': 'x' * 100}
+
+
+def test_worker_threads_share_one_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv('CACHE_DIRECTORY', str(tmp_path))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        caches = list(executor.map(lambda _: main.get_task_definition_cache(), range(32)))
+
+    assert len({id(cache) for cache in caches}) == 1
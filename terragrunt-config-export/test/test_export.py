@@ -0,0 +1,122 @@
+import json
+import pytest
+import yaml
+import main
+from test.fakes import FakeEcsClient, task_definition, task_definition_arn
+
+
+def read_yaml(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def test_services_are_described_in_chunks_and_task_definitions_fetched_once(ecs_clients, monkeypatch, tmp_path):
+    # 23 services sharing 5 task definitions
+    services = {f"service-{index}": task_definition_arn(f"family-{index % 5}") for index in range(23)}
+    task_definitions = {task_definition_arn(f"family-{index}"): task_definition(f"family-{index}") for index in range(5)}
+    ecs_clients['eu-west-1'] = ecs = FakeEcsClient({'cluster': services}, task_definitions)
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path))
+
+    assert main.export_services(list(services)) == 0
+
+    assert [len(call['services']) for call in ecs.operations('describe_services')] == [10, 10, 3]
+    assert sorted(call['taskDefinition'] for call in ecs.operations('describe_task_definition')) == sorted(task_definitions)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(f"{service}.yml" for service in services)
+    assert read_yaml(tmp_path / 'service-7.yml') == main.convert_to_terragrunt_format(task_definition('family-2'), 'service-7')
+
+
+def test_every_service_in_the_cluster_is_listed(ecs_clients, monkeypatch, tmp_path):
+    services = {name: task_definition_arn(name) for name in ['api', 'worker', 'scheduler']}
+    ecs_clients['eu-west-1'] = FakeEcsClient({'cluster': services}, {arn: task_definition(name) for name, arn in services.items()})
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('ECS_SERVICE', '*')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path))
+
+    assert main.export_services(main.get_requested_services()) == 0
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['api.yml', 'scheduler.yml', 'worker.yml']
+
+
+def test_missing_services_fail_the_run_after_exporting_the_rest(ecs_clients, monkeypatch, tmp_path):
+    ecs_clients['eu-west-1'] = FakeEcsClient({'cluster': {'api': task_definition_arn('api')}},
+                                             {task_definition_arn('api'): task_definition('api')})
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('ECS_SERVICES', 'api, missing')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path))
+
+    assert main.export_services(main.get_requested_services()) == 1
+
+    assert [path.name for path in tmp_path.iterdir()] == ['api.yml']
+
+
+def test_ndjson_batch_output_goes_to_one_file(ecs_clients, monkeypatch, tmp_path):
+    services = {name: task_definition_arn(name) for name in ['api', 'worker']}
+    ecs_clients['eu-west-1'] = FakeEcsClient({'cluster': services}, {arn: task_definition(name) for name, arn in services.items()})
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('OUTPUT_FORMAT', 'ndjson')
+    monkeypatch.setenv('OUTPUT_FILE', str(tmp_path / 'services.ndjson'))
+
+    assert main.export_services(['api', 'worker']) == 0
+
+    lines = (tmp_path / 'services.ndjson').read_text().splitlines()
+    assert [yaml.safe_load(line)['terragruntConfig']['name'] for line in lines] == ['(api)', '(worker)']
+
+
+@pytest.fixture
+def fan_out(ecs_clients, monkeypatch, tmp_path):
+    """
+    An api service in the blue and green clusters of two regions.
+    """
+    for region in ['eu-west-1', 'us-east-1']:
+        clusters = {cluster: {'api': task_definition_arn(f"{region}-{cluster}")} for cluster in ['blue', 'green']}
+        ecs_clients[region] = FakeEcsClient(clusters, {
+            task_definition_arn(f"{region}-{cluster}"): task_definition(f"{region}-{cluster}") for cluster in clusters})
+    monkeypatch.setenv('AWS_REGIONS', 'eu-west-1, us-east-1')
+    monkeypatch.setenv('ECS_CLUSTERS', '[blue, green]')
+    monkeypatch.setenv('ECS_SERVICE', 'api')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path))
+    return ecs_clients
+
+
+def test_fan_out_writes_each_cluster_of_each_region(fan_out, tmp_path):
+    assert main.export_services(main.get_requested_services()) == 0
+
+    for region, ecs in fan_out.items():
+        assert sorted(call['cluster'] for call in ecs.operations('describe_services')) == ['blue', 'green']
+        for cluster in ['blue', 'green']:
+            config = read_yaml(tmp_path / region / cluster / 'api.yml')
+            assert config['terragruntConfig']['containers'][0]['name'] == f"{region}-{cluster}"
+
+
+def test_fan_out_ndjson_is_written_per_region(fan_out, monkeypatch, tmp_path):
+    monkeypatch.setenv('OUTPUT_FORMAT', 'ndjson')
+
+    assert main.export_services(main.get_requested_services()) == 0
+
+    for region in fan_out:
+        lines = (tmp_path / f"{region}.ndjson").read_text().splitlines()
+        assert [json.loads(line)['terragruntConfig']['containers'][0]['name'] for line in lines] == [
+            f"{region}-blue", f"{region}-green"]
+
+
+def test_rate_limiter_waits_once_the_burst_is_spent(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(main.time, 'monotonic', lambda: 100.0)
+    monkeypatch.setattr(main.time, 'sleep', sleeps.append)
+    rate_limiter = main.RateLimiter(2)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+
+    assert sleeps == [0.5, 1.0]
+
+
+def test_rate_limiter_is_shared_by_a_regions_clients(monkeypatch):
+    monkeypatch.setenv('REGION_RATE_LIMIT', '5')
+
+    assert main.get_rate_limiter('eu-west-1') is main.get_rate_limiter('eu-west-1')
+    assert main.get_rate_limiter('eu-west-1') is not main.get_rate_limiter('us-east-1')
+
+    monkeypatch.setenv('REGION_RATE_LIMIT', '0')
+    assert main.get_rate_limiter('ap-south-1') is None
@@ -0,0 +1,60 @@
+import json
+import time
+import boto3
+import pytest
+import main
+from botocore.awsrequest import AWSResponse
+
+
+@pytest.fixture
+def ecs_responses(monkeypatch):
+    """
+    An instrumented ECS client whose HTTP requests are answered from a queue of (status code, body) responses,
+    so botocore still parses the responses and retries the throttled ones.
+    """
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    session = boto3.Session(aws_access_key_id='test', aws_secret_access_key='test')
+    client = main.instrument_client(session.client('ecs', region_name='eu-west-1'))
+    responses = []
+
+    def send(request, **kwargs):
+        status_code, body = responses.pop(0)
+        return AWSResponse(request.url, status_code, {}, FakeRaw(json.dumps(body).encode()))
+
+    client.meta.events.register('before-send.ecs', send)
+    yield client, responses
+    assert not responses
+
+
+class FakeRaw:
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self, **kwargs):
+        yield self.content
+
+
+def test_aws_calls_are_recorded_as_client_spans_with_their_retries(ecs_responses, tmp_path):
+    client, responses = ecs_responses
+    responses.extend([
+        (400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'}),
+        (400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'}),
+        (200, {'services': [], 'failures': []}),
+        (400, {'__type': 'ClientException', 'message': 'Unable to describe task definition.'}),
+    ])
+
+    client.describe_services(cluster='cluster', services=['api'])
+    with pytest.raises(client.exceptions.ClientException):
+        client.describe_task_definition(taskDefinition='api:1')
+
+    summary = main.telemetry.summary()
+    assert summary['counters'] == {'awsRetries': 2}
+    assert summary['spans']['aws ecs.DescribeServices']['count'] == 1
+    assert summary['spans']['aws ecs.DescribeTaskDefinition']['errors'] == 1
+
+    main.telemetry.write_otlp(str(tmp_path / 'traces.json'))
+    with open(tmp_path / 'traces.json') as f:
+        spans = {span['name']: span for span in json.load(f)['resourceSpans'][0]['scopeSpans'][0]['spans']}
+    assert spans['aws ecs.DescribeServices']['kind'] == 3
+    assert {'key': 'retries', 'value': {'intValue': '2'}} in spans['aws ecs.DescribeServices']['attributes']
+    assert spans['aws ecs.DescribeTaskDefinition']['status']['code'] == 2
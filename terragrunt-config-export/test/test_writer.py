@@ -0,0 +1,95 @@
+import io
+import os
+import json
+import pytest
+import yaml
+import main
+from test.fakes import FakeEcsClient, task_definition, task_definition_arn
+
+
+DOCUMENTS = {
+    'nested': {'a': {'b': [1, 2.5, {'c': [True, None]}], 'd': {'e': {'f': 'g'}}}, 'h': [[1, [2]], []]},
+    'empty': {'dict': {}, 'list': [], 'string': '', 'none': None},
+    'unicode': {'café': 'naïve ünïcödé', 'emoji': '🚀', 'cjk': ['日本語', '中文'], 'escape': 'tab\there'},
+    'ambiguous strings': {'yes': 'no', 'number': '123', 'float': '1.5', 'null': 'null', 'colon': 'a: b', 'dash': '- x'},
+    'multiline': {'text': 'first line\nsecond line\n', 'long': 'word ' * 40},
+    'top level list': [{'a': 1}, 'b', []],
+}
+
+
+def write(config, output_format):
+    stream = io.StringIO()
+    main.write_terragrunt_config(config, stream, output_format)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize('data', DOCUMENTS.values(), ids=DOCUMENTS.keys())
+def test_yaml_is_what_yaml_dump_writes(data):
+    output = write(data, 'yaml')
+
+    assert output == yaml.dump(data, Dumper=main.YamlDumper, default_flow_style=False, sort_keys=False)
+    # The call earlier versions of the pipe wrote their output with
+    assert output == yaml.dump(data, default_flow_style=False, sort_keys=False)
+
+
+@pytest.mark.parametrize('data', DOCUMENTS.values(), ids=DOCUMENTS.keys())
+def test_json_is_what_json_dump_writes(data):
+    assert write(data, 'json') == json.dumps(data, indent=2) + '\n'
+    assert write(data, 'ndjson') == json.dumps(data, separators=(',', ':')) + '\n'
+
+
+@pytest.mark.parametrize('output_format', main.OUTPUT_FORMATS)
+def test_lazy_containers_are_written_like_a_list(output_format):
+    definition = task_definition('api')
+    definition['containerDefinitions'] *= 3
+
+    lazy = main.convert_to_terragrunt_format(definition, 'api', lazy=True)
+    eager = main.convert_to_terragrunt_format(definition, 'api')
+
+    assert write(lazy, output_format) == write(eager, output_format)
+
+
+def test_failed_write_leaves_the_previous_output(tmp_path):
+    output_file = tmp_path / 'api.yml'
+    output_file.write_text('previous: output\n')
+
+    def containers():
+        yield {'name': 'api'}
+        raise RuntimeError('conversion failed')
+
+    with pytest.raises(RuntimeError):
+        main.write_output_file(str(output_file), [{'containers': containers()}], 'yaml')
+
+    assert output_file.read_text() == 'previous: output\n'
+    assert [path.name for path in tmp_path.iterdir()] == ['api.yml']
+
+
+def test_unchanged_output_is_not_rewritten(tmp_path):
+    output_file = tmp_path / 'api.yml'
+    config = main.convert_to_terragrunt_format(task_definition('api'), 'api')
+
+    assert main.write_output_file(str(output_file), [config], 'yaml', only_if_changed=True)
+    os.utime(output_file, (0, 0))
+
+    assert not main.write_output_file(str(output_file), [config], 'yaml', only_if_changed=True)
+    assert os.path.getmtime(output_file) == 0
+
+    config['terragruntConfig']['iamRole'] = 'arn:aws:iam::1:role/other'
+    assert main.write_output_file(str(output_file), [config], 'yaml', only_if_changed=True)
+    assert main.read_output_file(str(output_file)) == write(config, 'yaml')
+
+
+def test_change_summary_lists_the_changed_services(ecs_clients, monkeypatch, tmp_path):
+    services = {name: task_definition_arn(name) for name in ['api', 'worker']}
+    ecs_clients['eu-west-1'] = FakeEcsClient({'cluster': services}, {arn: task_definition(name) for name, arn in services.items()})
+    monkeypatch.setenv('ECS_CLUSTER', 'cluster')
+    monkeypatch.setenv('OUTPUT_DIRECTORY', str(tmp_path / 'output'))
+    monkeypatch.setenv('ONLY_WRITE_IF_CHANGED', 'true')
+    monkeypatch.setenv('CHANGE_SUMMARY_FILE', str(tmp_path / 'changes.json'))
+    assert main.export_services(['api', 'worker']) == 0
+
+    ecs_clients['eu-west-1'].task_definitions[services['worker']]['cpu'] = '512'
+    assert main.export_services(['api', 'worker']) == 0
+
+    with open(tmp_path / 'changes.json') as f:
+        assert json.load(f) == {'changed': ['worker'], 'unchanged': ['api'], 'anyChanged': True}